@@ -0,0 +1,93 @@
+# Bytes saved by CompressionMiddleware per endpoint and encoding. Representative payloads for
+# /user, /chat_history, /view_summary, /chat (diagnosis card) and the streamed /debug/users
+# NDJSON are sent through the middleware in-process. Reports identity vs zstd/gzip sizes,
+# the ratio and the time spent compressing each response.
+# Run from the backend directory: python benchmarks/bench_compression.py
+import os
+import sys
+import time
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from main import CompressionMiddleware, FastJSONResponse, COMPRESSION_MIN_SIZE, dump_json
+from bench_serialization import make_session, make_chat_history
+
+REPEAT = int(os.getenv("BENCH_REPEAT", "20"))
+
+DIAGNOSIS_CARD = "<div class=\"diagnosis-card\"><h3>Possible conditions</h3>" + "".join(
+    f"<div class=\"condition\"><strong>Condition {i}</strong><p>" + "Common causes and what to watch for. " * 12 + "</p></div>"
+    for i in range(4)
+) + "</div>"
+
+SUMMARY = "## Medical Case Summary\n\n" + "\n\n".join(
+    f"### {heading}\n" + f"{heading} details reported by the patient. " * 15
+    for heading in ["Chief Complaint", "History", "Medications", "Assessment", "Recommendations"]
+)
+
+def build_app():
+    app = FastAPI(default_response_class=FastJSONResponse)
+    session = make_session(50)
+    history = make_chat_history(200)
+    sessions = [make_session(20) for _ in range(100)]
+
+    @app.get("/user")
+    def user():
+        return session
+
+    @app.get("/chat_history")
+    def chat_history():
+        return history
+
+    @app.get("/view_summary")
+    def view_summary():
+        return {"summary": SUMMARY}
+
+    @app.get("/chat")
+    def chat():
+        return {"next_question": DIAGNOSIS_CARD, "current_step": "diagnosis"}
+
+    @app.get("/debug/users")
+    def debug_users():
+        return StreamingResponse((dump_json(s) + b"\n" for s in sessions), media_type="application/x-ndjson")
+
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+    return app
+
+# Wire size of the response body, read raw so httpx doesn't decode it
+async def measure(http, path, encoding):
+    elapsed = 0.0
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        size = 0
+        async with http.stream("GET", path, headers={"Accept-Encoding": encoding}) as response:
+            async for chunk in response.aiter_raw():
+                size += len(chunk)
+        elapsed += time.perf_counter() - started
+    assert response.headers.get("content-encoding", "identity") == encoding, f"{path} was not sent as {encoding}"
+    return size, elapsed / REPEAT
+
+async def main():
+    transport = httpx.ASGITransport(app=build_app())
+    print(f"{'endpoint':<14} {'identity':>10} {'zstd':>10} {'ratio':>6} {'gzip':>10} {'ratio':>6} {'+zstd ms':>9} {'+gzip ms':>9}")
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        for path in ["/user", "/chat_history", "/view_summary", "/chat", "/debug/users"]:
+            identity, identity_seconds = await measure(http, path, "identity")
+            results = {}
+            for encoding in ["zstd", "gzip"]:
+                size, seconds = await measure(http, path, encoding)
+                results[encoding] = (size, (seconds - identity_seconds) * 1000)
+            print(
+                f"{path:<14} {identity:>10} "
+                f"{results['zstd'][0]:>10} {identity / results['zstd'][0]:>6.1f} "
+                f"{results['gzip'][0]:>10} {identity / results['gzip'][0]:>6.1f} "
+                f"{results['zstd'][1]:>9.2f} {results['gzip'][1]:>9.2f}"
+            )
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+# Burst benchmark for the LLM rate governor against benchmarks/stub_groq.py.
+# Fires BENCH_CALLS concurrent urgency checks at a stub provider that enforces STUB_RPM/STUB_TPM,
+# once with the governor disabled and once with limits matching the stub, and reports
+# provider 429s, calls served from fallbacks and elapsed time for each run.
+# Run from the backend directory: python benchmarks/bench_rate_limits.py
+import os
+import sys
+import json
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = int(os.getenv("BENCH_STUB_PORT", "8790"))
+CALLS = int(os.getenv("BENCH_CALLS", "60"))
+STUB_RPM = os.getenv("STUB_RPM", "30")
+STUB_TPM = os.getenv("STUB_TPM", "6000")
+
+# Runs inside a child process so main.py picks up the rate limits for the mode being measured
+def run_burst():
+    sys.path.insert(0, BACKEND_DIR)
+    import main
+    
+    prompt = "Based on these symptoms, is this an urgent medical situation? Answer YES or NO.\nSymptoms: headache and mild fever"
+    
+    def call(_):
+        response = main.llm_router.invoke("urgency_check", prompt)
+        return bool(response.response_metadata.get("fallback"))
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CALLS) as callers:
+        fallbacks = sum(callers.map(call, range(CALLS)))
+    print(json.dumps({
+        "elapsed_seconds": round(time.perf_counter() - started, 2),
+        "served": CALLS - fallbacks,
+        "fallbacks": fallbacks,
+        "governor": [governor.stats() for governor in main.rate_governors.values()],
+    }))
+
+def measure(limits):
+    base_url = f"http://127.0.0.1:{PORT}"
+    env = {**os.environ, "GROQ_API_KEY": "benchmark", "GROQ_API_BASE": base_url, "LLM_RATE_LIMITS": limits, "BENCH_CHILD": "1"}
+    stub = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", "benchmarks", "stub_groq:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env={**os.environ, "STUB_RPM": STUB_RPM, "STUB_TPM": STUB_TPM}
+    )
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"{base_url}/stats", timeout=1)
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__)], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        result["provider"] = httpx.get(f"{base_url}/stats").json()
+        return result
+    finally:
+        stub.terminate()
+        stub.wait()
+
+def main():
+    fast_model = os.getenv("LLM_FAST_MODEL", "llama-3.1-8b-instant")
+    print(json.dumps({
+        "ungoverned": measure(f"{fast_model}=0/0"),
+        "governed": measure(f"{fast_model}={STUB_RPM}/{STUB_TPM}"),
+    }, indent=2))
+
+if __name__ == "__main__":
+    if os.getenv("BENCH_CHILD"):
+        run_burst()
+    else:
+        main()
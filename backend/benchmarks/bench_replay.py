@@ -0,0 +1,145 @@
+# Replays scripted consultations through /chat against recorded LLM responses, to measure the
+# server's own per-turn overhead without calling Groq.
+#
+# 1. Record once against the live provider (needs GROQ_API_KEY):
+#      python benchmarks/bench_replay.py --record
+# 2. Replay as often as needed, offline:
+#      BENCH_ITERATIONS=1000 python benchmarks/bench_replay.py
+#
+# Needs a MongoDB at MONGODB_URI; benchmark users are created directly and removed afterwards.
+# By default replay sleeps for none of the recorded latency, so the timings are server overhead
+# only; set LLM_CASSETTE_LATENCY_SCALE=1 to replay with the original provider latencies.
+#
+# The first turn of each accident script must not make any LLM call: the emergency card is
+# built without one. The run fails if any call site is invoked (or the cassette is consulted)
+# for that turn. A replay also fails if any call had no recording, since the fallback served
+# instead would make the timings meaningless.
+import os
+import sys
+import json
+import time
+import uuid
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+import httpx
+from jose import jwt
+from pymongo import MongoClient
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = int(os.getenv("BENCH_PORT", "8766"))
+ITERATIONS = int(os.getenv("BENCH_ITERATIONS", "20"))
+CASSETTE = os.getenv("LLM_CASSETTE_PATH", os.path.join(BACKEND_DIR, "benchmarks", "consultations.cassette.jsonl"))
+SCRIPTS = os.path.join(BACKEND_DIR, "benchmarks", "consultation_scripts.json")
+ACCIDENT_SCRIPTS = {"accident"}
+
+def make_token(email):
+    secret = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
+    return jwt.encode({"sub": email, "exp": datetime.utcnow() + timedelta(hours=1)}, secret, algorithm="HS256")
+
+def start_server(mode):
+    env = {
+        **os.environ,
+        "LLM_CASSETTE_MODE": mode,
+        "LLM_CASSETTE_PATH": CASSETTE,
+        "LLM_CASSETTE_LATENCY_SCALE": os.getenv("LLM_CASSETTE_LATENCY_SCALE", "0"),
+        # Keep background work from making different LLM calls between runs
+        "SPECULATIVE_DIAGNOSIS_ENABLED": "false",
+        "SESSION_SNAPSHOT_PATH": "",
+    }
+    if mode == "replay":
+        env.setdefault("GROQ_API_KEY", "replay")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL
+    )
+    for _ in range(600):
+        try:
+            if httpx.get(f"http://127.0.0.1:{PORT}/ready", timeout=1).status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server did not become ready")
+
+# LLM calls per call site plus cassette lookups, to tell whether a turn used the LLM
+def llm_usage(http):
+    calls = http.get("/debug/llm_routing").json()["calls"]
+    cassette = http.get("/debug/llm_cassette").json()
+    return {**calls, "cassette": cassette["recorded"] + cassette["replayed"] + cassette["misses"]}
+
+# Run every script once per iteration, each consultation as a fresh benchmark user
+def run_consultations(users, scripts, iterations):
+    turn_seconds = []
+    statuses = {}
+    accident_llm_calls = []
+    with httpx.Client(base_url=f"http://127.0.0.1:{PORT}", timeout=120) as http:
+        for iteration in range(iterations):
+            # Each iteration replays the recorded sequence from the start, in recording order
+            http.post("/debug/llm_cassette/rewind").raise_for_status()
+            for name, turns in scripts.items():
+                email = f"{name}-{iteration}-{uuid.uuid4().hex[:8]}@replay.bench"
+                user_id = f"user-{uuid.uuid4().hex[:8]}"
+                users.insert_one({"user_id": user_id, "email": email, "name": "Replay Benchmark", "chat_history": []})
+                headers = {"Authorization": f"Bearer {make_token(email)}"}
+                for turn, message in enumerate(turns):
+                    check_no_llm = name in ACCIDENT_SCRIPTS and turn == 0
+                    before = llm_usage(http) if check_no_llm else None
+                    started = time.perf_counter()
+                    response = http.post("/chat", json={"user_id": user_id, "response": message}, headers=headers)
+                    turn_seconds.append(time.perf_counter() - started)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                    if check_no_llm:
+                        after = llm_usage(http)
+                        used = {site: count - before.get(site, 0) for site, count in after.items() if count != before.get(site, 0)}
+                        if used:
+                            accident_llm_calls.append({"script": name, "iteration": iteration, "calls": used})
+        cassette = http.get("/debug/llm_cassette").json()
+    return turn_seconds, statuses, cassette, accident_llm_calls
+
+def main():
+    mode = "record" if "--record" in sys.argv else "replay"
+    iterations = 1 if mode == "record" else ITERATIONS
+    with open(SCRIPTS) as f:
+        scripts = json.load(f)
+    
+    client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    users = client.medbot_db.users
+    server = start_server(mode)
+    try:
+        started = time.perf_counter()
+        turn_seconds, statuses, cassette, accident_llm_calls = run_consultations(users, scripts, iterations)
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+        users.delete_many({"email": {"$regex": r"@replay\.bench$"}})
+    
+    turn_seconds.sort()
+    print(json.dumps({
+        "mode": mode,
+        "cassette": cassette,
+        "consultations": iterations * len(scripts),
+        "turns": len(turn_seconds),
+        "statuses": statuses,
+        "elapsed_seconds": round(elapsed, 2),
+        "turns_per_second": round(len(turn_seconds) / elapsed, 1),
+        "turn_p50_ms": round(statistics.median(turn_seconds) * 1000, 2),
+        "turn_p95_ms": round(turn_seconds[min(len(turn_seconds) - 1, int(len(turn_seconds) * 0.95))] * 1000, 2),
+        "turn_max_ms": round(turn_seconds[-1] * 1000, 2),
+        "accident_intake_llm_calls": accident_llm_calls,
+    }, indent=2))
+    failed = False
+    if mode == "replay" and cassette["misses"]:
+        print(f"FAIL: {cassette['misses']} LLM calls had no recording; re-record the cassette with --record")
+        failed = True
+    if accident_llm_calls:
+        print("FAIL: the accident intake made LLM calls; the emergency card must not wait on the LLM")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Microbenchmark: FastAPI's jsonable_encoder + json vs the orjson path used by FastJSONResponse.
+# Run from the backend directory: python benchmarks/bench_serialization.py
+import os
+import sys
+import json
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from fastapi.encoders import jsonable_encoder
+from main import UserData, dump_json
+
+# Build a session with a long history, similar to what update_user_data produces
+def make_session(turns):
+    user = UserData(user_id="user-bench")
+    for i in range(turns):
+        user.history.append({"symptoms": f"fever and cough for {i} days", "validation_details": {
+            "is_valid": True,
+            "reason": "Describes symptoms",
+            "extracted_symptoms": ["fever", "cough", "sore throat"]
+        }})
+        user.history.append({"current_question": "<div class=\"diagnosis-card\">" + "Likely condition. " * 40 + "</div>"})
+        user.history.append({"current_step": "dynamic_symptoms_continued"})
+    user.symptoms = ["fever", "cough"]
+    return user
+
+# Build a chat_history document as stored in MongoDB
+def make_chat_history(entries):
+    return {"chat_history": [{
+        "timestamp": datetime.utcnow(),
+        "user_message": "I have had a fever and a cough since Monday",
+        "bot_response": "<div class=\"diagnosis-card\">" + "Action step. " * 60 + "</div>"
+    } for _ in range(entries)]}
+
+def measure(label, func, content, repeat):
+    func(content)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(content)
+    elapsed = (time.perf_counter() - started) / repeat
+    
+    tracemalloc.start()
+    func(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    print(f"  {label:<22} {elapsed * 1000:8.2f} ms   peak alloc {peak / 1024:9.1f} KiB")
+    return elapsed
+
+def main():
+    cases = [
+        ("session, 200 turns", make_session(200)),
+        ("session, 1000 turns", make_session(1000)),
+        ("chat_history, 500", make_chat_history(500)),
+        ("chat_history, 5000", make_chat_history(5000)),
+    ]
+    for name, content in cases:
+        print(name)
+        baseline = measure("jsonable_encoder+json", lambda c: json.dumps(jsonable_encoder(c)).encode("utf-8"), content, 20)
+        fast = measure("orjson", dump_json, content, 20)
+        print(f"  speedup {baseline / fast:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Memory benchmark for session history: plain {key: value, "validation_details": {...}} dicts
+# (the previous representation) vs HistoryEntry records written through append_history.
+# Reports bytes per session at 10, 50 and 200 turns, measured with tracemalloc.
+# Run from the backend directory: python benchmarks/bench_session_memory.py
+import os
+import sys
+import json
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from main import UserData, append_history
+
+SESSIONS = int(os.getenv("BENCH_SESSIONS", "200"))
+QUESTIONS = [
+    "How long have you had these symptoms?",
+    "How severe is the pain on a scale of 1 to 10?",
+    "Have you eaten anything unusual or travelled recently?",
+]
+
+# The entries update_user_data records for one turn; bot output is rebuilt every turn,
+# as it is when the handlers format it
+def turn_entries(turn):
+    question = QUESTIONS[turn % len(QUESTIONS)]
+    yield "symptoms", f"fever and cough for {turn} days", {
+        "is_valid": True,
+        "reason": "Describes symptoms",
+        "extracted_symptoms": ["fever", "cough"]
+    }
+    yield "current_question", f"<div class=\"question-card\"><p>{question}</p><p>Please describe in as much detail as you can.</p></div>", None
+    yield "current_step", "".join(["dynamic_", "symptoms_", "continued"]), None
+
+def build_dicts(user_id, turns):
+    history = []
+    for turn in range(turns):
+        for key, value, details in turn_entries(turn):
+            entry = {key: value}
+            if details:
+                entry["validation_details"] = details
+            history.append(entry)
+    return UserData.model_construct(user_id=user_id, version=0, history=history, is_existing=False, symptoms=[],
+                                    previous_history="", medication_history="", additional_symptoms="", diagnosis="", critical=False)
+
+def build_compact(user_id, turns):
+    user = UserData(user_id=user_id)
+    for turn in range(turns):
+        for key, value, details in turn_entries(turn):
+            append_history(user, key, value, details)
+    return user
+
+def bytes_per_session(build, turns):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [build(f"user-{i:08d}", turns) for i in range(SESSIONS)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used // len(sessions), len(sessions[0].history)
+
+def main():
+    results = {}
+    for turns in [10, 50, 200]:
+        dict_bytes, dict_entries = bytes_per_session(build_dicts, turns)
+        compact_bytes, compact_entries = bytes_per_session(build_compact, turns)
+        results[f"{turns}_turns"] = {
+            "dicts": {"bytes_per_session": dict_bytes, "history_entries": dict_entries},
+            "compact": {"bytes_per_session": compact_bytes, "history_entries": compact_entries},
+            "reduction": round(1 - compact_bytes / dict_bytes, 3)
+        }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Snapshot/restore benchmark for the in-memory session store.
+# Builds BENCH_SESSIONS sessions (default 100k) of BENCH_TURNS turns each, then times
+# MemorySessionStore.snapshot() and restore() and reports the snapshot size.
+# Run from the backend directory: python benchmarks/bench_snapshot.py
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from main import MemorySessionStore, UserData
+
+SESSIONS = int(os.getenv("BENCH_SESSIONS", "100000"))
+TURNS = int(os.getenv("BENCH_TURNS", "5"))
+
+# A mid-consultation session shaped like what update_user_data produces
+def make_session(i):
+    user = UserData(user_id=f"user-{i:08d}", symptoms=["fever", "cough"])
+    for turn in range(TURNS):
+        user.history.append({"symptoms": f"fever and cough for {turn} days", "validation_details": {
+            "is_valid": True,
+            "reason": "Describes symptoms",
+            "extracted_symptoms": ["fever", "cough"]
+        }})
+        user.history.append({"current_question": "<div class=\"question-card\">How long have you had these symptoms?</div>"})
+        user.history.append({"current_step": "dynamic_symptoms_continued"})
+    return user
+
+def main():
+    store = MemorySessionStore()
+    for i in range(SESSIONS):
+        user = make_session(i)
+        store[user.user_id] = user
+    
+    path = os.path.join(tempfile.mkdtemp(), "sessions.msgpack.zst")
+    started = time.perf_counter()
+    size = store.snapshot(path)
+    snapshot_seconds = time.perf_counter() - started
+    
+    restored_store = MemorySessionStore()
+    started = time.perf_counter()
+    restored = restored_store.restore(path)
+    restore_seconds = time.perf_counter() - started
+    
+    sample = f"user-{SESSIONS // 2:08d}"
+    assert restored == SESSIONS
+    assert restored_store[sample].model_dump() == store[sample].model_dump()
+    os.remove(path)
+    
+    print(json.dumps({
+        "sessions": SESSIONS,
+        "turns_per_session": TURNS,
+        "snapshot_seconds": round(snapshot_seconds, 3),
+        "restore_seconds": round(restore_seconds, 3),
+        "snapshot_bytes": size,
+        "bytes_per_session": size // SESSIONS
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Startup benchmark: import time of main.py, time until /ready, and time to the first /chat reply.
+# Run from the backend directory with the usual .env (MongoDB, GROQ_API_KEY):
+#   BENCH_EMAIL=registered@example.com python benchmarks/bench_startup.py
+# Without BENCH_EMAIL the first /chat is sent for an unknown user and measures the
+# request path up to the 401 (auth + database lookup) rather than a full consultation turn.
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+import httpx
+from jose import jwt
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = int(os.getenv("BENCH_PORT", "8765"))
+
+def measure_import(repeat=5):
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, capture_output=True, text=True, check=True)
+        samples.append(float(output.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+def make_token(email):
+    secret = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
+    return jwt.encode({"sub": email, "exp": datetime.utcnow() + timedelta(minutes=5)}, secret, algorithm="HS256")
+
+def measure_server(timeout=120):
+    base_url = f"http://127.0.0.1:{PORT}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR
+    )
+    try:
+        ready_seconds = None
+        server_timings = {}
+        while time.perf_counter() - started < timeout:
+            try:
+                response = httpx.get(f"{base_url}/ready", timeout=1)
+                if response.status_code == 200:
+                    ready_seconds = time.perf_counter() - started
+                    server_timings = response.json().get("timings", {})
+                    break
+            except httpx.TransportError:
+                pass
+            time.sleep(0.05)
+        if ready_seconds is None:
+            raise RuntimeError("Server did not become ready")
+        
+        token = make_token(os.getenv("BENCH_EMAIL", "startup-benchmark@example.com"))
+        chat_started = time.perf_counter()
+        response = httpx.post(
+            f"{base_url}/chat",
+            json={"user_id": "benchmark", "response": "I have had a fever and a sore throat for two days"},
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=timeout
+        )
+        first_chat_seconds = time.perf_counter() - chat_started
+        return {
+            "ready_seconds": ready_seconds,
+            "server_timings": server_timings,
+            "first_chat_seconds": first_chat_seconds,
+            "first_chat_status": response.status_code,
+            "process_start_to_first_chat_seconds": time.perf_counter() - started
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    results = {"import_seconds": measure_import()}
+    results.update(measure_server())
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Throughput benchmark for POST /triage/batch against benchmarks/stub_groq.py.
+# Sends one batch of BENCH_ITEMS intake descriptions once per TRIAGE_BATCH_CONCURRENCY value in
+# BENCH_CONCURRENCY, with every stub completion taking STUB_LATENCY_SECONDS. It reports items per
+# second, time to the first streamed result and per-item latency for each run.
+# Run from the backend directory: python benchmarks/bench_triage_batch.py
+#
+# Needs a MongoDB at MONGODB_URI; the benchmark user is created directly and removed afterwards.
+import os
+import sys
+import json
+import time
+import uuid
+import statistics
+import subprocess
+from datetime import datetime, timedelta
+
+import httpx
+from jose import jwt
+from pymongo import MongoClient
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = int(os.getenv("BENCH_PORT", "8767"))
+STUB_PORT = int(os.getenv("BENCH_STUB_PORT", "8790"))
+ITEMS = int(os.getenv("BENCH_ITEMS", "200"))
+CONCURRENCY = [int(c) for c in os.getenv("BENCH_CONCURRENCY", "1,4,16,32").split(",")]
+STUB_LATENCY_SECONDS = os.getenv("STUB_LATENCY_SECONDS", "0.3")
+
+STUB_REPLY = json.dumps({
+    "urgency_level": "PROMPT",
+    "category": "respiratory",
+    "reasoning": "Benchmark reply",
+    "key_symptoms": ["cough", "fever"],
+    "recommended_questions": []
+})
+SYMPTOMS = ["cough", "fever", "headache", "sore throat", "back pain", "rash", "nausea", "dizziness", "earache", "fatigue"]
+
+# Mostly distinct descriptions so each goes to the LLM, with some that the keyword triage answers
+def make_descriptions(count):
+    descriptions = []
+    for i in range(count):
+        if i % 10 == 0:
+            descriptions.append(f"I fell down the stairs this morning, patient {i}")
+        elif i % 10 == 5:
+            descriptions.append(f"My asthma has been worse for {i % 7 + 1} days, patient {i}")
+        else:
+            first, second = SYMPTOMS[i % len(SYMPTOMS)], SYMPTOMS[(i // len(SYMPTOMS)) % len(SYMPTOMS)]
+            descriptions.append(f"{first} and {second} for {i % 9 + 1} days, patient {i}")
+    return descriptions
+
+def make_token(email):
+    secret = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
+    return jwt.encode({"sub": email, "exp": datetime.utcnow() + timedelta(hours=1)}, secret, algorithm="HS256")
+
+def wait_until_up(url, process):
+    for _ in range(600):
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{url} did not come up")
+
+def start_server(concurrency):
+    fast_model = os.getenv("LLM_FAST_MODEL", "llama-3.1-8b-instant")
+    large_model = os.getenv("LLM_LARGE_MODEL", "llama-3.3-70b-versatile")
+    env = {
+        **os.environ,
+        "GROQ_API_KEY": "benchmark",
+        "GROQ_API_BASE": f"http://127.0.0.1:{STUB_PORT}",
+        # Measure the endpoint's parallelism, not local pacing
+        "LLM_RATE_LIMITS": f"{fast_model}=0/0,{large_model}=0/0",
+        "TRIAGE_BATCH_CONCURRENCY": str(concurrency),
+        "TRIAGE_BATCH_MAX_ITEMS": str(max(ITEMS, 500)),
+        "SESSION_SNAPSHOT_PATH": "",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL
+    )
+    wait_until_up(f"http://127.0.0.1:{PORT}/ready", server)
+    return server
+
+def run_batch(headers, descriptions):
+    started = time.perf_counter()
+    first_result = None
+    results = []
+    summary = None
+    with httpx.Client(base_url=f"http://127.0.0.1:{PORT}", timeout=600) as http:
+        with http.stream("POST", "/triage/batch", json={"descriptions": descriptions}, headers=headers) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                item = json.loads(line)
+                if item.get("done"):
+                    summary = item
+                    continue
+                if first_result is None:
+                    first_result = time.perf_counter() - started
+                results.append(item)
+    elapsed = time.perf_counter() - started
+    item_ms = sorted(item["elapsed_ms"] for item in results if "elapsed_ms" in item)
+    return {
+        "items": len(results),
+        "errors": summary["errors"] if summary else None,
+        "elapsed_seconds": round(elapsed, 2),
+        "items_per_second": round(len(results) / elapsed, 1),
+        "first_result_ms": round(first_result * 1000, 1) if first_result is not None else None,
+        "item_p50_ms": round(statistics.median(item_ms), 1) if item_ms else None,
+        "item_max_ms": item_ms[-1] if item_ms else None,
+        "sources": {source: sum(1 for item in results if item.get("source") == source) for source in ("keywords", "llm")},
+    }
+
+def main():
+    descriptions = make_descriptions(ITEMS)
+    client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    users = client.medbot_db.users
+    email = f"clinic-{uuid.uuid4().hex[:8]}@triage.bench"
+    users.insert_one({"user_id": f"user-{uuid.uuid4().hex[:8]}", "email": email, "name": "Triage Benchmark", "chat_history": []})
+    headers = {"Authorization": f"Bearer {make_token(email)}"}
+
+    stub = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", "benchmarks", "stub_groq:app", "--port", str(STUB_PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "STUB_RPM": "1000000", "STUB_TPM": "1000000000", "STUB_LATENCY_SECONDS": STUB_LATENCY_SECONDS, "STUB_REPLY": STUB_REPLY}
+    )
+    report = {"items": ITEMS, "stub_latency_seconds": float(STUB_LATENCY_SECONDS), "runs": {}}
+    try:
+        wait_until_up(f"http://127.0.0.1:{STUB_PORT}/stats", stub)
+        for concurrency in CONCURRENCY:
+            server = start_server(concurrency)
+            try:
+                report["runs"][concurrency] = run_batch(headers, descriptions)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        stub.terminate()
+        stub.wait()
+        users.delete_many({"email": {"$regex": r"@triage\.bench$"}})
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
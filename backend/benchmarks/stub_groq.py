@@ -0,0 +1,69 @@
+# Minimal stand-in for the Groq chat completions API that enforces requests/tokens per
+# minute per model and answers 429 with a retry-after header once a limit is exceeded.
+# Every completion answers STUB_REPLY.
+#   STUB_RPM=30 STUB_TPM=6000 STUB_LATENCY_SECONDS=0.2 uvicorn --app-dir benchmarks stub_groq:app --port 8790
+# Point the backend at it with GROQ_API_BASE=http://127.0.0.1:8790
+import os
+import time
+import uuid
+import asyncio
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+STUB_RPM = int(os.getenv("STUB_RPM", "30"))
+STUB_TPM = int(os.getenv("STUB_TPM", "6000"))
+STUB_LATENCY_SECONDS = float(os.getenv("STUB_LATENCY_SECONDS", "0.2"))
+STUB_COMPLETION_TOKENS = int(os.getenv("STUB_COMPLETION_TOKENS", "150"))
+STUB_REPLY = os.getenv("STUB_REPLY", "NO")
+
+app = FastAPI()
+windows = {}
+stats = {"completions": 0, "rate_limited": 0}
+
+@app.get("/openai/v1/models")
+def models():
+    return {"object": "list", "data": []}
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "unknown")
+    prompt_tokens = sum(len(str(message.get("content", ""))) for message in body.get("messages", [])) // 4 + 1
+    total_tokens = prompt_tokens + STUB_COMPLETION_TOKENS
+    
+    # Sliding one-minute window of (timestamp, tokens) per model
+    now = time.monotonic()
+    window = windows.setdefault(model, deque())
+    while window and now - window[0][0] >= 60:
+        window.popleft()
+    used_tokens = sum(tokens for _, tokens in window)
+    if len(window) >= STUB_RPM or used_tokens + total_tokens > STUB_TPM:
+        stats["rate_limited"] += 1
+        retry_after = max(1, int(60 - (now - window[0][0])) + 1) if window else 1
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": str(retry_after)},
+            content={"error": {"message": f"Rate limit reached for model {model}", "type": "tokens", "code": "rate_limit_exceeded"}}
+        )
+    window.append((now, total_tokens))
+    
+    await asyncio.sleep(STUB_LATENCY_SECONDS)
+    stats["completions"] += 1
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": STUB_REPLY},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": STUB_COMPLETION_TOKENS, "total_tokens": total_tokens}
+    }
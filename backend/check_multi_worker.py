@@ -0,0 +1,165 @@
+# Runs scripted consultations against two workers sharing the MongoDB session store, with
+# benchmarks/stub_groq.py standing in for Groq, and checks that:
+#   - a conversation continues across workers, every request on a new connection, and any
+#     worker serves the latest session version right after a turn
+#   - each turn is applied as at most one session write (version moves by one per turn)
+#   - concurrent turns for the same user either succeed or get 409, and the session is still
+#     consistent and usable afterwards
+# The repo has no automated test suite, so this script stands in for a multi-worker test.
+# Run against a local mongod: MONGODB_URI=mongodb://localhost:27017 python check_multi_worker.py
+# Exits non-zero if any check fails.
+import os
+import sys
+import json
+import time
+import uuid
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+from jose import jwt
+from pymongo import MongoClient
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PORT = int(os.getenv("CHECK_PORT", "8768"))
+STUB_PORT = int(os.getenv("CHECK_STUB_PORT", "8791"))
+SCRIPTS = os.path.join(BACKEND_DIR, "benchmarks", "consultation_scripts.json")
+BASE_URL = f"http://127.0.0.1:{PORT}"
+
+# One reply every call site can use: valid for validation, routine for urgency
+STUB_REPLY = json.dumps({
+    "is_valid": True,
+    "reason": "Stub reply",
+    "urgency_level": "ROUTINE",
+    "category": "general",
+    "reasoning": "Stub reply",
+    "key_symptoms": [],
+    "recommended_questions": []
+})
+
+failures = []
+created_user_ids = []
+
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAIL: {message}")
+
+def make_token(email):
+    secret = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
+    return jwt.encode({"sub": email, "exp": datetime.utcnow() + timedelta(hours=1)}, secret, algorithm="HS256")
+
+def wait_until_up(url, process):
+    for _ in range(600):
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{url} did not come up")
+
+# A new connection per request, so the kernel spreads them over the workers
+def post_turn(user_id, headers, message):
+    response = httpx.post(f"{BASE_URL}/chat", json={"user_id": user_id, "response": message}, headers=headers, timeout=120)
+    return response.status_code, response.json()
+
+def stored_version(user_id):
+    return httpx.get(f"{BASE_URL}/user/{user_id}", params={"fields": "version"}, timeout=30).json()["version"]
+
+def new_user(users, name):
+    email = f"{name}-{uuid.uuid4().hex[:8]}@workers.check"
+    user_id = f"user-{uuid.uuid4().hex[:8]}"
+    users.insert_one({"user_id": user_id, "email": email, "name": "Multi-worker Check", "chat_history": []})
+    created_user_ids.append(user_id)
+    return user_id, {"Authorization": f"Bearer {make_token(email)}"}
+
+def check_sequential(users, scripts):
+    for name, turns in scripts.items():
+        user_id, headers = new_user(users, name)
+        version = 0
+        for message in turns:
+            status, body = post_turn(user_id, headers, message)
+            check(status == 200, f"{name}: turn {message!r} returned {status}")
+            if status != 200:
+                break
+            new_version = body["state"]["version"]
+            check(version <= new_version <= version + 1, f"{name}: version went from {version} to {new_version} in one turn")
+            version = new_version
+            for _ in range(4):
+                check(stored_version(user_id) == version, f"{name}: a worker served a stale session after {message!r}")
+
+def check_concurrent(users, scripts):
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for name, turns in scripts.items():
+            if len(turns) < 4:
+                continue
+            user_id, headers = new_user(users, f"{name}-concurrent")
+            status, _ = post_turn(user_id, headers, turns[0])
+            check(status == 200, f"{name}: first turn returned {status}")
+            before = stored_version(user_id)
+            results = list(pool.map(lambda message: post_turn(user_id, headers, message), [turns[1], turns[2]]))
+            versions = []
+            for status, body in results:
+                statuses[status] = statuses.get(status, 0) + 1
+                check(status in (200, 409), f"{name}: concurrent turn returned {status}")
+                if status == 200:
+                    versions.append(body["state"]["version"])
+            after = stored_version(user_id)
+            check(after <= before + sum(1 for status, _ in results if status == 200),
+                  f"{name}: {after - before} session writes for {len(versions)} successful turns")
+            check(not versions or after == max(versions), f"{name}: stored version {after} is not the latest reply's {max(versions) if versions else None}")
+            status, _ = post_turn(user_id, headers, turns[3])
+            check(status == 200, f"{name}: turn after the concurrent ones returned {status}")
+    return statuses
+
+def main():
+    with open(SCRIPTS) as f:
+        scripts = json.load(f)
+    client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    users = client.medbot_db.users
+
+    stub = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", "benchmarks", "stub_groq:app", "--port", str(STUB_PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "STUB_RPM": "1000000", "STUB_TPM": "1000000000", "STUB_LATENCY_SECONDS": "0.05", "STUB_REPLY": STUB_REPLY}
+    )
+    server = None
+    try:
+        wait_until_up(f"http://127.0.0.1:{STUB_PORT}/stats", stub)
+        server = subprocess.Popen(
+            [sys.executable, "main.py"],
+            cwd=BACKEND_DIR,
+            env={
+                **os.environ,
+                "SESSION_STORE": "mongo",
+                "WORKERS": "2",
+                "PORT": str(PORT),
+                "GROQ_API_KEY": "check",
+                "GROQ_API_BASE": f"http://127.0.0.1:{STUB_PORT}",
+                "SPECULATIVE_DIAGNOSIS_ENABLED": "false",
+            },
+            stdout=subprocess.DEVNULL
+        )
+        wait_until_up(f"{BASE_URL}/ready", server)
+        check_sequential(users, scripts)
+        statuses = check_concurrent(users, scripts)
+        print(json.dumps({"concurrent_turn_statuses": statuses, "failures": len(failures)}))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        stub.terminate()
+        stub.wait()
+        users.delete_many({"email": {"$regex": r"@workers\.check$"}})
+        client.medbot_db.sessions.delete_many({"user_id": {"$in": created_user_ids}})
+
+    if failures:
+        sys.exit(1)
+    print("OK: sessions stay consistent across workers")
+
+if __name__ == "__main__":
+    main()
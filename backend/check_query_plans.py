@@ -0,0 +1,48 @@
+# Verifies that every hot MongoDB query is served by an index.
+# Run against a local mongod: MONGODB_URI=mongodb://localhost:27017 python check_query_plans.py
+# Exits non-zero if any query in HOT_QUERIES falls back to a collection scan.
+import os
+import sys
+
+os.environ.setdefault("GROQ_API_KEY", "query-plan-check")
+
+from pymongo import MongoClient
+from main import HOT_QUERIES, ensure_indexes
+
+# Collect the stage names of a query plan tree
+def plan_stages(plan):
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    if "queryPlan" in plan:
+        stages += plan_stages(plan["queryPlan"])
+    return [stage for stage in stages if stage]
+
+def main():
+    client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    database = client[os.getenv("QUERY_PLAN_DB", "medbot_query_plan_check")]
+    missing = ensure_indexes(database)
+    if missing:
+        print(f"Could not create indexes: {', '.join(missing)}")
+        sys.exit(1)
+    
+    failures = []
+    for name, (collection_name, query) in HOT_QUERIES.items():
+        explain = database[collection_name].find(query).explain()
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+        status = "COLLSCAN" if "COLLSCAN" in stages else "ok"
+        print(f"{name:<28} {collection_name:<10} {' <- '.join(stages):<40} {status}")
+        if "COLLSCAN" in stages:
+            failures.append(name)
+    
+    if os.getenv("QUERY_PLAN_DB") is None:
+        client.drop_database(database.name)
+    
+    if failures:
+        print(f"Collection scans in: {', '.join(failures)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# Checks that a WebSocket chat turn runs once even when the connection drops mid-turn, with
+# benchmarks/stub_groq.py standing in for Groq (every completion takes STUB_LATENCY_SECONDS):
+#   - a turn whose connection closes right after the ack still completes, and resending its id
+#     on a new connection returns the stored reply without running the turn again
+#   - a turn resent on a new connection while it is still running is coalesced with the first run
+# "Ran once" means the session version moved by one, the stub saw no further completions and the
+# user's chat history holds the message once.
+# The repo has no automated test suite, so this script stands in for a WebSocket resend test.
+# Run against a local mongod: MONGODB_URI=mongodb://localhost:27017 python check_ws_resend.py
+# Exits non-zero if any check fails.
+import os
+import sys
+import json
+import time
+import uuid
+import subprocess
+from datetime import datetime, timedelta
+
+import httpx
+from jose import jwt
+from pymongo import MongoClient
+from websockets.sync.client import connect
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PORT = int(os.getenv("CHECK_PORT", "8769"))
+STUB_PORT = int(os.getenv("CHECK_STUB_PORT", "8792"))
+STUB_LATENCY_SECONDS = os.getenv("STUB_LATENCY_SECONDS", "1.0")
+BASE_URL = f"http://127.0.0.1:{PORT}"
+SOCKET_URL = f"ws://127.0.0.1:{PORT}/ws/chat"
+
+# One reply every call site can use: valid for validation, routine for urgency
+STUB_REPLY = json.dumps({
+    "is_valid": True,
+    "reason": "Stub reply",
+    "urgency_level": "ROUTINE",
+    "category": "general",
+    "reasoning": "Stub reply",
+    "key_symptoms": [],
+    "recommended_questions": []
+})
+
+failures = []
+
+def check(condition, message):
+    if not condition:
+        failures.append(message)
+        print(f"FAIL: {message}")
+
+def make_token(email):
+    secret = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
+    return jwt.encode({"sub": email, "exp": datetime.utcnow() + timedelta(hours=1)}, secret, algorithm="HS256")
+
+def wait_until_up(url, process):
+    for _ in range(600):
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{url} did not come up")
+
+def completions():
+    return httpx.get(f"http://127.0.0.1:{STUB_PORT}/stats", timeout=10).json()["completions"]
+
+def stored_version(user_id):
+    return httpx.get(f"{BASE_URL}/user/{user_id}", params={"fields": "version"}, timeout=30).json()["version"]
+
+def history_count(users, user_id, message):
+    doc = users.find_one({"user_id": user_id}, {"chat_history": 1})
+    return sum(1 for item in doc.get("chat_history", []) if item.get("user_message") == message)
+
+# Open an authenticated socket and wait for the ready frame
+def open_socket(token):
+    socket = connect(SOCKET_URL)
+    socket.send(json.dumps({"type": "auth", "token": token}))
+    while True:
+        frame = json.loads(socket.recv(timeout=30))
+        if frame["type"] == "ready":
+            return socket
+
+def send_turn(socket, turn_id, message):
+    socket.send(json.dumps({"type": "turn", "id": turn_id, "response": message}))
+
+# Frames until the reply (or error) for this turn, skipping acks and pings
+def wait_reply(socket, turn_id, timeout=120):
+    deadline = time.monotonic() + timeout
+    while True:
+        frame = json.loads(socket.recv(timeout=max(0.1, deadline - time.monotonic())))
+        if frame["type"] == "ping":
+            socket.send(json.dumps({"type": "pong"}))
+        elif frame["type"] in ("reply", "error") and frame.get("id") == turn_id:
+            return frame
+
+def wait_ack(socket, turn_id):
+    while True:
+        frame = json.loads(socket.recv(timeout=30))
+        if frame["type"] == "ack" and frame.get("id") == turn_id:
+            return
+
+# The turn has finished once the session version and the stub's completion count stop moving
+def wait_settled(user_id, version_before, timeout=120):
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        current = (stored_version(user_id), completions())
+        if current[0] > version_before and current == last:
+            return current
+        last = current
+        time.sleep(float(STUB_LATENCY_SECONDS) + 0.5)
+    raise RuntimeError(f"Turn for {user_id} did not finish")
+
+# Disconnect right after the ack, let the turn finish, then resend it
+def check_resend_after_completion(users, user_id, token):
+    message = "I have had a headache and a mild fever for two days"
+    version_before = stored_version(user_id)
+    socket = open_socket(token)
+    send_turn(socket, "turn-1", message)
+    wait_ack(socket, "turn-1")
+    socket.close()
+    version, calls = wait_settled(user_id, version_before)
+    check(version == version_before + 1, f"turn-1: version went from {version_before} to {version}")
+
+    socket = open_socket(token)
+    send_turn(socket, "turn-1", message)
+    reply = wait_reply(socket, "turn-1")
+    socket.close()
+    check(reply["type"] == "reply", f"turn-1: resend got {reply}")
+    check(completions() == calls, f"turn-1: resend made {completions() - calls} more LLM calls")
+    check(stored_version(user_id) == version, "turn-1: resend wrote the session again")
+    check(history_count(users, user_id, message) == 1, "turn-1: message saved to chat history more than once")
+
+# Disconnect right after the ack and resend on a new connection while the turn is still running
+def check_resend_while_running(users, user_id, token):
+    message = "The headache is worse in the mornings"
+    version_before = stored_version(user_id)
+    socket = open_socket(token)
+    send_turn(socket, "turn-2", message)
+    wait_ack(socket, "turn-2")
+    socket.close()
+
+    socket = open_socket(token)
+    send_turn(socket, "turn-2", message)
+    reply = wait_reply(socket, "turn-2")
+    socket.close()
+    check(reply["type"] == "reply", f"turn-2: resend got {reply}")
+    version, _ = wait_settled(user_id, version_before)
+    check(version == version_before + 1, f"turn-2: version went from {version_before} to {version}")
+    check(history_count(users, user_id, message) == 1, "turn-2: message saved to chat history more than once")
+
+def main():
+    client = MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    users = client.medbot_db.users
+    email = f"resend-{uuid.uuid4().hex[:8]}@ws.check"
+    user_id = f"user-{uuid.uuid4().hex[:8]}"
+    users.insert_one({"user_id": user_id, "email": email, "name": "WebSocket Check", "chat_history": []})
+    token = make_token(email)
+
+    stub = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "--app-dir", "benchmarks", "stub_groq:app", "--port", str(STUB_PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "STUB_RPM": "1000000", "STUB_TPM": "1000000000", "STUB_LATENCY_SECONDS": STUB_LATENCY_SECONDS, "STUB_REPLY": STUB_REPLY}
+    )
+    server = None
+    try:
+        wait_until_up(f"http://127.0.0.1:{STUB_PORT}/stats", stub)
+        server = subprocess.Popen(
+            [sys.executable, "main.py"],
+            cwd=BACKEND_DIR,
+            env={
+                **os.environ,
+                "WORKERS": "1",
+                "PORT": str(PORT),
+                "GROQ_API_KEY": "check",
+                "GROQ_API_BASE": f"http://127.0.0.1:{STUB_PORT}",
+                "SPECULATIVE_DIAGNOSIS_ENABLED": "false",
+                "SESSION_SNAPSHOT_PATH": "",
+            },
+            stdout=subprocess.DEVNULL
+        )
+        wait_until_up(f"{BASE_URL}/ready", server)
+        check_resend_after_completion(users, user_id, token)
+        check_resend_while_running(users, user_id, token)
+        print(json.dumps({"failures": len(failures)}))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        stub.terminate()
+        stub.wait()
+        users.delete_many({"email": {"$regex": r"@ws\.check$"}})
+        client.medbot_db.sessions.delete_many({"user_id": user_id})
+        client.medbot_db.archived_sessions.delete_many({"user_id": user_id})
+
+    if failures:
+        sys.exit(1)
+    print("OK: WebSocket turns run once across disconnects and resends")
+
+if __name__ == "__main__":
+    main()
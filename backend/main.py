@@ -1,16 +1,40 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import langgraph
-from langgraph.graph import StateGraph, START
+from pydantic_core import core_schema
 from typing import Dict, List, Optional
 from fastapi.middleware.cors import CORSMiddleware
-from langchain_groq import ChatGroq
+from starlette.datastructures import MutableHeaders
+import zstandard
+import httpx
+import orjson
+import ormsgpack
+from bson import ObjectId
+from tenacity import Retrying, retry_if_not_exception_type, stop_after_attempt, wait_random_exponential
 import os
+import sys
 from dotenv import load_dotenv
 from pymongo import MongoClient
-from pymongo.errors import PyMongoError
+from pymongo.errors import PyMongoError, DuplicateKeyError, ConnectionFailure
 from datetime import datetime, timedelta
 import uuid
+import asyncio
+import re
+import json
+import time
+import hashlib
+import random
+import bisect
+import zlib
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, TimeoutError as FutureTimeoutError
+import itertools
+import heapq
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -21,10 +45,45 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
 # MongoDB Connection
 MONGODB_URI = os.getenv("MONGODB_URI")
-client = MongoClient(MONGODB_URI)
+client = MongoClient(MONGODB_URI, connect=False)  # connects on first operation
 db = client.medbot_db
 users_collection = db.users
 
+# Indexes backing the hot queries: (collection, key, options)
+MONGO_INDEXES = [
+    ("users", "email", {"unique": True}),
+    ("users", "user_id", {"unique": True}),
+    ("sessions", "user_id", {"unique": True}),
+    ("summaries", "user_id", {"unique": True}),
+    ("sessions", "updated_at", {}),
+    ("archived_sessions", "user_id", {"unique": True}),
+]
+
+# Hot queries by call site, checked against their query plans by check_query_plans.py
+HOT_QUERIES = {
+    "get_user_by_email": ("users", {"email": "patient@example.com"}),
+    "user_document_by_user_id": ("users", {"user_id": "user-00000000"}),
+    "session_by_user_id": ("sessions", {"user_id": "user-00000000"}),
+    "summary_by_user_id": ("summaries", {"user_id": "user-00000000"}),
+    "idle_sessions": ("sessions", {"updated_at": {"$lt": datetime(2000, 1, 1)}}),
+    "archived_session_by_user_id": ("archived_sessions", {"user_id": "user-00000000"}),
+}
+
+# Create the indexes above; safe to run on every startup. Returns the indexes that could not
+# be created, all of them if MongoDB can't be reached (without waiting out a timeout for each).
+def ensure_indexes(database):
+    failed = []
+    for position, (collection_name, key, options) in enumerate(MONGO_INDEXES):
+        try:
+            database[collection_name].create_index(key, **options)
+        except ConnectionFailure as e:
+            print(f"Could not reach MongoDB to create indexes: {str(e)}")
+            return failed + [f"{name}.{field}" for name, field, _ in MONGO_INDEXES[position:]]
+        except PyMongoError as e:
+            print(f"Could not create index {collection_name}.{key}: {str(e)}")
+            failed.append(f"{collection_name}.{key}")
+    return failed
+
 # Password and JWT Security
 SECRET_KEY = os.getenv("SECRET_KEY", "a_default_secret_key_for_development_only")
 ALGORITHM = "HS256"
@@ -33,12 +92,359 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# Initialize LLM
-llm = ChatGroq(model="llama-3.3-70b-versatile", groq_api_key=GROQ_API_KEY)
+# Initialize LLMs: a fast tier for classification/validation and a large tier for diagnosis
+LLM_MODELS = {
+    "fast": os.getenv("LLM_FAST_MODEL", "llama-3.1-8b-instant"),
+    "large": os.getenv("LLM_LARGE_MODEL", "llama-3.3-70b-versatile"),
+}
+
+# LLM resilience: jittered retries, hedged requests and a circuit breaker per model tier
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_MAX_WAIT_SECONDS = float(os.getenv("LLM_RETRY_MAX_WAIT_SECONDS", "4"))
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_PRIORITY_AGING_SECONDS = float(os.getenv("LLM_PRIORITY_AGING_SECONDS", "5"))
+
+# Provider rate limits as requests/tokens per minute for each model. Off unless set, e.g. for
+# Groq's free tier LLM_RATE_LIMITS="llama-3.1-8b-instant=30/6000,llama-3.3-70b-versatile=30/12000"
+# (0 disables a limit)
+LLM_RATE_LIMITS = {}
+for model_limits in os.getenv("LLM_RATE_LIMITS", "").split(","):
+    if "=" in model_limits and "/" in model_limits:
+        model_name, limits = [part.strip() for part in model_limits.split("=", 1)]
+        rpm, tpm = limits.split("/", 1)
+        LLM_RATE_LIMITS[model_name] = (int(rpm), int(tpm))
+LLM_COMPLETION_TOKEN_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKEN_ESTIMATE", "400"))
+LLM_RATE_MAX_WAIT_SECONDS = float(os.getenv("LLM_RATE_MAX_WAIT_SECONDS", "10"))
+
+# Shared HTTP connection pool to the LLM provider
+GROQ_API_BASE = os.getenv("GROQ_API_BASE", "https://api.groq.com")
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "64"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "32"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "120"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() == "true"  # needs the h2 package
+LLM_HTTP_WARM_CONNECTIONS = int(os.getenv("LLM_HTTP_WARM_CONNECTIONS", "2"))
+
+# Record/replay of LLM responses: "record" appends live responses to the cassette file,
+# "replay" answers from it without calling the provider (latencies scaled by LLM_CASSETTE_LATENCY_SCALE)
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off").lower()
+LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "llm_cassette.jsonl")
+LLM_CASSETTE_LATENCY_SCALE = float(os.getenv("LLM_CASSETTE_LATENCY_SCALE", "1.0"))
+
+# HTTP transport that counts requests against newly opened connections and TLS handshakes
+class CountingTransport(httpx.HTTPTransport):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = {"requests": 0, "connections_opened": 0, "tls_handshakes": 0}
+        self.lock = threading.Lock()
+
+    def handle_request(self, request):
+        upstream_trace = request.extensions.get("trace")
+        
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                with self.lock:
+                    self.stats["connections_opened"] += 1
+            elif event_name == "connection.start_tls.complete":
+                with self.lock:
+                    self.stats["tls_handshakes"] += 1
+            if upstream_trace is not None:
+                upstream_trace(event_name, info)
+        
+        request.extensions["trace"] = trace
+        with self.lock:
+            self.stats["requests"] += 1
+        return super().handle_request(request)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["reused_connections"] = max(0, stats["requests"] - stats["connections_opened"])
+        stats["reuse_ratio"] = round(stats["reused_connections"] / stats["requests"], 3) if stats["requests"] else None
+        return stats
+
+llm_transport = CountingTransport(
+    http2=LLM_HTTP2,
+    limits=httpx.Limits(
+        max_connections=LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY
+    )
+)
+llm_http_client = httpx.Client(transport=llm_transport, timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=5.0))
+
+# Open LLM_HTTP_WARM_CONNECTIONS connections ahead of the first consultation
+def warm_llm_connections():
+    def warm_one(_):
+        try:
+            llm_http_client.get(f"{GROQ_API_BASE}/openai/v1/models", headers={"Authorization": f"Bearer {GROQ_API_KEY}"})
+        except httpx.HTTPError as e:
+            print(f"LLM connection warm-up failed: {str(e)}")
+    with ThreadPoolExecutor(max_workers=max(1, LLM_HTTP_WARM_CONNECTIONS)) as warmers:
+        list(warmers.map(warm_one, range(LLM_HTTP_WARM_CONNECTIONS)))
+
+# Chat models are created on first use (langchain_groq is slow to import) and share the pool
+def create_chat_model(model_name):
+    from langchain_groq import ChatGroq
+    return ChatGroq(model=model_name, groq_api_key=GROQ_API_KEY, base_url=GROQ_API_BASE, http_client=llm_http_client)
+
+# Which tier each LLM call site uses; override with e.g. LLM_SITE_TIERS="validation=large,summary=fast"
+LLM_SITE_TIERS = {
+    "validation": "fast",
+    "initial_urgency": "fast",
+    "triage_batch": "fast",
+    "urgency_check": "fast",
+    "follow_up_question": "fast",
+    "similar_diagnosis": "large",
+    "urgent_advice": "large",
+    "diagnosis": "large",
+    "criticality": "large",
+    "summary": "large",
+}
+for site_tier in os.getenv("LLM_SITE_TIERS", "").split(","):
+    if "=" in site_tier:
+        site, tier = [part.strip() for part in site_tier.split("=", 1)]
+        LLM_SITE_TIERS[site] = tier
+
+# Speculative diagnosis: start the diagnosis in the background once a follow-up path has
+# collected this many answers, or as soon as the conversation is headed to diagnosis_prep
+SPECULATIVE_DIAGNOSIS_ENABLED = os.getenv("SPECULATIVE_DIAGNOSIS_ENABLED", "true").lower() == "true"
+SPECULATIVE_DIAGNOSIS_MIN_ANSWERS = int(os.getenv("SPECULATIVE_DIAGNOSIS_MIN_ANSWERS", "3"))
+# Longest a diagnosis turn waits for a speculative diagnosis that is already running before
+# making its own call
+SPECULATIVE_DIAGNOSIS_MAX_WAIT_SECONDS = float(os.getenv("SPECULATIVE_DIAGNOSIS_MAX_WAIT_SECONDS", "5"))
+
+# Diagnosis cache settings (opt-in)
+DIAGNOSIS_CACHE_ENABLED = os.getenv("DIAGNOSIS_CACHE_ENABLED", "false").lower() == "true"
+DIAGNOSIS_CACHE_MAX_ENTRIES = int(os.getenv("DIAGNOSIS_CACHE_MAX_ENTRIES", "1000"))
+DIAGNOSIS_CACHE_TTL_SECONDS = int(os.getenv("DIAGNOSIS_CACHE_TTL_SECONDS", "3600"))
 
+# Session state backend: "memory" (single worker) or "mongo" (shared across workers)
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").lower()
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+# Session expiry: finished consultations and idle sessions are archived to MongoDB and evicted
+SESSION_IDLE_TTL_SECONDS = int(os.getenv("SESSION_IDLE_TTL_SECONDS", "3600"))
+SESSION_FINISHED_TTL_SECONDS = int(os.getenv("SESSION_FINISHED_TTL_SECONDS", "600"))
+SESSION_SWEEP_INTERVAL_SECONDS = int(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", "60"))  # 0 disables the sweeper
+
+# In-memory sessions can be snapshotted to disk periodically and on shutdown, and restored on
+# startup. Off unless a path is set: the file holds every patient's session data, unencrypted.
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", "")
+SESSION_SNAPSHOT_INTERVAL_SECONDS = int(os.getenv("SESSION_SNAPSHOT_INTERVAL_SECONDS", "30"))
+
+# How long to wait before retrying index creation when MongoDB was unavailable at startup
+INDEX_RETRY_SECONDS = float(os.getenv("INDEX_RETRY_SECONDS", "30"))
+
+# How long a completed save is remembered for idempotent retries
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+
+# WebSocket chat: server heartbeat interval; a connection silent for 3 intervals is closed
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+
+# Bulk intake triage: descriptions per request and how many are classified at once
+TRIAGE_BATCH_MAX_ITEMS = int(os.getenv("TRIAGE_BATCH_MAX_ITEMS", "500"))
+TRIAGE_BATCH_CONCURRENCY = int(os.getenv("TRIAGE_BATCH_CONCURRENCY", "8"))
+
+# Response compression: bodies smaller than this are sent as-is
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "500"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+
+# Pick the best supported encoding from an Accept-Encoding header, preferring zstd on ties
+def negotiate_encoding(accept_encoding):
+    qualities = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip()] = quality
+    candidates = [(qualities[name], name == "zstd", name) for name in ["zstd", "gzip"] if qualities.get(name, 0) > 0]
+    return max(candidates)[2] if candidates else None
+
+# Incremental zstd/gzip compressor; non-final chunks are flushed so streamed responses keep flowing
+class StreamCompressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+        else:
+            self.compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data, final):
+        out = self.compressor.compress(data)
+        if final:
+            return out + self.compressor.flush()
+        if self.encoding == "zstd":
+            return out + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return out + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+COMPRESSIBLE_TYPES = ["application/json", "application/x-ndjson", "text/"]
+
+# ASGI middleware negotiating zstd or gzip, with per-endpoint byte counters
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=500, stats=None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.stats = stats if stats is not None else {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        accept_encoding = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        
+        endpoint = "/" + scope["path"].strip("/").split("/")[0]
+        state = {"start": None, "compressor": None, "passthrough": False}
+        
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body" or state["passthrough"]:
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            
+            # Decide on the first body chunk, once we know whether the response is small
+            if state["start"] is not None:
+                start = state["start"]
+                state["start"] = None
+                headers = MutableHeaders(raw=start["headers"])
+                content_type = headers.get("content-type", "")
+                if (
+                    "content-encoding" in headers
+                    or not any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(message)
+                    return
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if "content-length" in headers:
+                    del headers["content-length"]
+                state["compressor"] = StreamCompressor(encoding)
+                await send(start)
+            
+            compressed = state["compressor"].compress(body, final=not more_body)
+            self.record(endpoint, encoding, len(body), len(compressed))
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        
+        await self.app(scope, receive, send_compressed)
 
-# Initialize FastAPI
-app = FastAPI()
+    def record(self, endpoint, encoding, bytes_in, bytes_out):
+        entry = self.stats.setdefault(endpoint, {}).setdefault(encoding, {"bytes_in": 0, "bytes_out": 0})
+        entry["bytes_in"] += bytes_in
+        entry["bytes_out"] += bytes_out
+
+# Compressed bytes in/out per endpoint and encoding, shared with /debug/compression
+compression_stats = {}
+
+
+# orjson hook for types it doesn't handle natively (datetime, dict and list are native)
+def orjson_default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, HistoryEntry):
+        return obj.to_dict()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+# Serialize a session (UserData) or history document straight to JSON bytes
+def dump_json(content):
+    return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Default response class. Returning it directly from an endpoint also skips
+# FastAPI's jsonable_encoder pass, which is slow on large histories.
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dump_json(content)
+
+# Startup timings and readiness, reported by /ready
+startup_state = {"ready": False, "timings": {}, "indexes": {"status": "pending", "failed": []}}
+
+# Build the MongoDB indexes in the background so an unreachable database doesn't hold up
+# startup; retried until every index exists
+async def index_builder():
+    started = time.perf_counter()
+    while True:
+        startup_state["indexes"]["status"] = "building"
+        failed = await run_in_threadpool(ensure_indexes, db)
+        startup_state["indexes"]["failed"] = failed
+        if not failed:
+            startup_state["indexes"]["status"] = "ready"
+            startup_state["timings"]["indexes_seconds"] = time.perf_counter() - started
+            return
+        startup_state["indexes"]["status"] = "failed"
+        await asyncio.sleep(INDEX_RETRY_SECONDS)
+
+# In-memory mode: learn which users have an archived session, retrying while MongoDB is unavailable
+async def archived_ids_loader():
+    while True:
+        try:
+            await run_in_threadpool(user_data_store.load_archived_ids)
+            return
+        except PyMongoError as e:
+            print(f"Could not load archived session ids: {str(e)}")
+        await asyncio.sleep(INDEX_RETRY_SECONDS)
+
+# Initialize FastAPI with a lifespan that does the slow setup after the process is up
+@asynccontextmanager
+async def lifespan(app):
+    started = time.perf_counter()
+    indexer = asyncio.create_task(index_builder())
+    archive_loader = asyncio.create_task(archived_ids_loader()) if SESSION_STORE != "mongo" else None
+    
+    # Bring back in-memory sessions from before the restart so patients resume where they were
+    snapshots_enabled = SESSION_STORE != "mongo" and bool(SESSION_SNAPSHOT_PATH)
+    if snapshots_enabled:
+        await run_in_threadpool(restore_sessions)
+        startup_state["timings"]["session_restore_seconds"] = snapshot_stats["restore_seconds"]
+    
+    # Build the LLM clients and open provider connections now so the first consultation doesn't pay for it
+    for model in llm_router.models.values():
+        await run_in_threadpool(lambda: model.model)
+    if LLM_CASSETTE_MODE != "replay":
+        await run_in_threadpool(warm_llm_connections)
+    startup_state["timings"]["startup_seconds"] = time.perf_counter() - started
+    startup_state["ready"] = True
+    sweeper = asyncio.create_task(session_sweeper()) if SESSION_SWEEP_INTERVAL_SECONDS > 0 else None
+    snapshotter = asyncio.create_task(session_snapshotter()) if snapshots_enabled and SESSION_SNAPSHOT_INTERVAL_SECONDS > 0 else None
+    
+    yield
+    
+    startup_state["ready"] = False
+    for task in [indexer, archive_loader, sweeper, snapshotter]:
+        if task is not None:
+            task.cancel()
+    if snapshots_enabled:
+        await run_in_threadpool(snapshot_sessions)
+    background_executor.shutdown(wait=False)
+    llm_scheduler.shutdown()
+    llm_http_client.close()
+    client.close()
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -47,20 +453,681 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
-# Simulating a persistent database (replace with actual DB if needed)
-user_data_store = {}
+# Compress large JSON/NDJSON responses with zstd or gzip
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE, stats=compression_stats)
+
+# Raised when another worker updated a session since it was loaded
+class SessionConflictError(Exception):
+    pass
+
+# Compressed copies of expired sessions. Stores restore from here when an evicted user returns.
+class SessionArchive:
+    def __init__(self, collection):
+        self.collection = collection
+        self.restored = 0
+
+    # Returns the size of the archived record
+    def archive(self, user, reason, last_step):
+        session = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress(dump_json(user))
+        self.collection.update_one({"user_id": user.user_id}, {"$set": {
+            "user_id": user.user_id,
+            "version": user.version,
+            "reason": reason,
+            "last_step": last_step,
+            "turns": len(user.history),
+            "symptoms": user.symptoms,
+            "diagnosis": user.diagnosis,
+            "critical": user.critical,
+            "session": session,
+            "archived_at": datetime.utcnow()
+        }}, upsert=True)
+        return len(session)
+
+    def restore(self, user_id):
+        try:
+            record = self.collection.find_one({"user_id": user_id}, {"session": 1})
+        except PyMongoError as e:
+            print(f"Could not look up archived session {user_id}: {str(e)}")
+            return None
+        if record is None:
+            return None
+        self.restored += 1
+        return UserData(**orjson.loads(zstandard.ZstdDecompressor().decompress(record["session"])))
+
+    def discard(self, user_id):
+        self.collection.delete_one({"user_id": user_id})
+
+    def user_ids(self):
+        return {doc["user_id"] for doc in self.collection.find({}, {"_id": 0, "user_id": 1})}
+
+# Process-local session store, only safe with a single worker
+class MemorySessionStore(dict):
+    def __init__(self, archive=None):
+        super().__init__()
+        self.archive = archive
+        self.touched = {}
+        self.writes = 0
+        # Users with an archived session. Once loaded at startup (load_archived_ids), a miss for
+        # anyone else is answered without querying MongoDB; until then every miss checks the archive.
+        self.archived_ids = set()
+        self.archived_ids_loaded = False
+
+    def __setitem__(self, user_id, user):
+        user.version += 1
+        super().__setitem__(user_id, user)
+        self.touched[user_id] = time.time()
+        self.writes += 1
+
+    # Membership and indexing only look at memory; an archived session comes back through get(),
+    # which queries MongoDB and so must not be called on the event loop
+    def get(self, user_id, default=None):
+        if super().__contains__(user_id):
+            return super().__getitem__(user_id)
+        user = self.rehydrate(user_id)
+        return default if user is None else user
+
+    # Read-only lookup that never brings back an archived session
+    def peek(self, user_id):
+        return super().get(user_id)
+
+    def __delitem__(self, user_id):
+        super().__delitem__(user_id)
+        self.touched.pop(user_id, None)
+        self.writes += 1
+
+    # A turn failed after changing the session in place; the change is already visible here,
+    # so store it to move the version on. A session the turn was creating is dropped.
+    def abandon(self, user_id, user):
+        if super().__contains__(user_id):
+            self[user_id] = user
+
+    def rehydrate(self, user_id):
+        if self.archive is None or (self.archived_ids_loaded and user_id not in self.archived_ids):
+            return None
+        user = self.archive.restore(user_id)
+        if user is not None:
+            super().__setitem__(user_id, user)
+            self.touched[user_id] = time.time()
+            self.archive.discard(user_id)
+            self.archived_ids.discard(user_id)
+        return user
+
+    def load_archived_ids(self):
+        self.archived_ids |= self.archive.user_ids()
+        self.archived_ids_loaded = True
+
+    # Sessions not written for at least `seconds`, with their idle time
+    def idle_since(self, seconds):
+        now = time.time()
+        return [(user_id, now - touched) for user_id, touched in list(self.touched.items()) if now - touched >= seconds]
+
+    # Remove a session that has just been archived
+    def evict(self, user_id, version):
+        user = super().get(user_id)
+        if user is None or user.version != version:
+            return False
+        del self[user_id]
+        self.archived_ids.add(user_id)
+        return True
+
+    # Write all sessions to `path` as zstd-compressed msgpack, replacing the file atomically.
+    # Returns the snapshot size in bytes.
+    def snapshot(self, path):
+        packed = ormsgpack.packb(
+            {"sessions": list(dict.values(self)), "touched": dict(self.touched)},
+            default=orjson_default,
+            option=ormsgpack.OPT_SERIALIZE_PYDANTIC
+        )
+        data = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL, threads=-1).compress(packed)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return len(data)
+
+    # Load sessions written by snapshot(); returns the number restored
+    def restore(self, path):
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            snapshot = ormsgpack.unpackb(zstandard.ZstdDecompressor().decompress(f.read()))
+        touched = snapshot.get("touched", {})
+        now = time.time()
+        for fields in snapshot["sessions"]:
+            # Written by this process from validated models, so skip re-validation
+            fields["history"] = [HistoryEntry.coerce(item) for item in fields.get("history", [])]
+            user = UserData.model_construct(**fields)
+            dict.__setitem__(self, user.user_id, user)
+            self.touched[user.user_id] = touched.get(user.user_id, now)
+        return len(snapshot["sessions"])
+
+    def history_lengths(self):
+        for user_id, user in list(super().items()):
+            yield user_id, len(user.history)
+
+# Session store shared by all workers through MongoDB, with optimistic versioning.
+# Loaded sessions are cached per worker and only re-read when the stored version moves.
+class MongoSessionStore:
+    def __init__(self, collection, archive=None):
+        # Relies on the unique user_id index created by ensure_indexes
+        self.collection = collection
+        self.archive = archive
+        self.cache = {}
+        # Fields of each cached session as last read or written, to send only what changed
+        self.baselines = {}
+
+    def load(self, user_id, rehydrate=True):
+        stored = self.collection.find_one({"user_id": user_id}, {"version": 1})
+        if stored is None:
+            self.cache.pop(user_id, None)
+            return self.rehydrate(user_id) if rehydrate else None
+        cached = self.cache.get(user_id)
+        if cached is not None and cached.version == stored["version"]:
+            return cached
+        doc = self.collection.find_one({"user_id": user_id}, {"_id": 0})
+        if doc is None:
+            return None
+        user = UserData(**doc)
+        self.remember(user, user.model_dump(exclude={"version"}))
+        return user
+
+    def remember(self, user, fields):
+        self.cache[user.user_id] = user
+        self.baselines[user.user_id] = (user.version, fields)
+
+    def forget(self, user_id):
+        self.cache.pop(user_id, None)
+        self.baselines.pop(user_id, None)
+
+    # A turn failed after changing the cached session in place: drop it so it is re-read
+    def abandon(self, user_id, user):
+        self.forget(user_id)
+
+    # Update operators for the fields that differ from the stored copy; new history entries
+    # are appended rather than rewriting the whole list
+    def changes(self, user_id, version, fields):
+        baseline_version, baseline = self.baselines.get(user_id, (None, None))
+        if baseline_version != version:
+            return {"$set": dict(fields)}
+        update = {}
+        for field, value in fields.items():
+            before = baseline.get(field)
+            if value == before:
+                continue
+            if field == "history" and isinstance(before, list) and value[:len(before)] == before:
+                update["$push"] = {"history": {"$each": value[len(before):]}}
+            else:
+                update.setdefault("$set", {})[field] = value
+        return update
+
+    def __contains__(self, user_id):
+        return self.load(user_id) is not None
+
+    def __getitem__(self, user_id):
+        user = self.load(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def get(self, user_id, default=None):
+        user = self.load(user_id)
+        return default if user is None else user
+
+    # Read-only lookup that never brings back an archived session
+    def peek(self, user_id):
+        return self.load(user_id, rehydrate=False)
+
+    def __setitem__(self, user_id, user):
+        expected_version = user.version
+        fields = user.model_dump(exclude={"version"})
+        updated_at = datetime.utcnow()
+        if expected_version == 0:
+            try:
+                self.collection.insert_one({**fields, "version": 1, "updated_at": updated_at})
+            except DuplicateKeyError:
+                raise SessionConflictError(f"Session {user_id} was created by another worker")
+        else:
+            update = self.changes(user_id, expected_version, fields)
+            update.setdefault("$set", {}).update({"version": expected_version + 1, "updated_at": updated_at})
+            result = self.collection.update_one({"user_id": user_id, "version": expected_version}, update)
+            if result.matched_count == 0:
+                self.forget(user_id)
+                raise SessionConflictError(f"Session {user_id} was modified by another worker")
+        user.version = expected_version + 1
+        self.remember(user, fields)
+
+    def __delitem__(self, user_id):
+        self.collection.delete_one({"user_id": user_id})
+        self.forget(user_id)
+
+    # Move an archived session back into the shared collection, keeping its version
+    def rehydrate(self, user_id):
+        user = self.archive.restore(user_id) if self.archive is not None else None
+        if user is None:
+            return None
+        try:
+            self.collection.insert_one({**user.model_dump(), "updated_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            # Another worker restored it first
+            return self.load(user_id)
+        self.archive.discard(user_id)
+        self.remember(user, user.model_dump(exclude={"version"}))
+        return user
+
+    def idle_since(self, seconds):
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=seconds)
+        return [
+            (doc["user_id"], (now - doc.get("updated_at", now)).total_seconds())
+            for doc in self.collection.find({"updated_at": {"$lt": cutoff}}, {"user_id": 1, "updated_at": 1})
+        ]
+
+    # Delete the session only if it is still at the archived version. False when another worker
+    # has written to it since, or has already archived and deleted it.
+    def evict(self, user_id, version):
+        self.forget(user_id)
+        return self.collection.delete_one({"user_id": user_id, "version": version}).deleted_count == 1
+
+    def __len__(self):
+        return self.collection.count_documents({})
+
+    def keys(self):
+        return [doc["user_id"] for doc in self.collection.find({}, {"user_id": 1})]
+
+    def history_lengths(self):
+        for doc in self.collection.aggregate([{"$project": {"user_id": 1, "length": {"$size": "$history"}}}]):
+            yield doc["user_id"], doc["length"]
+
+    def items(self):
+        return [(doc["user_id"], UserData(**doc)) for doc in self.collection.find({}, {"_id": 0})]
+
+# Conversation state for in-progress consultations
+session_archive = SessionArchive(db.archived_sessions)
+if SESSION_STORE == "mongo":
+    user_data_store = MongoSessionStore(db.sessions, session_archive)
+else:
+    user_data_store = MemorySessionStore(session_archive)
+
+# Single-flight coalescing: concurrent identical requests share one in-flight computation
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, make_call):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(make_call())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            print(f"Coalescing duplicate in-flight request: {key}")
+        # Shield so one cancelled caller doesn't cancel the shared computation
+        return await asyncio.shield(task)
+
+request_coalescer = SingleFlight()
+
+# Remembers results of completed requests so retried saves become no-ops
+class IdempotencyStore:
+    def __init__(self, ttl_seconds=600):
+        self.ttl_seconds = ttl_seconds
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is None:
+                return None
+            stored_at, result = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.results[key]
+                return None
+            return result
+
+    def set(self, key, result):
+        with self.lock:
+            now = time.monotonic()
+            self.results = {k: v for k, v in self.results.items() if now - v[0] <= self.ttl_seconds}
+            self.results[key] = (now, result)
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS)
+
+# Per-session locks: turns for the same user run one at a time (FIFO),
+# while turns for different users proceed in parallel
+class SessionLocks:
+    def __init__(self, slow_wait_seconds=1.0):
+        self.slow_wait_seconds = slow_wait_seconds
+        self.locks = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def hold(self, user_id):
+        entry = self.locks.setdefault(user_id, {"lock": asyncio.Lock(), "users": 0})
+        entry["users"] += 1
+        started = time.perf_counter()
+        try:
+            async with entry["lock"]:
+                self.record_wait(user_id, time.perf_counter() - started)
+                yield
+        finally:
+            entry["users"] -= 1
+            if entry["users"] == 0:
+                self.locks.pop(user_id, None)
+
+    def record_wait(self, user_id, waited):
+        self.acquisitions += 1
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        if waited > 0.001:
+            self.contended += 1
+        if waited >= self.slow_wait_seconds:
+            print(f"Session lock for {user_id} waited {waited:.3f}s")
+
+    def stats(self):
+        return {
+            "active_sessions": len(self.locks),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "avg_wait_seconds": self.total_wait_seconds / self.acquisitions if self.acquisitions else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+session_locks = SessionLocks(float(os.getenv("SESSION_LOCK_SLOW_WAIT_SECONDS", "1.0")))
+
+# Materialized doctor summaries, keyed by the session version they were built from
+class SummaryStore:
+    def __init__(self, collection=None):
+        self.collection = collection
+        self.summaries = {}
+
+    def get(self, user_id):
+        if self.collection is not None:
+            return self.collection.find_one({"user_id": user_id}, {"_id": 0})
+        return self.summaries.get(user_id)
+
+    def set(self, user_id, version, summary):
+        record = {"user_id": user_id, "version": version, "summary": summary, "generated_at": datetime.utcnow()}
+        if self.collection is not None:
+            self.collection.update_one({"user_id": user_id}, {"$set": record}, upsert=True)
+        else:
+            self.summaries[user_id] = record
+
+    def discard(self, user_id):
+        if self.collection is not None:
+            self.collection.delete_one({"user_id": user_id})
+        else:
+            self.summaries.pop(user_id, None)
+
+summary_store = SummaryStore(db.summaries if SESSION_STORE == "mongo" else None)
+
+# Background work that shouldn't hold up a request, such as summary generation
+background_executor = ThreadPoolExecutor(max_workers=int(os.getenv("BACKGROUND_WORKERS", "4")), thread_name_prefix="background")
+summary_jobs = {}
+
+# Session changes made during one turn, applied as a single write when the turn ends so a
+# conflict with another worker rejects the whole turn instead of leaving it half-applied
+pending_session_writes = contextvars.ContextVar("pending_session_writes", default=None)
+
+# "users" holds sessions changed in the turn, "loaded" the ones it has read
+def new_session_writes():
+    return {"users": {}, "loaded": {}, "after_write": {}}
+
+def abandon_session_writes(pending):
+    for user_id, user in pending["users"].items():
+        user_data_store.abandon(user_id, user)
+
+def commit_session_writes(pending):
+    for user_id, user in pending["users"].items():
+        user_data_store[user_id] = user
+    for func, args in pending["after_write"]:
+        func(*args)
+
+@contextmanager
+def session_turn():
+    if pending_session_writes.get() is not None:
+        yield
+        return
+    pending = new_session_writes()
+    token = pending_session_writes.set(pending)
+    try:
+        yield
+    except BaseException:
+        abandon_session_writes(pending)
+        raise
+    finally:
+        pending_session_writes.reset(token)
+    commit_session_writes(pending)
+
+# session_turn() for turns that run on the event loop: the write (a MongoDB round trip in
+# mongo mode) and the callbacks after it run in the threadpool
+@asynccontextmanager
+async def async_session_turn():
+    if pending_session_writes.get() is not None:
+        yield
+        return
+    pending = new_session_writes()
+    token = pending_session_writes.set(pending)
+    try:
+        yield
+    except BaseException:
+        abandon_session_writes(pending)
+        raise
+    finally:
+        pending_session_writes.reset(token)
+    await run_in_threadpool(commit_session_writes, pending)
+
+# Read a session in the threadpool, bringing back an archived one; later reads in the same
+# turn use this copy instead of going back to the store. None if the user has no session.
+async def load_turn_session(user_id):
+    user = await run_in_threadpool(user_data_store.get, user_id)
+    pending = pending_session_writes.get()
+    if pending is not None and user is not None:
+        pending["loaded"][user_id] = user
+    return user
+
+def save_user_data(user_id, user):
+    pending = pending_session_writes.get()
+    if pending is None:
+        user_data_store[user_id] = user
+    else:
+        pending["users"][user_id] = user
+
+# Run once the session has been written (at the end of the turn, if one is in progress)
+def after_session_write(func, *args):
+    pending = pending_session_writes.get()
+    if pending is None:
+        func(*args)
+    else:
+        pending["after_write"][(func, args)] = True
+
+def run_session_turn(func, *args):
+    with session_turn():
+        return func(*args)
+
+# Run blocking session work in the threadpool while holding the user's session lock
+async def run_locked(user_id, func, *args):
+    async with session_locks.hold(user_id):
+        return await run_in_threadpool(run_session_turn, func, *args)
+
+sweeper_stats = {"sweeps": 0, "evicted": 0, "finished": 0, "idle": 0, "bytes_reclaimed": 0, "bytes_archived": 0, "last_sweep_seconds": 0.0}
+
+# Archive and evict one session if it has expired; returns the reason or None
+def expire_session(user_id, idle_seconds):
+    # Never rehydrate here: the session may already have been archived by another worker
+    user = user_data_store.peek(user_id)
+    if user is None:
+        return None
+    last_step = get_current_step(user)
+    if last_step == "end" and idle_seconds >= SESSION_FINISHED_TTL_SECONDS:
+        reason = "finished"
+    elif idle_seconds >= SESSION_IDLE_TTL_SECONDS:
+        reason = "idle"
+    else:
+        return None
+    
+    session_bytes = len(dump_json(user))
+    archived_bytes = session_archive.archive(user, reason, last_step)
+    if not user_data_store.evict(user_id, user.version):
+        # Another worker wrote to the session in the meantime: keep the live session and drop
+        # this archive. If it was deleted instead, another worker archived it; keep that record.
+        if user_data_store.peek(user_id) is not None:
+            session_archive.discard(user_id)
+        return None
+    summary_store.discard(user_id)
+    summary_jobs.pop(user_id, None)
+    speculative_jobs.pop(user_id, None)
+    
+    sweeper_stats[reason] += 1
+    sweeper_stats["evicted"] += 1
+    sweeper_stats["bytes_reclaimed"] += session_bytes
+    sweeper_stats["bytes_archived"] += archived_bytes
+    return reason
+
+# Archive finished and idle sessions, skipping any with a turn in progress
+async def sweep_sessions():
+    started = time.perf_counter()
+    candidates = await run_in_threadpool(user_data_store.idle_since, min(SESSION_FINISHED_TTL_SECONDS, SESSION_IDLE_TTL_SECONDS))
+    for user_id, idle_seconds in candidates:
+        if user_id in session_locks.locks:
+            continue
+        try:
+            await run_locked(user_id, expire_session, user_id, idle_seconds)
+        except PyMongoError as e:
+            print(f"Could not archive session {user_id}: {str(e)}")
+    sweeper_stats["sweeps"] += 1
+    sweeper_stats["last_sweep_seconds"] = time.perf_counter() - started
+
+snapshot_stats = {"snapshots": 0, "restored_sessions": 0, "last_snapshot_bytes": 0, "last_snapshot_seconds": 0.0, "restore_seconds": 0.0}
+
+def snapshot_sessions():
+    started = time.perf_counter()
+    snapshot_stats["last_snapshot_bytes"] = user_data_store.snapshot(SESSION_SNAPSHOT_PATH)
+    snapshot_stats["last_snapshot_seconds"] = time.perf_counter() - started
+    snapshot_stats["snapshots"] += 1
+
+def restore_sessions():
+    started = time.perf_counter()
+    try:
+        snapshot_stats["restored_sessions"] = user_data_store.restore(SESSION_SNAPSHOT_PATH)
+    except Exception as e:
+        print(f"Could not restore session snapshot {SESSION_SNAPSHOT_PATH}: {str(e)}")
+    snapshot_stats["restore_seconds"] = time.perf_counter() - started
+
+# Snapshot periodically, skipping intervals in which no session changed
+async def session_snapshotter():
+    written = user_data_store.writes
+    while True:
+        await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL_SECONDS)
+        if user_data_store.writes == written:
+            continue
+        written = user_data_store.writes
+        try:
+            await run_in_threadpool(snapshot_sessions)
+        except Exception as e:
+            print(f"Session snapshot failed: {str(e)}")
+
+async def session_sweeper():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+        try:
+            await sweep_sessions()
+        except Exception as e:
+            print(f"Session sweep failed: {str(e)}")
 
 # User Response Model
 class UserResponse(BaseModel):
     user_id: str
     response: str
 
+# Step names come from a small fixed set and are recorded every turn in every session;
+# they are interned so all sessions reference one copy
+INTERNED_VALUE_KEYS = {"current_step"}
+
+# Bot output that is often recorded again unchanged (a re-asked question, a repeated step);
+# a repeat shares the previous entry's string instead of holding its own copy
+SHARED_VALUE_KEYS = {"current_question", "current_step"}
+
+# One conversation history record. Reads like the {key: value, "validation_details": {...}}
+# dict it replaces, but keeps the fields in slots with interned keys and step names.
+class HistoryEntry(Mapping):
+    __slots__ = ("key", "value", "validation_details")
+
+    def __init__(self, key, value, validation_details=None):
+        self.key = sys.intern(key)
+        self.value = sys.intern(value) if key in INTERNED_VALUE_KEYS and isinstance(value, str) else value
+        self.validation_details = {sys.intern(k): v for k, v in validation_details.items()} if validation_details else None
+
+    # Accepts stored dicts (MongoDB, archives, snapshots); unexpected shapes stay plain dicts
+    @classmethod
+    def coerce(cls, item):
+        if isinstance(item, HistoryEntry) or not isinstance(item, dict):
+            return item
+        keys = [key for key in item if key != "validation_details"]
+        if len(keys) != 1 or not isinstance(keys[0], str):
+            return item
+        return cls(keys[0], item[keys[0]], item.get("validation_details"))
+
+    def __getitem__(self, key):
+        if key == self.key:
+            return self.value
+        if key == "validation_details" and self.validation_details is not None:
+            return self.validation_details
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield self.key
+        if self.validation_details is not None:
+            yield "validation_details"
+
+    def __len__(self):
+        return 1 if self.validation_details is None else 2
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source_type, handler):
+        return core_schema.no_info_plain_validator_function(
+            cls.coerce,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda item: item.to_dict() if isinstance(item, HistoryEntry) else item
+            )
+        )
+
+# Approximate memory held by an object graph. Objects already in `seen` (e.g. interned
+# strings shared with another session) are not counted again.
+def deep_sizeof(obj, seen=None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, BaseModel):
+        size += deep_sizeof(obj.__dict__, seen)
+    elif isinstance(obj, HistoryEntry):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in HistoryEntry.__slots__)
+    elif isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
 # User Data Model (for tracking conversation state)
 class UserData(BaseModel):
     user_id: str
-    history: List[Dict[str, str]] = []
+    version: int = 0
+    history: List[HistoryEntry] = []
     is_existing: bool = False
     symptoms: List[str] = []
     previous_history: str = ""
@@ -68,11 +1135,33 @@ class UserData(BaseModel):
     additional_symptoms: str = ""
     diagnosis: str = ""
     critical: bool = False
+    # Where the latest diagnosis came from, for auditing: {"source": "llm" | "cache" | "speculative", ...}
+    diagnosis_source: Dict = {}
 
 # Function to get user state
 def get_user_data(user_id: str):
+    pending = pending_session_writes.get()
+    if pending is not None:
+        user = pending["users"].get(user_id) or pending["loaded"].get(user_id)
+        if user is not None:
+            return user
     return user_data_store.get(user_id, UserData(user_id=user_id))
 
+# Record a history entry. A question or step identical to the latest one recorded for that
+# key is still recorded, but shares the earlier string.
+def append_history(user, key, value, validation_details=None):
+    if key in SHARED_VALUE_KEYS:
+        latest = next((item.get(key) for item in reversed(user.history) if key in item), None)
+        if latest == value:
+            value = latest
+    user.history.append(HistoryEntry(key, value, validation_details))
+
+# Follow-up paths; their handler records each answer under the step name (plus "_continued" suffixes)
+FOLLOW_UP_PATHS = {"dynamic_symptoms", "injury_assessment", "infection_assessment", "digestive_assessment", "respiratory_assessment", "chronic_condition"}
+
+def answered_follow_ups(user):
+    return sum(1 for item in user.history for key in item if key.replace("_continued", "") in FOLLOW_UP_PATHS)
+
 # Function to update user data with validation details
 def update_user_data(user_id: str, key: str, value: str, validation_details=None):
     user = get_user_data(user_id)
@@ -82,12 +1171,7 @@ def update_user_data(user_id: str, key: str, value: str, validation_details=None
         # Convert dict to string if accidentally passed
         value = str(value)
     
-    # Add the new entry with validation details if provided
-    entry = {key: value}
-    if validation_details:
-        entry["validation_details"] = validation_details
-    
-    user.history.append(entry)
+    append_history(user, key, value, validation_details)
     
     # Also update specific fields based on key
     if key == "symptoms":
@@ -111,7 +1195,784 @@ def update_user_data(user_id: str, key: str, value: str, validation_details=None
         # Just store in history, don't update specific fields
         pass
     
-    user_data_store[user_id] = user
+    save_user_data(user_id, user)
+    
+    # Consultation has reached its end: prepare the doctor summary ahead of the request
+    if key == "current_step" and value in ["criticality", "end"] and user.symptoms:
+        after_session_write(schedule_summary, user_id)
+    
+    # Enough has been collected for a diagnosis to be likely soon: start it in the background
+    if key == "current_step" and SPECULATIVE_DIAGNOSIS_ENABLED and user.symptoms and (
+        value == "diagnosis_prep" or (
+            value.replace("_continued", "") in FOLLOW_UP_PATHS and answered_follow_ups(user) >= SPECULATIVE_DIAGNOSIS_MIN_ANSWERS
+        )
+    ):
+        after_session_write(speculate_diagnosis, user_id)
+
+# Raised when the LLM backend can't produce an answer (breaker open or retries exhausted)
+class LLMUnavailableError(Exception):
+    pass
+
+# Stops calling a failing model for a while after repeated failures
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_seconds:
+                return False
+            # Half-open: let a single trial call through until it succeeds or fails. A probe that
+            # never reported back is replaced after another reset period.
+            if self.probe_started_at is not None and now - self.probe_started_at < self.reset_seconds:
+                return False
+            self.probe_started_at = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.probe_started_at is not None:
+                self.opened_at = time.monotonic()
+            self.probe_started_at = None
+
+    # The call never reached the provider, so it is neither a success nor a failure; a half-open
+    # probe slot it held is given back
+    def release(self):
+        with self.lock:
+            self.probe_started_at = None
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                return "half_open"
+            return "open"
+
+# Raised when a call would have to wait longer than LLM_RATE_MAX_WAIT_SECONDS for rate budget
+class LLMRateLimitedError(Exception):
+    pass
+
+# Rough token count for a prompt (~4 characters per token for English text)
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# Token bucket refilled continuously at limit_per_minute. Reservations may drive the
+# level negative; the deficit is how long the caller has to wait for its turn.
+class TokenBucket:
+    def __init__(self, limit_per_minute):
+        self.capacity = limit_per_minute
+        self.rate = limit_per_minute / 60.0
+        self.level = float(limit_per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        self.refill()
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount):
+        self.level -= amount
+
+    # Provider told us to back off: no budget until `seconds` from now
+    def drain(self, seconds):
+        self.refill()
+        self.level = min(self.level, -seconds * self.rate)
+
+# Smooths calls for one model and API key under the provider's requests/tokens per minute.
+# Tokens are reserved from an estimate before the call and corrected from the reported usage.
+class RateGovernor:
+    def __init__(self, model_name, api_key, rpm, tpm):
+        self.model_name = model_name
+        self.key_id = hashlib.sha256((api_key or "").encode()).hexdigest()[:8]
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.lock = threading.Lock()
+        self.counts = {"calls": 0, "delayed": 0, "rejected": 0, "provider_429s": 0}
+        self.waited_seconds = 0.0
+
+    def buckets(self, estimated_tokens):
+        return [(bucket, amount) for bucket, amount in [(self.requests, 1), (self.tokens, estimated_tokens)] if bucket]
+
+    # Reserve budget for a call; returns the token estimate and how long the call has to wait
+    # before it may be sent. The caller waits without holding a scheduler worker.
+    def reserve(self, prompt):
+        estimated_tokens = estimate_tokens(prompt) + LLM_COMPLETION_TOKEN_ESTIMATE
+        with self.lock:
+            delay = max([bucket.wait_for(amount) for bucket, amount in self.buckets(estimated_tokens)], default=0.0)
+            if delay > LLM_RATE_MAX_WAIT_SECONDS:
+                self.counts["rejected"] += 1
+                raise LLMRateLimitedError(f"Rate budget for {self.model_name} exhausted for {delay:.1f}s")
+            for bucket, amount in self.buckets(estimated_tokens):
+                bucket.take(amount)
+            self.counts["calls"] += 1
+            if delay > 0:
+                self.counts["delayed"] += 1
+                self.waited_seconds += delay
+        return estimated_tokens, delay
+
+    # Give back a reservation for a call that was cancelled before it was sent
+    def refund(self, estimated_tokens):
+        with self.lock:
+            self.counts["calls"] -= 1
+            for bucket, amount in self.buckets(estimated_tokens):
+                bucket.take(-amount)
+
+    # Charge (or refund) the difference between the estimate and the reported usage
+    def settle(self, estimated_tokens, response):
+        usage = getattr(response, "usage_metadata", None) or {}
+        actual_tokens = usage.get("total_tokens")
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self.lock:
+            self.tokens.take(actual_tokens - estimated_tokens)
+
+    def record_rate_limited(self, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        with self.lock:
+            self.counts["provider_429s"] += 1
+            for bucket in [self.requests, self.tokens]:
+                if bucket:
+                    bucket.drain(retry_after or 1.0)
+
+    def stats(self):
+        with self.lock:
+            for bucket in [self.requests, self.tokens]:
+                if bucket:
+                    bucket.refill()
+            return {
+                "model": self.model_name,
+                "key": self.key_id,
+                "rpm_limit": self.requests.capacity if self.requests else None,
+                "tpm_limit": self.tokens.capacity if self.tokens else None,
+                "remaining_requests": int(self.requests.level) if self.requests else None,
+                "remaining_tokens": int(self.tokens.level) if self.tokens else None,
+                **self.counts,
+                "waited_seconds": round(self.waited_seconds, 3),
+            }
+
+# One governor per (model, API key) so tiers that share a model share its budget
+rate_governors = {}
+rate_governors_lock = threading.Lock()
+
+def get_rate_governor(model_name):
+    with rate_governors_lock:
+        key = (model_name, GROQ_API_KEY)
+        if key not in rate_governors:
+            rpm, tpm = LLM_RATE_LIMITS.get(model_name, (0, 0))
+            rate_governors[key] = RateGovernor(model_name, GROQ_API_KEY, rpm, tpm)
+        return rate_governors[key]
+
+# Raised in replay mode for a prompt the cassette has no recording of
+class CassetteMissError(Exception):
+    pass
+
+# Prompt-hash -> response recordings stored as JSON lines, one per provider response
+class LLMCassette:
+    def __init__(self, path, mode, latency_scale=1.0):
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.entries = {}
+        # Next recording to replay per key; recordings themselves are never consumed
+        self.cursors = {}
+        self.lock = threading.Lock()
+        self.counts = {"recorded": 0, "replayed": 0, "misses": 0, "rewinds": 0}
+        if mode == "replay":
+            self.load()
+
+    @staticmethod
+    def key(model_name, prompt):
+        return hashlib.sha256(f"{model_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            print(f"LLM cassette {self.path} not found; every call will miss")
+            return
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    entry = orjson.loads(line)
+                    # Repeated prompts keep every recording
+                    self.entries.setdefault(entry["key"], []).append(entry)
+
+    def record(self, model_name, prompt, response, latency):
+        entry = {
+            "key": self.key(model_name, prompt),
+            "model": model_name,
+            "content": response.content,
+            "usage": getattr(response, "usage_metadata", None),
+            "latency_seconds": latency,
+            "recorded_at": datetime.utcnow().isoformat(),
+        }
+        with self.lock:
+            with open(self.path, "ab") as f:
+                f.write(orjson.dumps(entry) + b"\n")
+            self.counts["recorded"] += 1
+
+    def replay(self, model_name, prompt):
+        key = self.key(model_name, prompt)
+        with self.lock:
+            recordings = self.entries.get(key)
+            if not recordings:
+                self.counts["misses"] += 1
+                raise CassetteMissError(f"No recording for {model_name} prompt {key[:12]}")
+            # Repeated prompts get their recordings in order, then the last one again
+            position = self.cursors.get(key, 0)
+            entry = recordings[min(position, len(recordings) - 1)]
+            self.cursors[key] = position + 1
+            self.counts["replayed"] += 1
+        if self.latency_scale > 0:
+            time.sleep(entry["latency_seconds"] * self.latency_scale)
+        from langchain_core.messages import AIMessage
+        return AIMessage(content=entry["content"], usage_metadata=entry["usage"], response_metadata={"cassette": True})
+
+    # Start a new replay session: every prompt replays from its first recording again
+    def rewind(self):
+        with self.lock:
+            self.cursors.clear()
+            self.counts["rewinds"] += 1
+
+    def stats(self):
+        with self.lock:
+            return {"mode": self.mode, "path": self.path, "prompts": len(self.entries), **self.counts}
+
+llm_cassette = LLMCassette(LLM_CASSETTE_PATH, LLM_CASSETTE_MODE, LLM_CASSETTE_LATENCY_SCALE)
+
+# Priority queue in front of the LLM backend. Urgent-path calls jump the queue and
+# background work (summaries, batch triage) waits behind interactive turns. Waiting jobs
+# age: each LLM_PRIORITY_AGING_SECONDS in the queue counts as one priority level, so
+# background work is delayed under load but never starved.
+LLM_PRIORITIES = {"urgent": 0, "interactive": 1, "background": 2}
+
+class PriorityScheduler:
+    def __init__(self, workers, aging_seconds=5.0):
+        self.aging_seconds = aging_seconds
+        self.queues = {priority: deque() for priority in LLM_PRIORITIES}
+        # Jobs waiting for rate budget, by release time; they take no worker until released
+        self.delayed = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.waits = {priority: deque(maxlen=500) for priority in LLM_PRIORITIES}
+        self.completed = {priority: 0 for priority in LLM_PRIORITIES}
+        self.cancelled = {priority: 0 for priority in LLM_PRIORITIES}
+        self.promoted = 0
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work, name=f"llm-{i}", daemon=True) for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, priority, func, *args, delay=0.0):
+        if priority not in LLM_PRIORITIES:
+            priority = "interactive"
+        future = Future()
+        with self.condition:
+            if delay > 0:
+                heapq.heappush(self.delayed, (time.perf_counter() + delay, next(self.counter), priority, future, func, args))
+            else:
+                self.queues[priority].append((time.perf_counter(), future, func, args))
+            self.condition.notify()
+        return future
+
+    # Move a job that hasn't started yet up to `priority`, keeping its place by enqueue time.
+    # Returns whether the job was still waiting.
+    def promote(self, future, priority):
+        with self.condition:
+            for index, entry in enumerate(self.delayed):
+                if entry[3] is future:
+                    if LLM_PRIORITIES[priority] < LLM_PRIORITIES[entry[2]]:
+                        self.delayed[index] = entry[:2] + (priority,) + entry[3:]
+                    return True
+            for current, jobs in self.queues.items():
+                for entry in jobs:
+                    if entry[1] is not future:
+                        continue
+                    if LLM_PRIORITIES[priority] < LLM_PRIORITIES[current]:
+                        jobs.remove(entry)
+                        target = self.queues[priority]
+                        position = next((i for i, other in enumerate(target) if other[0] > entry[0]), len(target))
+                        target.insert(position, entry)
+                        self.condition.notify()
+                    return True
+        return False
+
+    # Move delayed jobs whose release time has come into their queues. Called with the condition held.
+    def release_due(self):
+        now = time.perf_counter()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, priority, future, func, args = heapq.heappop(self.delayed)
+            self.queues[priority].append((now, future, func, args))
+
+    # The queue whose oldest job has the best priority after aging; ties go to the higher priority.
+    # Called with the condition held.
+    def next_priority(self):
+        now = time.perf_counter()
+        best = None
+        for priority, level in LLM_PRIORITIES.items():
+            jobs = self.queues[priority]
+            if not jobs:
+                continue
+            effective = level - (now - jobs[0][0]) / self.aging_seconds
+            if best is None or effective < best[0]:
+                best = (effective, priority)
+        if best is None:
+            return None
+        if any(self.queues[priority] for priority, level in LLM_PRIORITIES.items() if level < LLM_PRIORITIES[best[1]]):
+            self.promoted += 1
+        return best[1]
+
+    def work(self):
+        while True:
+            with self.condition:
+                while True:
+                    self.release_due()
+                    priority = self.next_priority()
+                    if priority is not None:
+                        break
+                    if self.stopping and not self.delayed:
+                        return
+                    self.condition.wait(self.delayed[0][0] - time.perf_counter() if self.delayed else None)
+                enqueued_at, future, func, args = self.queues[priority].popleft()
+            if not future.set_running_or_notify_cancel():
+                with self.lock:
+                    self.cancelled[priority] += 1
+                continue
+            waited = time.perf_counter() - enqueued_at
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            # Counted once the job has run, so cancelled jobs don't show up as served
+            with self.lock:
+                self.waits[priority].append(waited)
+                self.completed[priority] += 1
+
+    # Workers finish the jobs already queued, then exit
+    def shutdown(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            report = {
+                "queued": sum(len(jobs) for jobs in self.queues.values()),
+                "waiting_for_rate_budget": len(self.delayed),
+                "promoted_by_aging": self.promoted,
+            }
+        with self.lock:
+            for priority, waits in self.waits.items():
+                ordered = sorted(waits)
+                report[priority] = {
+                    "completed": self.completed[priority],
+                    "cancelled": self.cancelled[priority],
+                    "avg_wait_seconds": sum(ordered) / len(ordered) if ordered else 0.0,
+                    "p95_wait_seconds": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0,
+                    "max_wait_seconds": ordered[-1] if ordered else 0.0,
+                }
+        return report
+
+llm_scheduler = PriorityScheduler(LLM_MAX_CONCURRENCY, LLM_PRIORITY_AGING_SECONDS)
+
+# Set by background work whose LLM calls may need to move up later: {"priority", "futures"}.
+# Calls made while it is set use its current priority and are recorded so they can be promoted.
+llm_call_tracker = contextvars.ContextVar("llm_call_tracker", default=None)
+
+# Wraps a chat model with a deadline, hedging, jittered retries and a circuit breaker
+class ResilientLLM:
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_RESET_SECONDS)
+        self.governor = get_rate_governor(model_name)
+        self.latencies = deque(maxlen=200)
+        self.hedged = 0
+        self.failures = 0
+        self.throttled = 0
+
+    @property
+    def model(self):
+        if self.client is None:
+            with self.client_lock:
+                if self.client is None:
+                    self.client = create_chat_model(self.model_name)
+        return self.client
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    # Queue a provider request. Rate budget is reserved first and the job is held back until
+    # it is available, so waiting for budget doesn't occupy a scheduler worker.
+    def submit_call(self, prompt, priority):
+        if llm_cassette.mode == "replay":
+            return llm_scheduler.submit(priority, self.call_model, prompt, 0)
+        tracker = llm_call_tracker.get()
+        if tracker is not None:
+            priority = tracker["priority"]
+        estimated_tokens, delay = self.governor.reserve(prompt)
+        future = llm_scheduler.submit(priority, self.call_model, prompt, estimated_tokens, delay=delay)
+        future.add_done_callback(lambda f: self.governor.refund(estimated_tokens) if f.cancelled() else None)
+        if tracker is not None:
+            tracker["futures"].append(future)
+        return future
+
+    # A single provider request (or an answer from the cassette)
+    def call_model(self, prompt, estimated_tokens):
+        if llm_cassette.mode == "replay":
+            return llm_cassette.replay(self.model_name, prompt)
+        started = time.perf_counter()
+        try:
+            response = self.model.invoke(prompt)
+        except Exception as e:
+            if getattr(e, "status_code", None) == 429:
+                self.governor.record_rate_limited(e)
+            raise
+        self.governor.settle(estimated_tokens, response)
+        if llm_cassette.mode == "record":
+            llm_cassette.record(self.model_name, prompt, response, time.perf_counter() - started)
+        return response
+
+    # Send the prompt, and a duplicate if the first hasn't answered by the hedge percentile
+    def invoke_once(self, prompt, priority="interactive"):
+        started = time.perf_counter()
+        futures = [self.submit_call(prompt, priority)]
+        error = None
+        try:
+            hedge_delay = self.latency_percentile(LLM_HEDGE_PERCENTILE) if len(self.latencies) >= LLM_HEDGE_MIN_SAMPLES else None
+            if hedge_delay is not None and hedge_delay < LLM_TIMEOUT_SECONDS:
+                done, _ = wait(futures, timeout=hedge_delay)
+                # Only hedge a request that is actually with the provider, not one still queued
+                if not done and futures[0].running():
+                    try:
+                        futures.append(self.submit_call(prompt, priority))
+                        self.hedged += 1
+                    except LLMRateLimitedError:
+                        pass  # No budget for a duplicate; keep waiting for the first
+            
+            remaining = max(0.0, LLM_TIMEOUT_SECONDS - (time.perf_counter() - started))
+            for future in as_completed(futures, timeout=remaining):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                self.latencies.append(time.perf_counter() - started)
+                return result
+            raise error
+        finally:
+            # Drop the losing hedge, or both calls after a timeout, if still queued so they
+            # don't reach the provider later
+            for future in futures:
+                future.cancel()
+
+    def invoke(self, prompt, priority="interactive"):
+        if not self.breaker.allow():
+            raise LLMUnavailableError(f"Circuit breaker open for {self.model_name}")
+        try:
+            for attempt in Retrying(
+                stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+                wait=wait_random_exponential(multiplier=0.5, max=LLM_RETRY_MAX_WAIT_SECONDS),
+                retry=retry_if_not_exception_type((LLMRateLimitedError, CassetteMissError)),
+                reraise=True,
+            ):
+                with attempt:
+                    result = self.invoke_once(prompt, priority)
+        except (LLMRateLimitedError, CassetteMissError) as e:
+            # Never reached the provider (throttled locally, or no recording to replay), so
+            # don't retry or count it against the breaker
+            if isinstance(e, LLMRateLimitedError):
+                self.throttled += 1
+            self.breaker.release()
+            print(f"LLM call to {self.model_name} not made: {str(e)}")
+            raise LLMUnavailableError(str(e)) from e
+        except Exception as e:
+            self.failures += 1
+            self.breaker.record_failure()
+            print(f"LLM call to {self.model_name} failed: {str(e)}")
+            raise LLMUnavailableError(str(e)) from e
+        self.breaker.record_success()
+        return result
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "breaker": self.breaker.state(),
+            "p50_latency_seconds": self.latency_percentile(50),
+            "p95_latency_seconds": self.latency_percentile(95),
+            "hedged": self.hedged,
+            "failures": self.failures,
+            "throttled": self.throttled,
+        }
+
+# Deterministic first aid steps used when the LLM can't provide specific ones
+DEFAULT_URGENT_STEPS = [
+    "Call emergency services (911) immediately",
+    "Sit upright and try to stay calm",
+    "Remove any restrictive clothing",
+    "Breathe slowly through pursed lips"
+]
+
+# Shown when the LLM can't tell how urgent the patient's situation is, instead of treating
+# it as non-urgent. The patient's next message is assessed again.
+TRIAGE_UNAVAILABLE_MESSAGE = """<div class="urgent-message">
+<div class="urgent-header">⚠️ WE CAN'T ASSESS URGENCY RIGHT NOW ⚠️</div>
+<div class="urgent-content">
+  <p>Our assessment service is temporarily unavailable, so we can't tell how urgent your situation is.</p>
+  <p>If you have trouble breathing, chest pain, severe pain or bleeding, confusion, or feel seriously unwell, call emergency services (911) or go to the nearest emergency department now.</p>
+  <p>Otherwise, please send another message in a few minutes and we'll try again.</p>
+</div>
+</div>"""
+
+# Replies served per call site when the LLM backend is unavailable. Most are empty or
+# unparseable on purpose so the handlers fall through to their existing defaults.
+LLM_FALLBACKS = {
+    "validation": '{"is_valid": true, "reason": "Validation unavailable"}',
+    "initial_urgency": "",
+    "triage_batch": "",
+    "urgency_check": "",
+    "follow_up_question": "Could you tell me more about your symptoms?",
+    "similar_diagnosis": "(similar conditions are not available right now)",
+    "urgent_advice": "\n".join(f"{i}. {step}" for i, step in enumerate(DEFAULT_URGENT_STEPS, 1)),
+    "diagnosis": "A detailed diagnosis is not available right now. Please consult a healthcare professional about your symptoms.",
+    "criticality": """## URGENCY LEVEL
+PROMPT (see doctor soon)
+
+## TIMEFRAME
+Within 24 hours, or immediately if your symptoms get worse
+
+## PRECAUTIONS
+• Rest and stay hydrated
+• Monitor your symptoms closely
+• Seek emergency care for trouble breathing, chest pain or severe pain
+
+## DISCLAIMER
+This automated assessment is not a substitute for professional medical care.""",
+    "summary": "The automated summary is temporarily unavailable. Please review the consultation details directly.",
+}
+
+# Default scheduling priority per call site; urgent handlers pass priority="urgent" and
+# validation runs at the priority of the turn it belongs to (see turn_priority)
+LLM_SITE_PRIORITIES = {
+    "urgent_advice": "urgent",
+    "summary": "background",
+    "triage_batch": "background",
+}
+
+# Steps of the urgent flow; LLM calls made for these turns run at urgent priority
+URGENT_STEPS = {"urgent_follow_up", "emergency_services"}
+
+def turn_priority(user, current_step):
+    if current_step in URGENT_STEPS or user.critical:
+        return "urgent"
+    return "interactive"
+
+# Routes each call site to its model tier and escalates to the large model
+# when the fast model's answer can't be used (parse failure or low confidence)
+# (or when the fast tier is unavailable). If the large tier is unavailable too,
+# the site's deterministic fallback is returned, flagged in response_metadata.
+class ModelRouter:
+    def __init__(self, models, site_tiers, fallbacks):
+        self.models = models
+        self.site_tiers = site_tiers
+        self.fallbacks = fallbacks
+        self.calls = {}
+        self.escalations = {}
+        self.fallbacks_served = {}
+
+    def invoke(self, site, prompt, accept=None, priority=None):
+        priority = priority or LLM_SITE_PRIORITIES.get(site, "interactive")
+        tier = self.site_tiers.get(site, "large")
+        if tier not in self.models:
+            tier = "large"
+        self.calls[site] = self.calls.get(site, 0) + 1
+        try:
+            response = self.models[tier].invoke(prompt, priority)
+        except LLMUnavailableError as e:
+            if tier == "large":
+                return self.fallback(site, e)
+            response = None
+        if tier != "large" and (response is None or (accept is not None and not accept(response.content))):
+            print(f"Escalating LLM call '{site}' from {tier} to large model")
+            self.escalations[site] = self.escalations.get(site, 0) + 1
+            try:
+                response = self.models["large"].invoke(prompt, priority)
+            except LLMUnavailableError as e:
+                return self.fallback(site, e)
+        return response
+
+    def fallback(self, site, error):
+        if site not in self.fallbacks:
+            raise error
+        print(f"Serving fallback for LLM call '{site}': {str(error)}")
+        self.fallbacks_served[site] = self.fallbacks_served.get(site, 0) + 1
+        from langchain_core.messages import AIMessage
+        return AIMessage(content=self.fallbacks[site], response_metadata={"fallback": True})
+
+    def stats(self):
+        return {
+            "site_tiers": self.site_tiers,
+            "models": {tier: model.stats() for tier, model in self.models.items()},
+            "calls": self.calls,
+            "escalations": self.escalations,
+            "fallbacks_served": self.fallbacks_served,
+        }
+
+llm_router = ModelRouter({"fast": ResilientLLM(LLM_MODELS["fast"]), "large": ResilientLLM(LLM_MODELS["large"])}, LLM_SITE_TIERS, LLM_FALLBACKS)
+
+# Extract the first JSON object from an LLM reply, or None if there isn't a valid one
+def parse_json_reply(text):
+    json_match = re.search(r'\{.*\}', text, re.DOTALL)
+    if not json_match:
+        return None
+    try:
+        return json.loads(json_match.group())
+    except ValueError:
+        return None
+
+# Acceptance check for JSON replies
+def is_json_reply(text):
+    return parse_json_reply(text) is not None
+
+# Acceptance check for YES/NO replies
+def is_yes_no_reply(text):
+    return text.strip().strip(".").upper() in ["YES", "NO"]
+
+# Answers that carry no clinical information and shouldn't affect the cache key
+NEGATIVE_ANSWERS = ["no", "none", "nothing", "not really", "that's all", "n/a", "continue", "proceed to diagnosis"]
+
+# Normalize free text into a sorted list of unique terms
+def normalize_terms(text):
+    if not text:
+        return []
+    if isinstance(text, list):
+        text = ", ".join(str(item) for item in text)
+    terms = set()
+    for part in re.split(r",|;|\n|\band\b|\bwith\b|\bplus\b", text.lower()):
+        term = " ".join(re.sub(r"[^a-z0-9 ]", " ", part).split())
+        if term and term not in NEGATIVE_ANSWERS:
+            terms.add(term)
+    return sorted(terms)
+
+# Build a canonical patient profile so near-identical presentations share a cache key
+def canonical_profile(user_data, urgency_level="normal"):
+    return {
+        "symptoms": normalize_terms(user_data.symptoms + [user_data.additional_symptoms]),
+        "previous_history": normalize_terms(user_data.previous_history),
+        "medication_history": normalize_terms(user_data.medication_history),
+        "urgency_level": (urgency_level or "normal").lower(),
+    }
+
+# In-memory LRU cache with TTL for generated diagnoses
+class DiagnosisCache:
+    def __init__(self, max_entries=1000, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, kind, profile):
+        raw = json.dumps({"kind": kind, "profile": profile}, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Whether a fresh entry exists, without counting a hit or miss
+    def contains(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": DIAGNOSIS_CACHE_ENABLED,
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+diagnosis_cache = DiagnosisCache(DIAGNOSIS_CACHE_MAX_ENTRIES, DIAGNOSIS_CACHE_TTL_SECONDS)
+
+# Record where the session's diagnosis came from. Kept out of history so the handlers and
+# patient_inputs never mistake it for validation output or something the patient said.
+def record_diagnosis_source(user_id, source, **details):
+    user = get_user_data(user_id)
+    user.diagnosis_source = {"source": source, **details}
+    save_user_data(user_id, user)
+
+# Return diagnosis text for a prompt, serving from the cache when enabled.
+# Records the diagnosis source so cached answers can be told apart.
+def cached_diagnosis(user_id, kind, prompt, urgency_level="normal"):
+    if not DIAGNOSIS_CACHE_ENABLED:
+        return llm_router.invoke("diagnosis", prompt).content, False
+
+    profile = canonical_profile(get_user_data(user_id), urgency_level)
+    key = diagnosis_cache.make_key(kind, profile)
+    cached = diagnosis_cache.get(key)
+    if cached is not None:
+        record_diagnosis_source(user_id, "cache", cache_key=key, kind=kind)
+        return cached, True
+
+    response = llm_router.invoke("diagnosis", prompt)
+    content = response.content
+    # Never cache a deterministic fallback served during an outage
+    if not response.response_metadata.get("fallback"):
+        diagnosis_cache.set(key, content)
+    record_diagnosis_source(user_id, "llm", cache_key=key, kind=kind)
+    return content, False
 
 # Update the ChatState model to track urgency and custom conversation paths
 class ChatState(BaseModel):
@@ -281,7 +2142,7 @@ def previous_history_handler(state):
     if has_consulted_doctor and extracted_diagnosis:
         symptoms_text = ", ".join(get_user_data(user_id).symptoms)
         similar_diagnosis_prompt = f"For a patient with symptoms {symptoms_text} and a previous diagnosis of {extracted_diagnosis}, suggest 2-3 similar or related possible diagnoses. Keep it brief."
-        similar_diagnosis = llm.invoke(similar_diagnosis_prompt)
+        similar_diagnosis = llm_router.invoke("similar_diagnosis", similar_diagnosis_prompt)
         response = f"Thank you for sharing that information. Based on your previous diagnosis of {extracted_diagnosis}, some similar conditions could include: {similar_diagnosis.content}\n\nHave you taken any medications for this condition? If yes, what medications and did you experience any side effects?"
         state_dict["current_question"] = response
         state_dict["current_step"] = "medication_history"
@@ -377,7 +2238,7 @@ def additional_symptoms_handler(state):
     Use bullet points (•) for main points and sub-bullets (-) for details.
     """
     
-    diagnosis = llm.invoke(diagnosis_prompt)
+    diagnosis = llm_router.invoke("diagnosis", diagnosis_prompt)
     update_user_data(user_id, "diagnosis", diagnosis.content)
     
     # Set the diagnosis as the current question and move to criticality step
@@ -386,35 +2247,9 @@ def additional_symptoms_handler(state):
     return state_dict
 
 # Update the diagnosis_prep_handler function to create better formatted output
-def diagnosis_prep_handler(state):
-    state_dict = ensure_dict(state)
-    user_id = state_dict["user_id"]
-    
-    # Initialize custom_context if not present
-    if "custom_context" not in state_dict:
-        state_dict["custom_context"] = {}
-    
-    # Create a local variable for easier access
-    custom_context = state_dict["custom_context"]
-    
-    # Get user data
-    user_data = get_user_data(user_id)
-    
-    # Check for critical health conditions first
-    has_asthma = False
-    lost_inhaler = False
-    breathing_issues = False
-    
-    for item in user_data.history:
-        for key, value in item.items():
-            if isinstance(value, str):
-                if "asthma" in value.lower():
-                    has_asthma = True
-                if "lost" in value.lower() and "inhaler" in value.lower():
-                    lost_inhaler = True
-                if any(phrase in value.lower() for phrase in ["can't breathe", "cant breathe", "difficulty breathing"]):
-                    breathing_issues = True
-    
+# The diagnosis_prep prompt for a session. Follow-up answers and validation entries don't
+# feed into it, so a speculative diagnosis stays valid until one of these inputs changes.
+def build_diagnosis_prompt(user_data):
     # Extract all user inputs to create a comprehensive patient history
     all_inputs = []
     for item in user_data.history:
@@ -445,22 +2280,58 @@ def diagnosis_prep_handler(state):
     ## LIKELY CONDITION
     [Provide the most likely condition and a brief explanation - 2-3 sentences maximum]
     
-    ## ACTION STEPS
-    • [First action step - specific and relevant to this condition]
-    • [Second action step]
-    • [Third action step if necessary]
+    ## ACTION STEPS
+    • [First action step - specific and relevant to this condition]
+    • [Second action step]
+    • [Third action step if necessary]
+    
+    ## NOTE
+    [A brief note about when to consult a doctor - 1 sentence]
+    
+    DO NOT include generic advice that isn't directly related to the patient's specific symptoms.
+    """
+    return diagnosis_prompt
+
+def diagnosis_prep_handler(state):
+    state_dict = ensure_dict(state)
+    user_id = state_dict["user_id"]
+    
+    # Initialize custom_context if not present
+    if "custom_context" not in state_dict:
+        state_dict["custom_context"] = {}
+    
+    # Create a local variable for easier access
+    custom_context = state_dict["custom_context"]
+    
+    # Get user data
+    user_data = get_user_data(user_id)
+    
+    # Check for critical health conditions first
+    has_asthma = False
+    lost_inhaler = False
+    breathing_issues = False
     
-    ## NOTE
-    [A brief note about when to consult a doctor - 1 sentence]
+    for item in user_data.history:
+        for key, value in item.items():
+            if isinstance(value, str):
+                if "asthma" in value.lower():
+                    has_asthma = True
+                if "lost" in value.lower() and "inhaler" in value.lower():
+                    lost_inhaler = True
+                if any(phrase in value.lower() for phrase in ["can't breathe", "cant breathe", "difficulty breathing"]):
+                    breathing_issues = True
     
-    DO NOT include generic advice that isn't directly related to the patient's specific symptoms.
-    """
+    diagnosis_prompt = build_diagnosis_prompt(user_data)
     
-    diagnosis = llm.invoke(diagnosis_prompt)
-    update_user_data(user_id, "diagnosis", diagnosis.content)
+    diagnosis_content = take_speculative_diagnosis(user_id, diagnosis_prompt, state_dict.get("urgency_level"))
+    from_cache = False
+    if diagnosis_content is None:
+        diagnosis_content, from_cache = cached_diagnosis(user_id, "diagnosis_prep", diagnosis_prompt, state_dict.get("urgency_level"))
+    update_user_data(user_id, "diagnosis", diagnosis_content)
+    custom_context["diagnosis_from_cache"] = from_cache
     
     # Format the diagnosis as HTML for better presentation
-    diagnosis_text = diagnosis.content.strip()
+    diagnosis_text = diagnosis_content.strip()
     
     # Extract sections
     condition_section = ""
@@ -559,14 +2430,15 @@ def generate_diagnosis(state):
     - Asthma attack: Use rescue inhaler, sit upright, seek help if not improving
     """
     
-    diagnosis = llm.invoke(diagnosis_prompt)
-    update_user_data(user_id, "diagnosis", diagnosis.content)
+    diagnosis_content, from_cache = cached_diagnosis(user_id, "generate_diagnosis", diagnosis_prompt, state_dict.get("urgency_level"))
+    update_user_data(user_id, "diagnosis", diagnosis_content)
+    state_dict["custom_context"]["diagnosis_from_cache"] = from_cache
     
     # Format the diagnosis as HTML
     formatted_html = f"""<div class="diagnosis-card">
   <div class="diagnosis-header">LIKELY CONDITION</div>
   <div class="diagnosis-content">
-    {diagnosis.content.split("ACTION STEPS")[0].strip()}
+    {diagnosis_content.split("ACTION STEPS")[0].strip()}
   </div>
   
   <div class="diagnosis-header">ACTION STEPS</div>
@@ -606,7 +2478,14 @@ def assess_criticality(state):
     Answer with ONLY 'YES' or 'NO'.
     """
     
-    urgency_response = llm.invoke(urgency_check_prompt).strip().upper()
+    urgency_check = llm_router.invoke("urgency_check", urgency_check_prompt, accept=is_yes_no_reply)
+    urgency_response = urgency_check.content.strip().strip(".").upper()
+    
+    # Urgency couldn't be checked (LLM unavailable or no YES/NO): never assume it isn't urgent
+    if urgency_check.response_metadata.get("fallback") or urgency_response not in ("YES", "NO"):
+        state_dict["current_question"] = TRIAGE_UNAVAILABLE_MESSAGE
+        state_dict["current_step"] = "criticality"
+        return state_dict
     
     if urgency_response == 'YES':
         print("Detected urgent medical situation, routing to urgent follow-up handler")
@@ -640,7 +2519,7 @@ def assess_criticality(state):
     [A brief medical disclaimer that this is not a substitute for professional care]
     """
     
-    assessment = llm.invoke(criticality_prompt)
+    assessment = llm_router.invoke("criticality", criticality_prompt)
     assessment_text = assessment.content
     
     is_critical = "URGENT" in assessment_text
@@ -653,48 +2532,177 @@ def assess_criticality(state):
 # Add a new handler for generating summary
 def generate_summary(state):
     state_dict = ensure_dict(state)
-    user_id = state_dict["user_id"]
-    user_data = get_user_data(user_id)
-    
-    if not user_data or not user_data.symptoms:
-        return {"summary": "## Medical Case Summary\n\nInsufficient data to generate a medical case summary. Please complete the consultation."}
-    
-    # Create a professional medical summary for doctors
-    symptoms_text = ", ".join(user_data.symptoms)
-    
-    # Extract validation details for more accurate summary
-    history_with_validation = [item for item in user_data.history if "validation_details" in item]
-    extracted_details = {}
+    return build_summary(state_dict["user_id"])
+
+# Update function to specifically handle accidents
+# Curated follow-up questions. Each slot is a standard question plus a pattern that tells us
+# the patient has already covered it; bump QUESTION_BANK_VERSION whenever the wording changes.
+QUESTION_BANK_VERSION = 1
+
+QUESTION_SLOTS = {
+    "onset": ("When did these symptoms start, and have they been getting better, worse, or staying the same?",
+              r"\b(since|ago|yesterday|today|tonight|last night|this morning|started|began)\b|\bfor (a|an|one|two|three|few|several|\d+) (hour|day|week|month)"),
+    "severity": ("On a scale of 1 to 10, how severe are your symptoms right now?",
+                 r"\b\d+\s*(/|out of)\s*10\b|\b(mild|moderate|severe|unbearable|excruciating)\b"),
+    "associated": ("Have you noticed any other symptoms, such as fever, nausea, dizziness, or unusual tiredness?",
+                   r"\b(no other symptoms|nothing else|also have|as well as)\b"),
+    "medications_tried": ("Have you taken any medication for this so far, and did it help?",
+                          r"\b(took|taken|taking|tried|medication|medicine|tablets?|pills?|paracetamol|ibuprofen|antacid)\b"),
+    "food": ("Have you eaten anything unusual in the last 48 hours, such as takeaway, undercooked meat, or seafood?",
+             r"\b(ate|eaten|eating|food|meal|restaurant|takeaway|seafood)\b"),
+    "travel": ("Have you travelled anywhere recently, or has anyone around you had similar symptoms?",
+               r"\b(travel|travelled|traveled|trip|abroad|holiday|vacation)\b"),
+    "hydration": ("Are you able to keep fluids down, and have you noticed any blood in your stool or vomit?",
+                  r"\b(fluids|drinking|dehydrated|blood in)\b"),
+    "breathing": ("Are you short of breath at rest, or only when you are active?",
+                  r"\b(short of breath|breathless|at rest|when walking|wheez\w*)\b"),
+    "cough": ("Is your cough dry, or are you bringing up phlegm? If so, what colour is it?",
+              r"\b(dry cough|phlegm|mucus|sputum)\b"),
+    "fever": ("Have you had a fever or chills, and if so, how high has your temperature been?",
+              r"\b(fever|chills|temperature|degrees)\b"),
+    "exposure": ("Have you been around anyone who has been ill recently?",
+                 r"\b(exposed|contact with|around someone|colleague|family member)\b"),
+    "site": ("Where exactly is the affected area, and is it red, swollen, warm, or leaking fluid?",
+             r"\b(red|redness|swollen|swelling|warm|pus|discharge)\b"),
+    "mechanism": ("How did the injury happen?",
+                  r"\b(fell|fall|hit|twisted|crash|collision|accident|tripped|slipped)\b"),
+    "injury_location": ("Which part of your body is injured, and can you move it normally?",
+                        r"\b(arm|leg|knee|ankle|wrist|back|neck|shoulder|hand|foot|hip|elbow)\b"),
+    "injury_signs": ("Is there any swelling, bruising, bleeding, or change in shape around the injury?",
+                     r"\b(swelling|swollen|bruis\w*|bleeding|deformed)\b"),
+    "head_injury": ("Did you hit your head or lose consciousness at any point?",
+                    r"\b(hit my head|head injury|conscious|unconscious|passed out|blacked out)\b"),
+    "condition_control": ("How well controlled has your condition been recently, for example your readings or how often you need your rescue medication?",
+                          r"\b(readings?|levels?|controlled|inhaler|blood sugar|blood pressure)\b"),
+    "regular_medications": ("Which medications do you take for it, and have you missed any doses recently?",
+                            r"\b(metformin|insulin|inhaler|medication|missed|doses?)\b"),
+    "recent_change": ("What has changed recently that made you want to seek advice today?",
+                      r"\b(recently|lately|worse|changed|new)\b"),
+}
+
+# Slots asked, in order, by each follow-up node
+QUESTION_BANK = {
+    "dynamic_symptoms": ["onset", "severity", "associated", "medications_tried"],
+    "digestive_assessment": ["onset", "food", "travel", "hydration", "severity"],
+    "respiratory_assessment": ["onset", "breathing", "cough", "fever", "exposure"],
+    "infection_assessment": ["onset", "fever", "site", "exposure", "medications_tried"],
+    "injury_assessment": ["mechanism", "injury_location", "injury_signs", "head_injury", "severity"],
+    "chronic_condition": ["recent_change", "condition_control", "regular_medications", "onset"],
+}
+
+# Replies that don't clearly answer anything; the LLM decides how to follow these up
+AMBIGUOUS_ANSWERS = ["not sure", "don't know", "dont know", "idk", "maybe", "unsure", "no idea", "?"]
+
+question_bank_stats = {"bank": {}, "llm": {}}
+
+# Triage questions shown on the accident card itself, so the emergency card never waits on the LLM
+ACCIDENT_QUESTIONS = [
+    "Is there any bleeding, a head injury, or severe pain?",
+    "Can you move all of your arms and legs?",
+    "Have you lost consciousness at any point?",
+    "Have emergency services been called?",
+]
+
+# Everything the patient has told us so far
+def patient_inputs(user):
+    return [
+        value for item in user.history for key, value in item.items()
+        if key not in ["current_question", "current_step", "validation", "validation_details", "urgency_assessment"]
+        and isinstance(value, str)
+    ]
+
+# Next curated question for this node that hasn't been asked or already answered,
+# or None when the bank has run out or the latest answer needs the LLM's judgement
+def next_bank_question(user_id, node, latest_response):
+    node = node.replace("_continued", "")
+    if node not in QUESTION_BANK:
+        return None
+    answer = (latest_response or "").strip().lower()
+    if len(answer) < 2 or any(phrase == answer or answer.startswith(phrase + " ") for phrase in AMBIGUOUS_ANSWERS):
+        question_bank_stats["llm"][node] = question_bank_stats["llm"].get(node, 0) + 1
+        return None
     
-    for entry in history_with_validation:
-        validation = entry.get("validation_details", {})
-        if "extracted_symptoms" in validation:
-            extracted_details["symptoms"] = validation["extracted_symptoms"]
-        if "extracted_diagnosis" in validation:
-            extracted_details["diagnosis"] = validation["extracted_diagnosis"]
-        if "medications" in validation:
-            extracted_details["medications"] = validation["medications"]
-        if "side_effects" in validation:
-            extracted_details["side_effects"] = validation["side_effects"]
+    user = get_user_data(user_id)
+    asked = {item.get("current_question") for item in user.history if "current_question" in item}
+    patient_text = " ".join(patient_inputs(user)).lower()
+    for slot in QUESTION_BANK[node]:
+        question, answered = QUESTION_SLOTS[slot]
+        if question in asked or re.search(answered, patient_text):
+            continue
+        question_bank_stats["bank"][node] = question_bank_stats["bank"].get(node, 0) + 1
+        return question
+    
+    question_bank_stats["llm"][node] = question_bank_stats["llm"].get(node, 0) + 1
+    return None
+
+# Keyword triage runs before any LLM call: accidents are urgent, known chronic conditions routine
+ACCIDENT_KEYWORDS = ["accident", "crash", "fell", "injured", "hit", "collision", "car accident"]
+CHRONIC_CONDITIONS = ["diabetes", "diabetic", "hypertension", "asthma", "copd", "arthritis", "thyroid"]
+
+def keyword_triage(description):
+    text = description.lower()
+    if any(keyword in text for keyword in ACCIDENT_KEYWORDS):
+        return {
+            "urgency_level": "URGENT",
+            "category": "injury",
+            "key_symptoms": ["accident", "injury"],
+            "reasoning": "Patient mentioned being in an accident"
+        }
+    mentioned_conditions = [c for c in CHRONIC_CONDITIONS if c in text]
+    if mentioned_conditions:
+        condition = mentioned_conditions[0]  # Use the first mentioned condition
+        return {
+            "urgency_level": "ROUTINE",
+            "category": "chronic",
+            "key_symptoms": [condition],
+            "reasoning": f"Patient mentioned {condition}, which is a chronic condition"
+        }
+    return None
+
+def build_urgency_prompt(description):
+    return f"""
+    Based on the following patient description, assess the medical urgency:
     
-    summary_prompt = f"""Generate a concise, professional medical case summary for a doctor based on the following patient information:
+    Patient description: "{description}"
     
-    Presenting Symptoms: {symptoms_text}
-    Medical History: {user_data.previous_history}
-    Medication History: {user_data.medication_history}
-    Additional Symptoms: {user_data.additional_symptoms}
-    Preliminary Diagnosis: {user_data.diagnosis}
-    Urgency Assessment: {"Urgent medical attention recommended" if user_data.critical else "Routine follow-up recommended"}
+    Rate the urgency as:
+    1. URGENT - requires immediate medical attention (bleeding, trouble breathing, severe injury)
+    2. PROMPT - should be addressed soon but not an emergency
+    3. ROUTINE - standard medical concern
     
-    Additional Extracted Details: {extracted_details}
+    Also identify the primary medical issue category (e.g., injury, infection, chronic condition).
+    Explain your reasoning briefly.
     
-    Format the summary as a professional medical case summary that a physician would find useful. Include only factual information provided by the patient. Structure the summary with clear headings for Chief Complaint, History, Medications, Assessment, and Recommendations.
+    Format your response as JSON:
+    {{
+        "urgency_level": "URGENT/PROMPT/ROUTINE",
+        "category": "primary medical issue category",
+        "reasoning": "brief explanation",
+        "key_symptoms": ["symptom1", "symptom2"],
+        "recommended_questions": ["question1", "question2"]
+    }}
     """
-    
-    summary = llm.invoke(summary_prompt)
-    return {"summary": f"## Medical Case Summary\n\n{summary.content}"}
 
-# Update function to specifically handle accidents
+# Classify one intake description without touching any session: keywords first, then the LLM.
+# Raises rather than defaulting to ROUTINE when the LLM served a fallback or no usable JSON.
+def classify_intake(description, site="initial_urgency"):
+    assessment = keyword_triage(description)
+    source = "keywords"
+    if assessment is None:
+        response = llm_router.invoke(site, build_urgency_prompt(description), accept=is_json_reply)
+        if response.response_metadata.get("fallback"):
+            raise LLMUnavailableError("Urgency classification is unavailable right now")
+        assessment = parse_json_reply(response.content)
+        if not isinstance(assessment, dict):
+            raise ValueError("Urgency classification reply could not be parsed")
+        source = "llm"
+    return {
+        "urgency_level": str(assessment.get("urgency_level", "ROUTINE")).upper(),
+        "category": assessment.get("category", "general"),
+        "key_symptoms": assessment.get("key_symptoms", []),
+        "source": source
+    }
+
 def assess_initial_urgency(state):
     state_dict = ensure_dict(state)
     
@@ -706,37 +2714,20 @@ def assess_initial_urgency(state):
     user_response = state_dict.get("response", "")
     
     # ACCIDENT DETECTION: Explicitly check for accident-related phrases
-    accident_keywords = ["accident", "crash", "fell", "injured", "hit", "collision", "car accident"]
-    if any(keyword in user_response.lower() for keyword in accident_keywords):
+    triage = keyword_triage(user_response)
+    if triage is not None and triage["category"] == "injury":
         # Set high urgency for accidents
         state_dict["urgency_level"] = "urgent"
         state_dict["custom_path"] = "injury_assessment"
-        state_dict["custom_context"] = {
-            "category": "injury",
-            "key_symptoms": ["accident", "injury"],
-            "reasoning": "Patient mentioned being in an accident"
-        }
+        state_dict["custom_context"] = {key: triage[key] for key in ("category", "key_symptoms", "reasoning")}
         
         # Store the accident information
         update_user_data(user_id, "accident_info", user_response)
         update_user_data(user_id, "symptoms", "accident injury")
         
-        # Generate specific questions for accidents
-        accident_prompt = f"""
-        The patient has said: "{user_response}"
-        
-        They have mentioned being in an accident. Ask them specific questions to:
-        1. Determine if there's any bleeding, head injury, or severe pain
-        2. Find out if they can move all limbs
-        3. Check if they've lost consciousness at any point
-        4. Determine if emergency services were called
-        
-        Format as 2-3 clear questions that assess the urgency of their injuries.
-        """
-        
-        accident_questions = llm.invoke(accident_prompt)
-        
-        # Format the emergency message with bold numbered points
+        # Format the emergency message with bold numbered points and the triage questions;
+        # the answers come back to urgent_follow_up_handler on the next turn
+        accident_questions = "\n".join(f"    <li>{question}</li>" for question in ACCIDENT_QUESTIONS)
         state_dict["current_question"] = f"""<div class="urgent-message">
 <div class="urgent-header">⚠️ URGENT MEDICAL SITUATION ⚠️</div>
 <div class="urgent-content">
@@ -745,6 +2736,12 @@ def assess_initial_urgency(state):
   <p><strong>3.</strong> Take aspirin if available</p>
   <p><strong>4.</strong> Loosen tight clothing</p>
 </div>
+<div class="urgent-questions">
+  <p>While you wait for help, please tell me:</p>
+  <ul>
+{accident_questions}
+  </ul>
+</div>
 <div class="urgent-footer">If this is life-threatening, stop using this app and call emergency services (911) immediately.</div>
 </div>"""
         
@@ -752,21 +2749,14 @@ def assess_initial_urgency(state):
         return state_dict
     
     # Check for known chronic conditions first
-    chronic_conditions = ["diabetes", "diabetic", "hypertension", "asthma", "copd", "arthritis", "thyroid"]
-    mentioned_conditions = [c for c in chronic_conditions if c in user_response.lower()]
-    
-    if mentioned_conditions:
+    if triage is not None:
         # Create a customized follow-up for chronic conditions
-        condition = mentioned_conditions[0]  # Use the first mentioned condition
+        condition = triage["key_symptoms"][0]
         
         # Store the condition information
         state_dict["urgency_level"] = "routine"
         state_dict["custom_path"] = "chronic_condition"
-        state_dict["custom_context"] = {
-            "category": "chronic",
-            "key_symptoms": [condition],
-            "reasoning": f"Patient mentioned {condition}, which is a chronic condition"
-        }
+        state_dict["custom_context"] = {key: triage[key] for key in ("category", "key_symptoms", "reasoning")}
         
         # Store condition in user data
         update_user_data(user_id, "medical_condition", condition)
@@ -790,59 +2780,17 @@ def assess_initial_urgency(state):
         return state_dict
     
     # Create a prompt to evaluate urgency
-    urgency_prompt = f"""
-    Based on the following patient description, assess the medical urgency:
-    
-    Patient description: "{user_response}"
-    
-    Rate the urgency as:
-    1. URGENT - requires immediate medical attention (bleeding, trouble breathing, severe injury)
-    2. PROMPT - should be addressed soon but not an emergency
-    3. ROUTINE - standard medical concern
-    
-    Also identify the primary medical issue category (e.g., injury, infection, chronic condition).
-    Explain your reasoning briefly.
-    
-    Format your response as JSON:
-    {{
-        "urgency_level": "URGENT/PROMPT/ROUTINE",
-        "category": "primary medical issue category",
-        "reasoning": "brief explanation",
-        "key_symptoms": ["symptom1", "symptom2"],
-        "recommended_questions": ["question1", "question2"]
-    }}
-    """
-    
-    urgency_assessment = llm.invoke(urgency_prompt)
-    
-    # Extract JSON from the response
-    import json
-    import re
-    
-    json_pattern = r'\{.*\}'
-    json_match = re.search(json_pattern, urgency_assessment.content, re.DOTALL)
-    
-    if json_match:
-        try:
-            assessment = json.loads(json_match.group())
-        except:
-            # Default assessment if JSON parsing fails
-            assessment = {
-                "urgency_level": "ROUTINE",
-                "category": "general",
-                "reasoning": "Unable to determine urgency from description",
-                "key_symptoms": [],
-                "recommended_questions": []
-            }
-    else:
-        # Default assessment if JSON parsing fails
-        assessment = {
-            "urgency_level": "ROUTINE",
-            "category": "general",
-            "reasoning": "Unable to determine urgency from description",
-            "key_symptoms": [],
-            "recommended_questions": []
-        }
+    urgency_assessment = llm_router.invoke("initial_urgency", build_urgency_prompt(user_response), accept=is_json_reply)
+    assessment = parse_json_reply(urgency_assessment.content)
+    
+    # No usable assessment (LLM unavailable or unparseable reply): say so rather than defaulting
+    # to ROUTINE, and assess the patient's next message again
+    if urgency_assessment.response_metadata.get("fallback") or not isinstance(assessment, dict) or "urgency_level" not in assessment:
+        state_dict["urgency_level"] = "unknown"
+        update_user_data(user_id, "urgency_assessment", json.dumps({"urgency_level": "UNKNOWN", "reasoning": "Urgency assessment unavailable"}))
+        state_dict["current_question"] = TRIAGE_UNAVAILABLE_MESSAGE
+        state_dict["current_step"] = "initial_assessment"
+        return state_dict
     
     # Update the state with urgency assessment
     state_dict["urgency_level"] = assessment["urgency_level"].lower()
@@ -871,7 +2819,7 @@ def assess_initial_urgency(state):
         4. Final immediate instruction
         """
         
-        urgent_advice = llm.invoke(urgent_advice_prompt)
+        urgent_advice = llm_router.invoke("urgent_advice", urgent_advice_prompt)
         
         # Format the emergency message with the entire advice content
         state_dict["current_question"] = f"""<div class="urgent-message">
@@ -885,7 +2833,22 @@ def assess_initial_urgency(state):
         state_dict["current_step"] = "urgent_follow_up"
         return state_dict
     
-    # For less urgent cases, generate dynamic personalized questions
+    # Choose appropriate next step based on category
+    category_to_path = {
+        "injury": "injury_assessment",
+        "infection": "infection_assessment",
+        "digestive": "digestive_assessment",
+        "respiratory": "respiratory_assessment",
+        "chronic": "chronic_condition",
+        # Add more mappings as needed
+    }
+    category = assessment.get("category", "").lower()
+    next_path = category_to_path.get(category, "dynamic_symptoms")
+    
+    # For less urgent cases, ask the first curated question for the path that isn't answered yet
+    bank_question = next_bank_question(user_id, next_path, user_response)
+    
+    # Otherwise generate dynamic personalized questions
     next_questions_prompt = f"""
     The patient has described: "{user_response}"
     
@@ -903,23 +2866,13 @@ def assess_initial_urgency(state):
     Format your response as a direct question to the patient.
     """
     
-    next_question = llm.invoke(next_questions_prompt)
-    
-    # Set dynamic question and create a custom conversation path
-    state_dict["current_question"] = next_question.content
-    
-    # Choose appropriate next step based on category
-    category_to_path = {
-        "injury": "injury_assessment",
-        "infection": "infection_assessment",
-        "digestive": "digestive_assessment",
-        "respiratory": "respiratory_assessment",
-        "chronic": "chronic_condition",
-        # Add more mappings as needed
-    }
+    if bank_question:
+        state_dict["current_question"] = bank_question
+    else:
+        next_question = llm_router.invoke("follow_up_question", next_questions_prompt)
+        state_dict["current_question"] = next_question.content
     
     # Set custom path or default to symptoms collection
-    category = assessment.get("category", "").lower()
     if category in category_to_path:
         state_dict["custom_path"] = category_to_path[category]
         state_dict["current_step"] = category_to_path[category]
@@ -960,6 +2913,14 @@ def dynamic_follow_up_handler(state):
         state_dict["current_step"] = "diagnosis_prep"
         return state_dict
     
+    # Standard questions for this category come from the question bank without an LLM call
+    bank_question = next_bank_question(user_id, current_step, user_response)
+    if bank_question:
+        state_dict["custom_context"] = current_context
+        state_dict["current_question"] = bank_question
+        state_dict["current_step"] = f"{current_step}_continued"
+        return state_dict
+    
     # Get all previous responses to build context
     user_data = get_user_data(user_id)
     conversation_history = [
@@ -1001,7 +2962,7 @@ def dynamic_follow_up_handler(state):
     }}
     """
     
-    response = llm.invoke(next_question_prompt)
+    response = llm_router.invoke("follow_up_question", next_question_prompt, accept=is_json_reply)
     
     # Extract JSON from the response
     import json
@@ -1088,18 +3049,13 @@ def urgent_follow_up_handler(state):
     Format your response as 4 numbered steps, each being a concise, direct instruction.
     """
     
-    urgent_advice = llm.invoke(prompt)
+    urgent_advice = llm_router.invoke("urgent_advice", prompt, priority="urgent")
     
     # Parse the response to extract specific steps
     advice_text = urgent_advice.content
     
     # Define default steps in case parsing fails
-    default_steps = [
-        "Call emergency services (911) immediately",
-        "Sit upright and try to stay calm",
-        "Remove any restrictive clothing",
-        "Breathe slowly through pursed lips"
-    ]
+    default_steps = list(DEFAULT_URGENT_STEPS)
     
     # Try to extract numbered steps
     import re
@@ -1127,76 +3083,88 @@ def urgent_follow_up_handler(state):
     state_dict["current_step"] = "emergency_services"
     return state_dict
 
-# Define the graph with updated nodes and flow
-graph = StateGraph(state_schema=ChatState)
-
-# Define nodes with dynamic capabilities
-graph.add_node("start", start_node)
-graph.add_node("collect_symptoms", collect_symptoms_handler)
-graph.add_node("prev_history_node", previous_history_handler)
-graph.add_node("med_history_node", medication_history_handler)
-graph.add_node("additional_symptoms_node", additional_symptoms_handler)
-graph.add_node("diagnosis_prep", diagnosis_prep_handler)
-graph.add_node("diagnosis_node", generate_diagnosis)
-graph.add_node("criticality_node", assess_criticality)
-graph.add_node("summary_node", generate_summary)
-
-# Add new dynamic nodes
-graph.add_node("initial_assessment", assess_initial_urgency)
-graph.add_node("dynamic_symptoms", dynamic_follow_up_handler)
-graph.add_node("injury_assessment", dynamic_follow_up_handler)
-graph.add_node("infection_assessment", dynamic_follow_up_handler)
-graph.add_node("digestive_assessment", dynamic_follow_up_handler)
-graph.add_node("respiratory_assessment", dynamic_follow_up_handler)
-graph.add_node("chronic_condition", dynamic_follow_up_handler)
-graph.add_node("urgent_follow_up", urgent_follow_up_handler)
-graph.add_node("emergency_services", urgent_follow_up_handler)
-
-# Connect nodes with flexible flow
-graph.add_edge(START, "start")
-graph.add_edge("start", "initial_assessment")
-
-# Connect initial assessment to different paths
-graph.add_edge("initial_assessment", "dynamic_symptoms")
-graph.add_edge("initial_assessment", "injury_assessment")
-graph.add_edge("initial_assessment", "infection_assessment")
-graph.add_edge("initial_assessment", "digestive_assessment")
-graph.add_edge("initial_assessment", "respiratory_assessment")
-graph.add_edge("initial_assessment", "chronic_condition")
-graph.add_edge("initial_assessment", "urgent_follow_up")
-
-# Connect dynamic symptom collectors to themselves for continuation
-graph.add_edge("dynamic_symptoms", "dynamic_symptoms")
-graph.add_edge("injury_assessment", "injury_assessment")
-graph.add_edge("infection_assessment", "infection_assessment")
-graph.add_edge("digestive_assessment", "digestive_assessment")
-graph.add_edge("respiratory_assessment", "respiratory_assessment")
-graph.add_edge("chronic_condition", "chronic_condition")
-
-# Connect urgent paths
-graph.add_edge("urgent_follow_up", "emergency_services")
-graph.add_edge("emergency_services", "emergency_services")
-
-# Connect all paths to diagnosis
-graph.add_edge("dynamic_symptoms", "diagnosis_prep")
-graph.add_edge("injury_assessment", "diagnosis_prep") 
-graph.add_edge("infection_assessment", "diagnosis_prep")
-graph.add_edge("digestive_assessment", "diagnosis_prep")
-graph.add_edge("respiratory_assessment", "diagnosis_prep")
-graph.add_edge("chronic_condition", "diagnosis_prep")
-graph.add_edge("urgent_follow_up", "diagnosis_prep")
-graph.add_edge("emergency_services", "diagnosis_prep")
-
-# Connect original nodes for backward compatibility
-graph.add_edge("collect_symptoms", "prev_history_node")
-graph.add_edge("prev_history_node", "med_history_node")
-graph.add_edge("med_history_node", "additional_symptoms_node")
-graph.add_edge("additional_symptoms_node", "diagnosis_prep")
-graph.add_edge("diagnosis_prep", "diagnosis_node")
-graph.add_edge("diagnosis_node", "criticality_node")
-
-# Compile Graph
-chatbot = graph.compile()
+# Define the graph with updated nodes and flow. Built on first use so that
+# langgraph isn't imported (or the graph compiled) at startup.
+def build_chatbot():
+    from langgraph.graph import StateGraph, START
+    
+    graph = StateGraph(state_schema=ChatState)
+
+    # Define nodes with dynamic capabilities
+    graph.add_node("start", start_node)
+    graph.add_node("collect_symptoms", collect_symptoms_handler)
+    graph.add_node("prev_history_node", previous_history_handler)
+    graph.add_node("med_history_node", medication_history_handler)
+    graph.add_node("additional_symptoms_node", additional_symptoms_handler)
+    graph.add_node("diagnosis_prep", diagnosis_prep_handler)
+    graph.add_node("diagnosis_node", generate_diagnosis)
+    graph.add_node("criticality_node", assess_criticality)
+    graph.add_node("summary_node", generate_summary)
+
+    # Add new dynamic nodes
+    graph.add_node("initial_assessment", assess_initial_urgency)
+    graph.add_node("dynamic_symptoms", dynamic_follow_up_handler)
+    graph.add_node("injury_assessment", dynamic_follow_up_handler)
+    graph.add_node("infection_assessment", dynamic_follow_up_handler)
+    graph.add_node("digestive_assessment", dynamic_follow_up_handler)
+    graph.add_node("respiratory_assessment", dynamic_follow_up_handler)
+    graph.add_node("chronic_condition", dynamic_follow_up_handler)
+    graph.add_node("urgent_follow_up", urgent_follow_up_handler)
+    graph.add_node("emergency_services", urgent_follow_up_handler)
+
+    # Connect nodes with flexible flow
+    graph.add_edge(START, "start")
+    graph.add_edge("start", "initial_assessment")
+
+    # Connect initial assessment to different paths
+    graph.add_edge("initial_assessment", "dynamic_symptoms")
+    graph.add_edge("initial_assessment", "injury_assessment")
+    graph.add_edge("initial_assessment", "infection_assessment")
+    graph.add_edge("initial_assessment", "digestive_assessment")
+    graph.add_edge("initial_assessment", "respiratory_assessment")
+    graph.add_edge("initial_assessment", "chronic_condition")
+    graph.add_edge("initial_assessment", "urgent_follow_up")
+
+    # Connect dynamic symptom collectors to themselves for continuation
+    graph.add_edge("dynamic_symptoms", "dynamic_symptoms")
+    graph.add_edge("injury_assessment", "injury_assessment")
+    graph.add_edge("infection_assessment", "infection_assessment")
+    graph.add_edge("digestive_assessment", "digestive_assessment")
+    graph.add_edge("respiratory_assessment", "respiratory_assessment")
+    graph.add_edge("chronic_condition", "chronic_condition")
+
+    # Connect urgent paths
+    graph.add_edge("urgent_follow_up", "emergency_services")
+    graph.add_edge("emergency_services", "emergency_services")
+
+    # Connect all paths to diagnosis
+    graph.add_edge("dynamic_symptoms", "diagnosis_prep")
+    graph.add_edge("injury_assessment", "diagnosis_prep") 
+    graph.add_edge("infection_assessment", "diagnosis_prep")
+    graph.add_edge("digestive_assessment", "diagnosis_prep")
+    graph.add_edge("respiratory_assessment", "diagnosis_prep")
+    graph.add_edge("chronic_condition", "diagnosis_prep")
+    graph.add_edge("urgent_follow_up", "diagnosis_prep")
+    graph.add_edge("emergency_services", "diagnosis_prep")
+
+    # Connect original nodes for backward compatibility
+    graph.add_edge("collect_symptoms", "prev_history_node")
+    graph.add_edge("prev_history_node", "med_history_node")
+    graph.add_edge("med_history_node", "additional_symptoms_node")
+    graph.add_edge("additional_symptoms_node", "diagnosis_prep")
+    graph.add_edge("diagnosis_prep", "diagnosis_node")
+    graph.add_edge("diagnosis_node", "criticality_node")
+
+    # Compile Graph
+    return graph.compile()
+
+chatbot = None
+
+def get_chatbot():
+    global chatbot
+    if chatbot is None:
+        chatbot = build_chatbot()
+    return chatbot
 
 # Add these new models for user registration
 class UserRegistration(BaseModel):
@@ -1269,6 +3237,18 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     return user
 
+# Liveness probe: the process is up
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+# Readiness probe: startup has finished and the app can serve consultations
+@app.get("/ready")
+def ready():
+    if not startup_state["ready"]:
+        return FastJSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True, "timings": startup_state["timings"], "indexes": startup_state["indexes"]}
+
 # Add these new endpoints for user registration and login
 @app.post("/register", response_model=dict)
 async def register_user(user_data: UserRegistration):
@@ -1296,7 +3276,25 @@ async def register_user(user_data: UserRegistration):
     }
     
     try:
-        users_collection.insert_one(new_user)
+        for attempt in range(3):
+            try:
+                users_collection.insert_one(new_user)
+                break
+            except DuplicateKeyError as e:
+                # Another registration for this email won the race; the unique index rejected ours
+                if "email" in (e.details or {}).get("keyPattern", {"email": 1}):
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail="Email already registered"
+                    )
+                # The generated user_id is already taken: pick another one
+                new_user.pop("_id", None)
+                new_user["user_id"] = f"user-{uuid.uuid4().hex[:8]}"
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Could not allocate a user id"
+            )
         # Create access token
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
@@ -1363,289 +3361,42 @@ async def read_users_me(current_user: dict = Depends(get_current_user)):
         "age": current_user["age"],
         "comorbidities": current_user["comorbidities"],
         "medications": current_user["medications"],
-        "allergies": current_user["allergies"]
-    }
-
-# Modify the existing chat endpoint to work with registered users
-@app.post("/chat")
-async def chat(user_response: UserResponse, token: str = Depends(oauth2_scheme)):
-    try:
-        # Decode token to get user
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        user_db = get_user_by_email(email)
-        
-        if not user_db:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="User not found"
-            )
-        
-        # Use the user's ID from the database
-        user_id = user_db["user_id"]
-        
-        # Rest of your existing chat logic here, using user_id
-        print(f"Received request: {user_response}")
-        
-        # ADDED: Special handling for "get_diagnosis" token to force diagnosis generation
-        if user_response.response in ["get_diagnosis", "provide diagnosis", "diagnose"]:
-            # Create a state object for diagnosis
-            user = get_user_data(user_id)
-            state_dict = {
-                "user_id": user_id,
-                "response": "proceed to diagnosis",
-                "is_existing": True,
-                "symptoms": user.symptoms,
-                "previous_history": user.previous_history,
-                "medication_history": user.medication_history,
-                "additional_symptoms": user.additional_symptoms,
-                "diagnosis": user.diagnosis,
-                "critical": user.critical,
-                "current_step": "diagnosis_prep"
-            }
-            
-            # Ensure state has custom_context initialized
-            if "custom_context" not in state_dict:
-                state_dict["custom_context"] = {}
-            
-            # Process through diagnosis_prep
-            next_state = diagnosis_prep_handler(state_dict)
-            
-            # Extract and return
-            next_question = next_state.get("current_question", "Unable to generate diagnosis with current information")
-            
-            # Store the updated state
-            update_user_data(user_id, "current_question", next_question)
-            update_user_data(user_id, "current_step", "criticality")
-            
-            # Store chat history in user document
-            users_collection.update_one(
-                {"user_id": user_id},
-                {"$push": {"chat_history": {
-                    "timestamp": datetime.utcnow(),
-                    "user_message": user_response.response,
-                    "bot_response": next_question
-                }}}
-            )
-            
-            return {"next_question": next_question, "current_step": "criticality"}
-        
-        # Special handling for "continue" token to always proceed to next step
-        if user_response.response == "continue":
-            if user_id in user_data_store:
-                user = user_data_store[user_id]
-                current_step = next((item.get("current_step") for item in reversed(user.history) 
-                                   if "current_step" in item), "start")
-                
-                # Force progress to next step in the flow
-                state_dict = {
-                    "user_id": user_id,
-                    "response": "continue",
-                    "is_existing": True,
-                    "symptoms": user.symptoms,
-                    "previous_history": user.previous_history,
-                    "medication_history": user.medication_history,
-                    "additional_symptoms": user.additional_symptoms,
-                    "diagnosis": user.diagnosis,
-                    "critical": user.critical,
-                    "current_step": current_step
-                }
-                
-                # If we're at the additional_symptoms step, we need to move to diagnosis
-                if current_step == "additional_symptoms":
-                    next_step = determine_next_step(state_dict)
-                else:
-                    next_step = determine_next_step(state_dict)
-                
-                # Process the next step
-                next_state = process_step(next_step, state_dict)
-                
-                # Extract question and step
-                next_question = next_state.get("current_question", "What can I help you with?")
-                current_step = next_state.get("current_step", "unknown")
-                
-                # Store the current question and step
-                update_user_data(user_id, "current_question", next_question)
-                update_user_data(user_id, "current_step", current_step)
-                
-                # Store chat history in user document
-                users_collection.update_one(
-                    {"user_id": user_id},
-                    {"$push": {"chat_history": {
-                        "timestamp": datetime.utcnow(),
-                        "user_message": user_response.response,
-                        "bot_response": next_question
-                    }}}
-                )
-                
-                return {"next_question": next_question, "current_step": current_step}
-        
-        # Check if this is a first-time interaction with this user
-        is_first_interaction = user_id not in user_data_store
-        
-        # MAJOR FIX: Create the user record FIRST and process their input
-        if is_first_interaction:
-            # Initialize new user in data store
-            user_data_store[user_id] = UserData(user_id=user_id)
-            
-            # Store their initial response as a symptom/issue
-            update_user_data(user_id, "symptoms", user_response.response)
-            
-            # Create state dictionary with the actual user response
-            state_dict = {
-                "user_id": user_id,
-                "response": user_response.response,  # <-- CRITICAL FIX: Use their actual response
-                "is_existing": False,
-                "symptoms": [user_response.response],
-                "previous_history": None,
-                "medication_history": None,
-                "additional_symptoms": None,
-                "diagnosis": None,
-                "critical": False,
-                "current_step": "initial_assessment"  # Go directly to assessment
-            }
-        else:
-            # Get existing user
-            user = user_data_store[user_id]
-            
-            # Extract current step to determine next action
-            current_step = next((item.get("current_step") for item in reversed(user.history) 
-                               if "current_step" in item), "start")
-            
-            # Create a state dict based on where we are in the conversation
-            state_dict = {
-                "user_id": user_id,
-                "response": user_response.response,
-                "is_existing": True,
-                "symptoms": user.symptoms,
-                "previous_history": user.previous_history,
-                "medication_history": user.medication_history,
-                "additional_symptoms": user.additional_symptoms,
-                "diagnosis": user.diagnosis,
-                "critical": user.critical,
-                "current_step": current_step
-            }
-            
-            # Skip validation for special tokens
-            skip_validation = user_response.response in ["continue", "continue_anyway"]
-            
-            if not skip_validation:
-                # Get the previous question to validate against
-                previous_question = next((item.get("current_question") for item in reversed(user.history) 
-                                         if "current_question" in item), "How can I help you?")
-                
-                # Determine the expected response type based on current step
-                expected_type_map = {
-                    "start": "symptoms",
-                    "symptoms": "symptoms",
-                    "previous_history": "previous_history",
-                    "medication_history": "medication_history",
-                    "additional_symptoms": "additional_symptoms",
-                    "diagnosis_prep": "general",
-                    "diagnosis": "general",
-                    "criticality": "general",
-                    "end": "general"
-                }
-                expected_type = expected_type_map.get(current_step, "general")
-                
-                # When processing validation results, check for partial answers 
-                validation = await validate_response(previous_question, user_response.response, expected_type)
-                
-                # Store validation details for future use
-                validation_details = validation.get("details", {})
-                
-                # If the response is invalid but it's a partial answer to a multi-part question
-                if not validation["is_valid"]:
-                    if validation_details.get("partial_answer", False):
-                        # Store the partial answer but stay on the same step
-                        update_user_data(user_id, "partial_" + current_step, user_response.response, validation_details)
-                        
-                        next_question = validation["feedback"]
-                        
-                        # Store chat history in user document
-                        users_collection.update_one(
-                            {"user_id": user_id},
-                            {"$push": {"chat_history": {
-                                "timestamp": datetime.utcnow(),
-                                "user_message": user_response.response,
-                                "bot_response": next_question
-                            }}}
-                        )
-                        
-                        return {
-                            "next_question": next_question,
-                            "current_step": current_step  # Stay on the same step
-                        }
-                    else:
-                        # Regular invalid response
-                        next_question = validation["feedback"]
-                        
-                        # Store chat history in user document
-                        users_collection.update_one(
-                            {"user_id": user_id},
-                            {"$push": {"chat_history": {
-                                "timestamp": datetime.utcnow(),
-                                "user_message": user_response.response,
-                                "bot_response": next_question
-                            }}}
-                        )
-                        
-                        return {
-                            "next_question": next_question,
-                            "current_step": current_step  # Stay on the same step
-                        }
-                
-                # Update the response with processed version
-                state_dict["response"] = validation["processed_response"]
-                
-                # Store validation details
-                update_user_data(user_id, "validation", "valid", validation_details)
-            elif user_response.response == "continue_anyway":
-                # For continue_anyway, use the previous user response but skip validation
-                last_user_response = next((item.get("response") for item in reversed(user.history) 
-                                          if "response" in item), "")
-                state_dict["response"] = last_user_response
-        
-        print(f"Processing state: {state_dict}")
-        
-        # Update the current step based on the conversation flow
-        next_step = determine_next_step(state_dict)
-        
-        # Process just the specific node for this step
-        next_state = process_step(next_step, state_dict)
-        
-        # Extract question and step from state
-        if not isinstance(next_state, dict):
-            raise HTTPException(status_code=500, detail=f"Expected dict, got {type(next_state)}")
-            
-        next_question = next_state.get("current_question", "What can I help you with?")
-        current_step = next_state.get("current_step", "unknown")
-        
-        # Store the current question for future validation
-        update_user_data(user_id, "current_question", next_question)
+        "allergies": current_user["allergies"]
+    }
+
+# Modify the existing chat endpoint to work with registered users
+@app.post("/chat")
+async def chat(user_response: UserResponse, token: str = Depends(oauth2_scheme)):
+    try:
+        # Decode token to get user
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        email = payload.get("sub")
+        user_db = get_user_by_email(email)
         
-        # Store the current step in history for next time
-        update_user_data(user_id, "current_step", current_step)
+        if not user_db:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User not found"
+            )
         
-        print(f"Returning question: {next_question}, step: {current_step}")
+        # Use the user's ID from the database
+        user_id = user_db["user_id"]
         
-        # Store chat history in user document
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$push": {"chat_history": {
-                "timestamp": datetime.utcnow(),
-                "user_message": user_response.response,
-                "bot_response": next_question
-            }}}
-        )
+        # Rest of your existing chat logic here, using user_id
+        print(f"Received request: {user_response}")
         
-        return {"next_question": next_question, "current_step": current_step}
+        return await run_chat_turn(user_id, user_response)
     
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials"
         )
+    except SessionConflictError as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e)
+        )
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         import traceback
@@ -1655,6 +3406,437 @@ async def chat(user_response: UserResponse, token: str = Depends(oauth2_scheme))
             detail=f"An error occurred: {str(e)}"
         )
 
+# One chat turn for an authenticated user, shared by POST /chat and the WebSocket transport
+async def run_chat_turn(user_id, user_response):
+    # ADDED: Special handling for "get_diagnosis" token to force diagnosis generation
+    if user_response.response in ["get_diagnosis", "provide diagnosis", "diagnose"]:
+        result = await request_coalescer.do(
+            ("chat_diagnosis", user_id),
+            lambda: run_locked(user_id, run_chat_diagnosis, user_id, user_response.response)
+        )
+        return {**result, "state": await run_in_threadpool(session_state, user_id)}
+    
+    # Special handling for "continue" token to always proceed to next step
+    if user_response.response == "continue":
+        user = await run_in_threadpool(user_data_store.get, user_id)
+        if user is not None:
+            current_step = get_current_step(user)
+            result = await request_coalescer.do(
+                ("continue", user_id, current_step),
+                lambda: run_locked(user_id, run_continue_step, user_id)
+            )
+            return {**result, "state": await run_in_threadpool(session_state, user_id)}
+    
+    # Serialize turns for this user so history and current_step stay consistent
+    async with session_locks.hold(user_id):
+        async with async_session_turn():
+            result = await process_chat_turn(user_id, user_response)
+    
+    # Include the derived session state so the client doesn't need to refetch /user
+    return {**result, "state": await run_in_threadpool(session_state, user_id)}
+
+# Chat over a WebSocket: authenticate once, then each turn is a single message.
+#   client: {"type": "auth", "token": ...}                  server: {"type": "ready", "user_id", "state"}
+#   client: {"type": "turn", "id", "response", "history"?}  server: {"type": "ack", "id"}, then
+#                                                             {"type": "reply", "id", "next_question", "current_step", "state"}
+#   client: {"type": "save_history", "entry"}               server: {"type": "saved", "id", ...}
+#   either side: {"type": "ping"} / {"type": "pong"}
+# A frame that isn't valid JSON gets {"type": "error", "status": 400} and the connection stays
+# open. The socket is closed with 1008 (policy violation) when the auth token expires.
+# "history" ({"id", "title"}) saves the turn to the user's chat history along with the reply.
+# After a reconnect, clients resend turns they have no reply for; a turn id that was already
+# processed (or is still running) gets the same reply instead of running twice.
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        auth = await asyncio.wait_for(websocket.receive_json(), timeout=WS_HEARTBEAT_SECONDS)
+        payload = jwt.decode(str(auth.get("token", "")), SECRET_KEY, algorithms=[ALGORITHM])
+        user_db = await run_in_threadpool(get_user_by_email, payload.get("sub"))
+    except (asyncio.TimeoutError, JWTError, ValueError, AttributeError, WebSocketDisconnect):
+        user_db = None
+    if not user_db:
+        await websocket.close(code=4401)
+        return
+    user_id = user_db["user_id"]
+    expires_at = payload.get("exp")
+    
+    send_lock = asyncio.Lock()
+    last_seen = time.monotonic()
+    
+    async def send(message):
+        async with send_lock:
+            try:
+                await websocket.send_text(dump_json(message).decode("utf-8"))
+            except (WebSocketDisconnect, RuntimeError):
+                # Closed mid-turn; run_turn has stored the reply for when the client resends the turn
+                pass
+    
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+            if time.monotonic() - last_seen > 3 * WS_HEARTBEAT_SECONDS:
+                await websocket.close(code=4408)
+                return
+            await send({"type": "ping"})
+    
+    # The token was only checked at auth; end the session when it expires
+    async def expire():
+        await asyncio.sleep(max(0, expires_at - time.time()))
+        await send({"type": "error", "status": status.HTTP_401_UNAUTHORIZED, "detail": "Token expired"})
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    
+    async def turn_reply(turn_id, text):
+        try:
+            result = await run_chat_turn(user_id, UserResponse(user_id=user_id, response=text))
+        except SessionConflictError as e:
+            return {"type": "error", "id": turn_id, "status": status.HTTP_409_CONFLICT, "detail": str(e)}
+        except HTTPException as e:
+            return {"type": "error", "id": turn_id, "status": e.status_code, "detail": e.detail}
+        except Exception as e:
+            print(f"Error in chat socket turn: {str(e)}")
+            return {"type": "error", "id": turn_id, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "detail": f"An error occurred: {str(e)}"}
+        return {"type": "reply", "id": turn_id, **result}
+    
+    # One run of a turn id, shared by every resend of it. The reply and its history entry are
+    # stored here rather than by the caller, which is cancelled if its connection drops
+    # mid-turn; the shielded run still finishes and a later resend gets the stored reply.
+    async def run_turn(turn_id, text, history):
+        reply = await turn_reply(turn_id, text)
+        if reply["type"] == "reply":
+            idempotency_store.set((user_id, f"ws-turn:{turn_id}"), reply)
+            if isinstance(history, dict) and "id" in history:
+                entry = {**history, "messages": [
+                    {"role": "user", "content": text},
+                    {"role": "assistant", "content": reply["next_question"]}
+                ]}
+                await handle_save({"entry": entry})
+        return reply
+    
+    async def handle_turn(message):
+        turn_id = str(message.get("id", ""))
+        text = str(message.get("response", ""))
+        reply = idempotency_store.get((user_id, f"ws-turn:{turn_id}")) if turn_id else None
+        if reply is None:
+            await send({"type": "ack", "id": turn_id})
+            if turn_id:
+                history = message.get("history")
+                reply = await request_coalescer.do(("ws_turn", user_id, turn_id), lambda: run_turn(turn_id, text, history))
+            else:
+                reply = await turn_reply(turn_id, text)
+        await send(reply)
+    
+    async def handle_save(message):
+        entry = message.get("entry")
+        if not isinstance(entry, dict):
+            await send({"type": "error", "status": status.HTTP_400_BAD_REQUEST, "detail": "Missing history entry"})
+            return
+        try:
+            result = await run_in_threadpool(store_chat_history_entry, user_id, entry, message.get("idempotency_key"))
+            await send({"type": "saved", "id": entry.get("id"), **result})
+        except HTTPException as e:
+            await send({"type": "error", "id": entry.get("id"), "status": e.status_code, "detail": e.detail})
+    
+    handlers = {"turn": handle_turn, "save_history": handle_save}
+    tasks = set()
+    heartbeat_task = asyncio.create_task(heartbeat())
+    expiry_task = asyncio.create_task(expire()) if expires_at is not None else None
+    try:
+        state = await run_in_threadpool(lambda: session_state(user_id) if user_data_store.get(user_id) is not None else None)
+        await send({"type": "ready", "user_id": user_id, "state": state})
+        while True:
+            frame = await websocket.receive_text()
+            last_seen = time.monotonic()
+            try:
+                message = orjson.loads(frame)
+            except ValueError:
+                await send({"type": "error", "status": status.HTTP_400_BAD_REQUEST, "detail": "Message is not valid JSON"})
+                continue
+            message_type = message.get("type") if isinstance(message, dict) else None
+            if message_type == "ping":
+                await send({"type": "pong"})
+            elif message_type in handlers:
+                # Run concurrently so heartbeats keep flowing during a long turn
+                task = asyncio.create_task(handlers[message_type](message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif message_type != "pong":
+                await send({"type": "error", "status": status.HTTP_400_BAD_REQUEST, "detail": f"Unknown message type: {message_type}"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        heartbeat_task.cancel()
+        if expiry_task is not None:
+            expiry_task.cancel()
+        for task in tasks:
+            task.cancel()
+
+# Process a regular chat turn; callers must hold the user's session lock and have started
+# an async_session_turn(). The session is loaded (or rehydrated) here, under the lock, so the
+# sweeper can't archive it between the load and the turn.
+async def process_chat_turn(user_id, user_response):
+    # Check if this is a first-time interaction with this user
+    user = await load_turn_session(user_id)
+    is_first_interaction = user is None
+    
+    # MAJOR FIX: Create the user record FIRST and process their input
+    if is_first_interaction:
+        # Initialize new user; written with the rest of the turn
+        save_user_data(user_id, UserData(user_id=user_id))
+        
+        # Store their initial response as a symptom/issue
+        update_user_data(user_id, "symptoms", user_response.response)
+        
+        # Create state dictionary with the actual user response
+        state_dict = {
+            "user_id": user_id,
+            "response": user_response.response,  # <-- CRITICAL FIX: Use their actual response
+            "is_existing": False,
+            "symptoms": [user_response.response],
+            "previous_history": None,
+            "medication_history": None,
+            "additional_symptoms": None,
+            "diagnosis": None,
+            "critical": False,
+            "current_step": "initial_assessment"  # Go directly to assessment
+        }
+    else:
+        # Extract current step to determine next action
+        current_step = next((item.get("current_step") for item in reversed(user.history) 
+                           if "current_step" in item), "start")
+        
+        # Create a state dict based on where we are in the conversation
+        state_dict = {
+            "user_id": user_id,
+            "response": user_response.response,
+            "is_existing": True,
+            "symptoms": user.symptoms,
+            "previous_history": user.previous_history,
+            "medication_history": user.medication_history,
+            "additional_symptoms": user.additional_symptoms,
+            "diagnosis": user.diagnosis,
+            "critical": user.critical,
+            "current_step": current_step
+        }
+        
+        # Skip validation for special tokens
+        skip_validation = user_response.response in ["continue", "continue_anyway"]
+        
+        if not skip_validation:
+            # Get the previous question to validate against
+            previous_question = next((item.get("current_question") for item in reversed(user.history) 
+                                     if "current_question" in item), "How can I help you?")
+            
+            # Determine the expected response type based on current step
+            expected_type_map = {
+                "start": "symptoms",
+                "symptoms": "symptoms",
+                "previous_history": "previous_history",
+                "medication_history": "medication_history",
+                "additional_symptoms": "additional_symptoms",
+                "diagnosis_prep": "general",
+                "diagnosis": "general",
+                "criticality": "general",
+                "end": "general"
+            }
+            expected_type = expected_type_map.get(current_step, "general")
+            
+            # When processing validation results, check for partial answers 
+            validation = await validate_response(previous_question, user_response.response, expected_type, turn_priority(user, current_step))
+            
+            # Store validation details for future use
+            validation_details = validation.get("details", {})
+            
+            # If the response is invalid but it's a partial answer to a multi-part question
+            if not validation["is_valid"]:
+                if validation_details.get("partial_answer", False):
+                    # Store the partial answer but stay on the same step
+                    update_user_data(user_id, "partial_" + current_step, user_response.response, validation_details)
+                    
+                    next_question = validation["feedback"]
+                    
+                    # Store chat history in user document
+                    await run_in_threadpool(
+                        users_collection.update_one,
+                        {"user_id": user_id},
+                        {"$push": {"chat_history": {
+                            "timestamp": datetime.utcnow(),
+                            "user_message": user_response.response,
+                            "bot_response": next_question
+                        }}}
+                    )
+                    
+                    return {
+                        "next_question": next_question,
+                        "current_step": current_step  # Stay on the same step
+                    }
+                else:
+                    # Regular invalid response
+                    next_question = validation["feedback"]
+                    
+                    # Store chat history in user document
+                    await run_in_threadpool(
+                        users_collection.update_one,
+                        {"user_id": user_id},
+                        {"$push": {"chat_history": {
+                            "timestamp": datetime.utcnow(),
+                            "user_message": user_response.response,
+                            "bot_response": next_question
+                        }}}
+                    )
+                    
+                    return {
+                        "next_question": next_question,
+                        "current_step": current_step  # Stay on the same step
+                    }
+            
+            # Update the response with processed version
+            state_dict["response"] = validation["processed_response"]
+            
+            # Store validation details
+            update_user_data(user_id, "validation", "valid", validation_details)
+        elif user_response.response == "continue_anyway":
+            # For continue_anyway, use the previous user response but skip validation
+            last_user_response = next((item.get("response") for item in reversed(user.history) 
+                                      if "response" in item), "")
+            state_dict["response"] = last_user_response
+    
+    print(f"Processing state: {state_dict}")
+    
+    # Update the current step based on the conversation flow
+    next_step = determine_next_step(state_dict)
+    
+    # Process just the specific node for this step
+    next_state = await run_in_threadpool(process_step, next_step, state_dict)
+    
+    # Extract question and step from state
+    if not isinstance(next_state, dict):
+        raise HTTPException(status_code=500, detail=f"Expected dict, got {type(next_state)}")
+        
+    next_question = next_state.get("current_question", "What can I help you with?")
+    current_step = next_state.get("current_step", "unknown")
+    
+    # Store the current question for future validation
+    update_user_data(user_id, "current_question", next_question)
+    
+    # Store the current step in history for next time
+    update_user_data(user_id, "current_step", current_step)
+    
+    print(f"Returning question: {next_question}, step: {current_step}")
+    
+    # Store chat history in user document
+    await run_in_threadpool(
+        users_collection.update_one,
+        {"user_id": user_id},
+        {"$push": {"chat_history": {
+            "timestamp": datetime.utcnow(),
+            "user_message": user_response.response,
+            "bot_response": next_question
+        }}}
+    )
+    
+    return {"next_question": next_question, "current_step": current_step}
+
+# Get the most recent conversation step recorded for a user
+def get_current_step(user):
+    return next((item.get("current_step") for item in reversed(user.history) 
+                 if "current_step" in item), "start")
+
+# Run a forced diagnosis requested from the chat endpoint
+def run_chat_diagnosis(user_id, user_message):
+    # Create a state object for diagnosis
+    user = get_user_data(user_id)
+    state_dict = {
+        "user_id": user_id,
+        "response": "proceed to diagnosis",
+        "is_existing": True,
+        "symptoms": user.symptoms,
+        "previous_history": user.previous_history,
+        "medication_history": user.medication_history,
+        "additional_symptoms": user.additional_symptoms,
+        "diagnosis": user.diagnosis,
+        "critical": user.critical,
+        "current_step": "diagnosis_prep"
+    }
+    
+    # Ensure state has custom_context initialized
+    if "custom_context" not in state_dict:
+        state_dict["custom_context"] = {}
+    
+    # Process through diagnosis_prep
+    next_state = diagnosis_prep_handler(state_dict)
+    
+    # Extract and return
+    next_question = next_state.get("current_question", "Unable to generate diagnosis with current information")
+    
+    # Store the updated state
+    update_user_data(user_id, "current_question", next_question)
+    update_user_data(user_id, "current_step", "criticality")
+    
+    # Store chat history in user document
+    users_collection.update_one(
+        {"user_id": user_id},
+        {"$push": {"chat_history": {
+            "timestamp": datetime.utcnow(),
+            "user_message": user_message,
+            "bot_response": next_question
+        }}}
+    )
+    
+    return {
+        "next_question": next_question,
+        "current_step": "criticality",
+        "diagnosis_from_cache": next_state["custom_context"].get("diagnosis_from_cache", False)
+    }
+
+# Advance the conversation one step for a "continue" request
+def run_continue_step(user_id):
+    user = get_user_data(user_id)
+    current_step = get_current_step(user)
+    
+    # Force progress to next step in the flow
+    state_dict = {
+        "user_id": user_id,
+        "response": "continue",
+        "is_existing": True,
+        "symptoms": user.symptoms,
+        "previous_history": user.previous_history,
+        "medication_history": user.medication_history,
+        "additional_symptoms": user.additional_symptoms,
+        "diagnosis": user.diagnosis,
+        "critical": user.critical,
+        "current_step": current_step
+    }
+    
+    # If we're at the additional_symptoms step, we need to move to diagnosis
+    if current_step == "additional_symptoms":
+        next_step = determine_next_step(state_dict)
+    else:
+        next_step = determine_next_step(state_dict)
+    
+    # Process the next step
+    next_state = process_step(next_step, state_dict)
+    
+    # Extract question and step
+    next_question = next_state.get("current_question", "What can I help you with?")
+    current_step = next_state.get("current_step", "unknown")
+    
+    # Store the current question and step
+    update_user_data(user_id, "current_question", next_question)
+    update_user_data(user_id, "current_step", current_step)
+    
+    # Store chat history in user document
+    users_collection.update_one(
+        {"user_id": user_id},
+        {"$push": {"chat_history": {
+            "timestamp": datetime.utcnow(),
+            "user_message": "continue",
+            "bot_response": next_question
+        }}}
+    )
+    
+    return {"next_question": next_question, "current_step": current_step}
+
 # Helper function to determine the next step based on the current step
 def determine_next_step(state):
     current_step = state.get("current_step", "start")
@@ -1749,14 +3931,341 @@ def update_user_state(user_id, state):
     
     pass
 
+# Small derived view of a session: what the chat client needs after each turn
+def session_state(user_id):
+    user = get_user_data(user_id)
+    
+    urgency_level = "normal"
+    for item in reversed(user.history):
+        if "accident_info" in item:
+            urgency_level = "urgent"
+            break
+        if "urgency_assessment" in item:
+            assessment = parse_json_reply(item["urgency_assessment"]) or {}
+            urgency_level = str(assessment.get("urgency_level", "routine")).lower()
+            break
+    if user.critical:
+        urgency_level = "urgent"
+    
+    return {
+        "version": user.version,
+        "current_step": get_current_step(user),
+        "urgency_level": urgency_level,
+        "symptoms": user.symptoms,
+        "has_previous_history": bool(user.previous_history),
+        "has_medication_history": bool(user.medication_history),
+        "has_additional_symptoms": bool(user.additional_symptoms),
+        "has_diagnosis": bool(user.diagnosis),
+        "critical": user.critical
+    }
+
+# Supports ?fields=a,b to select fields and If-None-Match for conditional requests
 @app.get("/user/{user_id}")
-def get_user(user_id: str):
+def get_user(user_id: str, fields: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
     user_data = get_user_data(user_id)
-    return user_data
+    
+    selected = sorted({field.strip() for field in fields.split(",") if field.strip()}) if fields else []
+    selection_tag = hashlib.sha1(",".join(selected).encode("utf-8")).hexdigest()[:8] if selected else "all"
+    etag = f'W/"{user_data.version}-{selection_tag}"'
+    
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    body = user_data.model_dump(include=set(selected)) if selected else user_data
+    return FastJSONResponse(content=body, headers={"ETag": etag})
+
+# Deterministic sampling so repeated pages see the same subset of sessions
+def in_sample(user_id, sample):
+    if sample >= 1.0:
+        return True
+    return zlib.crc32(user_id.encode("utf-8")) / 0xFFFFFFFF < sample
 
+# Streams sessions as NDJSON, one per line, followed by a line with the next cursor
 @app.get("/debug/users")
-def debug_users():
-    return {"user_count": len(user_data_store), "users": {k: v.dict() for k, v in user_data_store.items()}}
+def debug_users(cursor: Optional[str] = None, limit: int = 100, sample: float = 1.0):
+    limit = max(1, min(limit, 1000))
+    user_ids = sorted(user_data_store.keys())
+    start = bisect.bisect_right(user_ids, cursor) if cursor else 0
+    
+    def generate():
+        sent = 0
+        next_cursor = None
+        for user_id in user_ids[start:]:
+            if sent >= limit:
+                next_cursor = last_user_id
+                break
+            last_user_id = user_id
+            if not in_sample(user_id, sample):
+                continue
+            # Viewing sessions must not bring archived ones back
+            user = user_data_store.peek(user_id)
+            if user is None:
+                continue
+            yield dump_json(user) + b"\n"
+            sent += 1
+        yield dump_json({"next_cursor": next_cursor}) + b"\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# Aggregate session statistics; sizes are estimated from a sample of sessions
+@app.get("/debug/users/stats")
+def debug_users_stats(size_sample: int = 50):
+    lengths = []
+    user_ids = []
+    for user_id, length in user_data_store.history_lengths():
+        user_ids.append(user_id)
+        lengths.append(length)
+    
+    if not lengths:
+        return {"session_count": 0, "history_length": {}, "approx_bytes_per_session": 0, "approx_total_bytes": 0, "approx_memory_bytes_per_session": 0, "approx_total_memory_bytes": 0}
+    
+    lengths.sort()
+    def percentile(p):
+        return lengths[min(len(lengths) - 1, int(len(lengths) * p / 100))]
+    
+    buckets = {"0-9": 0, "10-49": 0, "50-199": 0, "200+": 0}
+    for length in lengths:
+        if length < 10:
+            buckets["0-9"] += 1
+        elif length < 50:
+            buckets["10-49"] += 1
+        elif length < 200:
+            buckets["50-199"] += 1
+        else:
+            buckets["200+"] += 1
+    
+    sampled_sizes = []
+    memory_sizes = []
+    shared = set()
+    for user_id in random.sample(user_ids, min(size_sample, len(user_ids))):
+        user = user_data_store.peek(user_id)
+        if user is not None:
+            sampled_sizes.append(len(dump_json(user)))
+            memory_sizes.append(deep_sizeof(user, shared))
+    bytes_per_session = sum(sampled_sizes) // len(sampled_sizes) if sampled_sizes else 0
+    memory_per_session = sum(memory_sizes) // len(memory_sizes) if memory_sizes else 0
+    
+    return {
+        "session_count": len(lengths),
+        "history_length": {
+            "min": lengths[0],
+            "p50": percentile(50),
+            "p90": percentile(90),
+            "p99": percentile(99),
+            "max": lengths[-1],
+            "buckets": buckets
+        },
+        "approx_bytes_per_session": bytes_per_session,
+        "approx_total_bytes": bytes_per_session * len(lengths),
+        "approx_memory_bytes_per_session": memory_per_session,
+        "approx_total_memory_bytes": memory_per_session * len(lengths)
+    }
+
+@app.get("/debug/compression")
+def debug_compression():
+    report = {}
+    for endpoint, encodings in compression_stats.items():
+        report[endpoint] = {}
+        for encoding, counts in encodings.items():
+            report[endpoint][encoding] = {
+                **counts,
+                "bytes_saved": counts["bytes_in"] - counts["bytes_out"],
+                "ratio": round(counts["bytes_in"] / counts["bytes_out"], 2) if counts["bytes_out"] else None
+            }
+    return report
+
+@app.get("/debug/session_sweeper")
+def debug_session_sweeper():
+    return {**sweeper_stats, "rehydrated": session_archive.restored, "idle_ttl_seconds": SESSION_IDLE_TTL_SECONDS, "finished_ttl_seconds": SESSION_FINISHED_TTL_SECONDS}
+
+@app.get("/debug/session_snapshot")
+def debug_session_snapshot():
+    return {**snapshot_stats, "path": SESSION_SNAPSHOT_PATH, "enabled": SESSION_STORE != "mongo" and bool(SESSION_SNAPSHOT_PATH)}
+
+@app.get("/debug/question_bank")
+def debug_question_bank():
+    return {"version": QUESTION_BANK_VERSION, "nodes": {node: len(slots) for node, slots in QUESTION_BANK.items()}, **question_bank_stats}
+
+@app.get("/debug/speculative_diagnosis")
+def debug_speculative_diagnosis():
+    return {**speculation_stats, "in_flight": sum(1 for job in list(speculative_jobs.values()) if not job["future"].done())}
+
+@app.get("/debug/triage")
+def debug_triage():
+    return {**triage_stats, "concurrency": TRIAGE_BATCH_CONCURRENCY, "max_items": TRIAGE_BATCH_MAX_ITEMS}
+
+@app.get("/debug/llm_cassette")
+def debug_llm_cassette():
+    return llm_cassette.stats()
+
+# Called by replay harnesses before each scripted consultation
+@app.post("/debug/llm_cassette/rewind")
+def rewind_llm_cassette():
+    llm_cassette.rewind()
+    return llm_cassette.stats()
+
+@app.get("/debug/llm_queue")
+def debug_llm_queue():
+    return llm_scheduler.stats()
+
+@app.get("/debug/llm_rate_limits")
+def debug_llm_rate_limits():
+    return [governor.stats() for governor in rate_governors.values()]
+
+@app.get("/debug/llm_http")
+def debug_llm_http():
+    return llm_transport.report()
+
+@app.get("/debug/llm_routing")
+def debug_llm_routing():
+    return llm_router.stats()
+
+@app.get("/debug/session_locks")
+def debug_session_locks():
+    return session_locks.stats()
+
+# Ask the LLM for a doctor-facing case summary; returns (summary, is_fallback)
+def generate_case_summary(user_data):
+    symptoms_text = ", ".join(user_data.symptoms)
+    
+    history_with_validation = [item for item in user_data.history if "validation_details" in item]
+    extracted_details = {}
+    
+    for entry in history_with_validation:
+        validation = entry.get("validation_details", {})
+        if "extracted_symptoms" in validation:
+            extracted_details["symptoms"] = validation["extracted_symptoms"]
+        if "extracted_diagnosis" in validation:
+            extracted_details["diagnosis"] = validation["extracted_diagnosis"]
+        if "medications" in validation:
+            extracted_details["medications"] = validation["medications"]
+        if "side_effects" in validation:
+            extracted_details["side_effects"] = validation["side_effects"]
+    
+    summary_prompt = f"""Generate a concise, professional medical case summary for a doctor based on the following patient information:
+    
+    Presenting Symptoms: {symptoms_text}
+    Medical History: {user_data.previous_history}
+    Medication History: {user_data.medication_history}
+    Additional Symptoms: {user_data.additional_symptoms}
+    Preliminary Diagnosis: {user_data.diagnosis}
+    Urgency Assessment: {"Urgent medical attention recommended" if user_data.critical else "Routine follow-up recommended"}
+    
+    Additional Extracted Details: {extracted_details}
+    
+    Format the summary as a professional medical case summary that a physician would find useful. Include only factual information provided by the patient. Structure the summary with clear headings for Chief Complaint, History, Medications, Assessment, and Recommendations.
+    """
+    
+    summary = llm_router.invoke("summary", summary_prompt)
+    return f"## Medical Case Summary\n\n{summary.content}", summary.response_metadata.get("fallback", False)
+
+# Return the materialized summary for the current session version, generating it if stale
+def materialize_summary(user_id):
+    user_data = get_user_data(user_id)
+    stored = summary_store.get(user_id)
+    if stored is not None and stored["version"] == user_data.version:
+        return stored["summary"]
+    
+    summary, is_fallback = generate_case_summary(user_data)
+    if not is_fallback:
+        summary_store.set(user_id, user_data.version, summary)
+    return summary
+
+# Start generating the summary in the background once the consultation reaches its end
+def schedule_summary(user_id):
+    job = summary_jobs.get(user_id)
+    if job is not None and not job.done():
+        return
+    summary_jobs[user_id] = background_executor.submit(materialize_summary, user_id)
+
+speculative_jobs = {}
+speculation_stats = {"started": 0, "cached": 0, "used": 0, "stale": 0, "preempted": 0, "promoted": 0, "timed_out": 0, "failed": 0}
+
+def run_speculative_diagnosis(prompt, tracker):
+    tracker["started_at"] = time.monotonic()
+    token = llm_call_tracker.set(tracker)
+    try:
+        response = llm_router.invoke("diagnosis", prompt, priority="background")
+    finally:
+        llm_call_tracker.reset(token)
+    if response.response_metadata.get("fallback"):
+        raise LLMUnavailableError("Speculative diagnosis got a fallback reply")
+    return response.content
+
+# Start a background diagnosis for the session's current inputs unless one is already running
+# for them, or the diagnosis cache will answer them anyway
+def speculate_diagnosis(user_id):
+    user_data = get_user_data(user_id)
+    if DIAGNOSIS_CACHE_ENABLED and diagnosis_cache.contains(diagnosis_cache.make_key("diagnosis_prep", canonical_profile(user_data))):
+        speculation_stats["cached"] += 1
+        return
+    prompt = build_diagnosis_prompt(user_data)
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    job = speculative_jobs.get(user_id)
+    if job is not None and job["prompt_hash"] == prompt_hash:
+        return
+    speculation_stats["started"] += 1
+    tracker = {"priority": "background", "futures": []}
+    speculative_jobs[user_id] = {
+        "prompt_hash": prompt_hash,
+        "version": user_data.version,
+        "tracker": tracker,
+        "future": background_executor.submit(run_speculative_diagnosis, prompt, tracker),
+    }
+
+# The speculative diagnosis for exactly this prompt; None when there is none, its inputs have
+# changed since it was started, or it never started. A patient is waiting now, so a job that
+# hasn't started is dropped (the caller diagnoses at interactive priority) and one that has
+# is moved up to interactive priority. The wait is bounded by what is left of the job's own
+# timeout and by SPECULATIVE_DIAGNOSIS_MAX_WAIT_SECONDS, after which the caller makes its own call.
+def take_speculative_diagnosis(user_id, prompt, urgency_level=None):
+    job = speculative_jobs.pop(user_id, None)
+    if job is None:
+        return None
+    if job["prompt_hash"] != hashlib.sha256(prompt.encode("utf-8")).hexdigest():
+        speculation_stats["stale"] += 1
+        job["future"].cancel()
+        return None
+    if job["future"].cancel():
+        speculation_stats["preempted"] += 1
+        return None
+    if not job["future"].done():
+        job["tracker"]["priority"] = "interactive"
+        if any([llm_scheduler.promote(call, "interactive") for call in list(job["tracker"]["futures"])]):
+            speculation_stats["promoted"] += 1
+    remaining = LLM_TIMEOUT_SECONDS - (time.monotonic() - job["tracker"].get("started_at", time.monotonic()))
+    try:
+        content = job["future"].result(timeout=max(0.0, min(remaining, SPECULATIVE_DIAGNOSIS_MAX_WAIT_SECONDS)))
+    except FutureTimeoutError:
+        speculation_stats["timed_out"] += 1
+        print(f"Speculative diagnosis for {user_id} still running; diagnosing directly")
+        return None
+    except Exception as e:
+        speculation_stats["failed"] += 1
+        print(f"Speculative diagnosis for {user_id} unusable: {str(e)}")
+        return None
+    speculation_stats["used"] += 1
+    if DIAGNOSIS_CACHE_ENABLED:
+        diagnosis_cache.set(diagnosis_cache.make_key("diagnosis_prep", canonical_profile(get_user_data(user_id), urgency_level)), content)
+    record_diagnosis_source(user_id, "speculative", started_at_version=job["version"])
+    return content
+
+# Build the doctor-facing case summary for a consultation
+def build_summary(user_id):
+    user_data = get_user_data(user_id)
+    
+    if not user_data or not user_data.symptoms:
+        return {"summary": "## Medical Case Summary\n\nInsufficient data to generate a medical case summary. Please complete the consultation."}
+    
+    # Reuse a background generation that is already running for this session
+    job = summary_jobs.get(user_id)
+    if job is not None and not job.done():
+        try:
+            job.result()
+        except Exception as e:
+            print(f"Background summary failed for {user_id}: {str(e)}")
+    
+    return {"summary": materialize_summary(user_id)}
 
 @app.post("/generate_summary")
 async def generate_summary_endpoint(user_data_request: dict):
@@ -1764,44 +4273,9 @@ async def generate_summary_endpoint(user_data_request: dict):
         user_id = user_data_request.get("user_id")
         if not user_id:
             raise HTTPException(status_code=400, detail="User ID is required")
-            
-        user_data = get_user_data(user_id)
-        
-        if not user_data or not user_data.symptoms:
-            return {"summary": "## Medical Case Summary\n\nInsufficient data to generate a medical case summary. Please complete the consultation."}
-        
-        symptoms_text = ", ".join(user_data.symptoms)
-        
-        history_with_validation = [item for item in user_data.history if "validation_details" in item]
-        extracted_details = {}
-        
-        for entry in history_with_validation:
-            validation = entry.get("validation_details", {})
-            if "extracted_symptoms" in validation:
-                extracted_details["symptoms"] = validation["extracted_symptoms"]
-            if "extracted_diagnosis" in validation:
-                extracted_details["diagnosis"] = validation["extracted_diagnosis"]
-            if "medications" in validation:
-                extracted_details["medications"] = validation["medications"]
-            if "side_effects" in validation:
-                extracted_details["side_effects"] = validation["side_effects"]
         
-        summary_prompt = f"""Generate a concise, professional medical case summary for a doctor based on the following patient information:
-        
-        Presenting Symptoms: {symptoms_text}
-        Medical History: {user_data.previous_history}
-        Medication History: {user_data.medication_history}
-        Additional Symptoms: {user_data.additional_symptoms}
-        Preliminary Diagnosis: {user_data.diagnosis}
-        Urgency Assessment: {"Urgent medical attention recommended" if user_data.critical else "Routine follow-up recommended"}
-        
-        Additional Extracted Details: {extracted_details}
-        
-        Format the summary as a professional medical case summary that a physician would find useful. Include only factual information provided by the patient. Structure the summary with clear headings for Chief Complaint, History, Medications, Assessment, and Recommendations.
-        """
-        
-        summary = llm.invoke(summary_prompt)
-        return {"summary": f"## Medical Case Summary\n\n{summary.content}"}
+        # Under the session lock, so the summary never sees a half-applied turn
+        return await request_coalescer.do(("generate_summary", user_id), lambda: run_locked(user_id, build_summary, user_id))
         
     except Exception as e:
         print(f"Error generating summary: {str(e)}")
@@ -1809,7 +4283,7 @@ async def generate_summary_endpoint(user_data_request: dict):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
-async def validate_response(question, response, expected_type):
+async def validate_response(question, response, expected_type, priority="interactive"):
     if response == "continue":
         return {"is_valid": True, "feedback": None, "processed_response": response}
     
@@ -1986,7 +4460,12 @@ async def validate_response(question, response, expected_type):
     prompt = validation_prompts.get(expected_type, validation_prompts["general"])
     
     try:
-        validation_result = llm.invoke(prompt)
+        # Rejections from the fast tier are treated as low confidence and re-checked
+        validation_result = await run_in_threadpool(
+            llm_router.invoke, "validation", prompt,
+            lambda text: (parse_json_reply(text) or {}).get("is_valid", False) is not False,
+            priority
+        )
         
         import json
         import re
@@ -2052,33 +4531,28 @@ def validate_multi_part_response(question, response, expected_type):
     
     return {"is_complete": True}
 
-@app.post("/force_diagnosis")
-async def force_diagnosis(user_data_request: dict):
-    try:
-        user_id = user_data_request.get("user_id")
-        if not user_id:
-            raise HTTPException(status_code=400, detail="User ID is required")
-            
-        user_data = get_user_data(user_id)
-        if not user_data:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        has_asthma = False
-        lost_inhaler = False
-        breathing_issues = False
-        
-        for item in user_data.history:
-            for key, value in item.items():
-                if isinstance(value, str):
-                    if "asthma" in value.lower():
-                        has_asthma = True
-                    if "lost" in value.lower() and "inhaler" in value.lower():
-                        lost_inhaler = True
-                    if any(phrase in value.lower() for phrase in ["can't breathe", "cant breathe", "difficulty breathing"]):
-                        breathing_issues = True
-        
-        if has_asthma and (lost_inhaler or breathing_issues):
-            urgent_html = f"""<div class="urgent-message">
+# Generate a diagnosis on demand, short-circuiting known emergencies
+def run_force_diagnosis(user_id):
+    user_data = get_user_data(user_id)
+    if not user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    has_asthma = False
+    lost_inhaler = False
+    breathing_issues = False
+    
+    for item in user_data.history:
+        for key, value in item.items():
+            if isinstance(value, str):
+                if "asthma" in value.lower():
+                    has_asthma = True
+                if "lost" in value.lower() and "inhaler" in value.lower():
+                    lost_inhaler = True
+                if any(phrase in value.lower() for phrase in ["can't breathe", "cant breathe", "difficulty breathing"]):
+                    breathing_issues = True
+    
+    if has_asthma and (lost_inhaler or breathing_issues):
+        urgent_html = f"""<div class="urgent-message">
 <div class="urgent-header">⚠️ URGENT ASTHMA EMERGENCY ⚠️</div>
 <div class="urgent-content">
   <p><strong>1.</strong> Call emergency services (911) immediately</p>
@@ -2088,40 +4562,53 @@ async def force_diagnosis(user_data_request: dict):
 </div>
 <div class="urgent-footer">Without an inhaler, an asthma attack can be life-threatening. Seek emergency help immediately.</div>
 </div>"""
-            
-            update_user_data(user_id, "current_question", urgent_html)
-            update_user_data(user_id, "current_step", "emergency_services")
-            
-            return {
-                "next_question": urgent_html,
-                "current_step": "emergency_services"
-            }
-        
-        state_dict = {
-            "user_id": user_id,
-            "response": "proceed to diagnosis",
-            "is_existing": True,
-            "symptoms": user_data.symptoms,
-            "previous_history": user_data.previous_history,
-            "medication_history": user_data.medication_history,
-            "additional_symptoms": user_data.additional_symptoms,
-            "diagnosis": user_data.diagnosis,
-            "critical": user_data.critical,
-            "current_step": "diagnosis_prep"
-        }
-        
-        next_state = diagnosis_prep_handler(state_dict)
         
-        diagnosis = next_state.get("current_question", "Unable to generate diagnosis with current information")
-        
-        update_user_data(user_id, "current_question", diagnosis)
-        update_user_data(user_id, "current_step", "criticality")
+        update_user_data(user_id, "current_question", urgent_html)
+        update_user_data(user_id, "current_step", "emergency_services")
         
         return {
-            "next_question": diagnosis,
-            "current_step": "criticality"
+            "next_question": urgent_html,
+            "current_step": "emergency_services"
         }
+    
+    state_dict = {
+        "user_id": user_id,
+        "response": "proceed to diagnosis",
+        "is_existing": True,
+        "symptoms": user_data.symptoms,
+        "previous_history": user_data.previous_history,
+        "medication_history": user_data.medication_history,
+        "additional_symptoms": user_data.additional_symptoms,
+        "diagnosis": user_data.diagnosis,
+        "critical": user_data.critical,
+        "current_step": "diagnosis_prep"
+    }
+    
+    next_state = diagnosis_prep_handler(state_dict)
+    
+    diagnosis = next_state.get("current_question", "Unable to generate diagnosis with current information")
+    
+    update_user_data(user_id, "current_question", diagnosis)
+    update_user_data(user_id, "current_step", "criticality")
+    
+    return {
+        "next_question": diagnosis,
+        "current_step": "criticality",
+        "diagnosis_from_cache": next_state["custom_context"].get("diagnosis_from_cache", False)
+    }
+
+@app.post("/force_diagnosis")
+async def force_diagnosis(user_data_request: dict):
+    try:
+        user_id = user_data_request.get("user_id")
+        if not user_id:
+            raise HTTPException(status_code=400, detail="User ID is required")
         
+        result = await request_coalescer.do(("force_diagnosis", user_id), lambda: run_locked(user_id, run_force_diagnosis, user_id))
+        return {**result, "state": await run_in_threadpool(session_state, user_id)}
+        
+    except SessionConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         print(f"Error in force_diagnosis endpoint: {str(e)}")
         import traceback
@@ -2135,7 +4622,7 @@ class ChatHistoryEntry(BaseModel):
 
 # Add the save_chat_history endpoint
 @app.post("/save_chat_history")
-async def save_chat_history(entry_data: ChatHistoryEntry, token: str = Depends(oauth2_scheme)):
+async def save_chat_history(entry_data: ChatHistoryEntry, token: str = Depends(oauth2_scheme), idempotency_key: Optional[str] = Header(None)):
     # Validate the user through token
     current_user = await get_current_user(token)
     if current_user["user_id"] != entry_data.user_id:
@@ -2144,9 +4631,22 @@ async def save_chat_history(entry_data: ChatHistoryEntry, token: str = Depends(o
             detail="Not authorized to save history for this user"
         )
     
+    return store_chat_history_entry(entry_data.user_id, entry_data.history_entry, idempotency_key)
+
+# Append an entry to a user's saved chat history; shared by /save_chat_history and the chat socket
+def store_chat_history_entry(user_id, history_entry, idempotency_key=None):
+    # Retried saves with the same idempotency key (or entry id) are no-ops
+    entry_id = history_entry.get("id")
+    if not idempotency_key and entry_id is not None:
+        idempotency_key = f"{history_entry.get('type', 'chat')}:{entry_id}"
+    if idempotency_key:
+        previous_result = idempotency_store.get((user_id, idempotency_key))
+        if previous_result is not None:
+            return previous_result
+    
     try:
         # Get the user's document from MongoDB
-        user_doc = users_collection.find_one({"user_id": entry_data.user_id})
+        user_doc = users_collection.find_one({"user_id": user_id})
         
         if not user_doc:
             raise HTTPException(
@@ -2158,13 +4658,20 @@ async def save_chat_history(entry_data: ChatHistoryEntry, token: str = Depends(o
         if "chat_history" not in user_doc:
             user_doc["chat_history"] = []
         
+        # The entry may already have been stored by an earlier attempt
+        if entry_id is not None and any(str(item.get("id")) == str(entry_id) for item in user_doc["chat_history"]):
+            result = {"status": "success", "message": "Chat history already saved"}
+            if idempotency_key:
+                idempotency_store.set((user_id, idempotency_key), result)
+            return result
+        
         # Check if this is a summary entry
-        is_summary = entry_data.history_entry.get("type") == "summary"
+        is_summary = history_entry.get("type") == "summary"
         
         if is_summary:
             # For summaries, check if we already have a summary from the same consultation
             # (within 5 minutes of this entry)
-            entry_time = datetime.fromisoformat(entry_data.history_entry.get("timestamp")) if "timestamp" in entry_data.history_entry else datetime.fromtimestamp(entry_data.history_entry.get("id") / 1000)
+            entry_time = datetime.fromisoformat(history_entry.get("timestamp")) if "timestamp" in history_entry else datetime.fromtimestamp(history_entry.get("id") / 1000)
             
             # Look for existing summaries in the last 5 minutes
             existing_summaries = []
@@ -2180,29 +4687,32 @@ async def save_chat_history(entry_data: ChatHistoryEntry, token: str = Depends(o
             if existing_summaries:
                 # If we have existing summaries from this consultation
                 # If this is a Doctor Summary, replace any existing summary
-                if entry_data.history_entry.get("title") == "Doctor Summary":
+                if history_entry.get("title") == "Doctor Summary":
                     for idx, _ in existing_summaries:
                         user_doc["chat_history"].pop(idx)
-                    user_doc["chat_history"].append(entry_data.history_entry)
+                    user_doc["chat_history"].append(history_entry)
                 # Otherwise, only add if we don't already have a Doctor Summary
                 else:
                     has_doctor_summary = any(s[1].get("title") == "Doctor Summary" for s in existing_summaries)
                     if not has_doctor_summary:
-                        user_doc["chat_history"].append(entry_data.history_entry)
+                        user_doc["chat_history"].append(history_entry)
             else:
                 # No existing summaries found, add this one
-                user_doc["chat_history"].append(entry_data.history_entry)
+                user_doc["chat_history"].append(history_entry)
         else:
             # Add the new history entry (not a summary)
-            user_doc["chat_history"].append(entry_data.history_entry)
+            user_doc["chat_history"].append(history_entry)
         
         # Update the user document
         users_collection.update_one(
-            {"user_id": entry_data.user_id},
+            {"user_id": user_id},
             {"$set": {"chat_history": user_doc["chat_history"]}}
         )
         
-        return {"status": "success", "message": "Chat history saved successfully"}
+        result = {"status": "success", "message": "Chat history saved successfully"}
+        if idempotency_key:
+            idempotency_store.set((user_id, idempotency_key), result)
+        return result
         
     except Exception as e:
         raise HTTPException(
@@ -2246,7 +4756,7 @@ async def view_summary(user_id: str, summary_id: str, token: str = Depends(oauth
                 detail="Summary not found"
             )
         
-        return {"summary": summary}
+        return FastJSONResponse(content={"summary": summary})
         
     except Exception as e:
         raise HTTPException(
@@ -2278,7 +4788,7 @@ async def get_chat_history(user_id: str, token: str = Depends(oauth2_scheme)):
         # Return chat history or empty list if none exists
         chat_history = user_doc.get("chat_history", [])
         
-        return {"chat_history": chat_history}
+        return FastJSONResponse(content={"chat_history": chat_history})
         
     except Exception as e:
         raise HTTPException(
@@ -2286,6 +4796,79 @@ async def get_chat_history(user_id: str, token: str = Depends(oauth2_scheme)):
             detail=f"Error retrieving chat history: {str(e)}"
         )
 
+class TriageBatchRequest(BaseModel):
+    descriptions: List[str]
+
+triage_stats = {"batches": 0, "items": 0, "keywords": 0, "llm": 0, "errors": 0}
+
+# One classification per distinct description; coalesced duplicates share it and aren't counted again
+async def classify_triage_description(description):
+    result = await run_in_threadpool(classify_intake, description, "triage_batch")
+    triage_stats[result["source"]] += 1
+    return result
+
+# Pre-visit triage of one description; identical descriptions in flight share one classification.
+# Items that couldn't be classified come back with an error and UNKNOWN urgency, never a default.
+async def triage_description(index, description, semaphore):
+    if not description.strip():
+        triage_stats["errors"] += 1
+        return {"index": index, "urgency_level": "UNKNOWN", "error": "Empty description"}
+    async with semaphore:
+        started = time.perf_counter()
+        key = ("triage", hashlib.sha256(description.strip().lower().encode("utf-8")).hexdigest())
+        try:
+            result = await request_coalescer.do(key, lambda: classify_triage_description(description))
+        except Exception as e:
+            print(f"Error triaging batch item {index}: {str(e)}")
+            triage_stats["errors"] += 1
+            return {"index": index, "urgency_level": "UNKNOWN", "error": str(e)}
+        return {"index": index, **result, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+# Bulk intake triage for partner clinics. Runs keyword and urgency classification over up to
+# TRIAGE_BATCH_MAX_ITEMS descriptions, TRIAGE_BATCH_CONCURRENCY at a time, and streams one NDJSON
+# line per description as it finishes (in completion order, tagged with its index), then a summary line
+@app.post("/triage/batch")
+async def triage_batch(batch: TriageBatchRequest, token: str = Depends(oauth2_scheme)):
+    await get_current_user(token)
+    if not batch.descriptions:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No descriptions to triage")
+    if len(batch.descriptions) > TRIAGE_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {TRIAGE_BATCH_MAX_ITEMS} descriptions per batch"
+        )
+    triage_stats["batches"] += 1
+    triage_stats["items"] += len(batch.descriptions)
+    
+    async def generate():
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(TRIAGE_BATCH_CONCURRENCY)
+        tasks = [asyncio.ensure_future(triage_description(index, description, semaphore)) for index, description in enumerate(batch.descriptions)]
+        errors = 0
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                result = await next_result
+                errors += "error" in result
+                yield dump_json(result) + b"\n"
+        finally:
+            # The client went away: stop classifying the rest of the batch
+            for task in tasks:
+                task.cancel()
+        yield dump_json({
+            "done": True,
+            "items": len(tasks),
+            "errors": errors,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+        }) + b"\n"
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WORKERS > 1:
+        # Each worker is a separate process, so sessions must live in the shared store
+        if SESSION_STORE != "mongo":
+            raise SystemExit("WORKERS > 1 requires SESSION_STORE=mongo so conversations survive across workers")
+        uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")), workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
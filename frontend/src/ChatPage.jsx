@@ -81,6 +81,17 @@ const diagnosisStyles = `
     min-width: 1.5rem;
   }
   
+  .urgent-questions {
+    color: #7f1d1d;
+    margin-bottom: 0.75rem;
+  }
+  
+  .urgent-questions ul {
+    list-style-type: disc;
+    padding-left: 1.25rem;
+    margin-top: 0.25rem;
+  }
+  
   .urgent-footer {
     font-size: 0.9rem;
     font-weight: bold;
@@ -110,6 +121,8 @@ const ChatPage = () => {
   const [showSummaryButton, setShowSummaryButton] = useState(false);
   const [messageCount, setMessageCount] = useState(0);
   const messagesEndRef = useRef(null);
+  const socketRef = useRef(null);
+  const pendingTurnsRef = useRef(new Map());
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -151,6 +164,57 @@ const ChatPage = () => {
     }
   }, [user, navigate]);
 
+  // Keep a chat socket open so each turn is a single message. The HTTP endpoints
+  // remain the fallback while it is connecting or if the server rejects it.
+  useEffect(() => {
+    let closed = false;
+    let activeSocket = null;
+    let retryTimer = null;
+    let retryDelay = 1000;
+
+    const connect = () => {
+      const token = localStorage.getItem('medbot_token');
+      if (!token || closed) return;
+
+      const socket = new WebSocket('wss://medbot-bknd.onrender.com/ws/chat');
+      activeSocket = socket;
+      socket.onopen = () => socket.send(JSON.stringify({ type: 'auth', token }));
+      socket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'ready') {
+          socketRef.current = socket;
+          retryDelay = 1000;
+          // Resume: resend turns that never got a reply; the server runs each turn id only once
+          pendingTurnsRef.current.forEach((turn) => socket.send(JSON.stringify(turn.message)));
+        } else if (message.type === 'ping') {
+          socket.send(JSON.stringify({ type: 'pong' }));
+        } else if (message.type === 'reply' || (message.type === 'error' && message.id)) {
+          const turn = pendingTurnsRef.current.get(message.id);
+          if (turn) {
+            pendingTurnsRef.current.delete(message.id);
+            turn.resolve(message);
+          }
+        }
+      };
+      socket.onclose = (event) => {
+        if (socketRef.current === socket) {
+          socketRef.current = null;
+        }
+        // 4401: authentication rejected, stay on HTTP
+        if (closed || event.code === 4401) return;
+        retryTimer = setTimeout(connect, retryDelay);
+        retryDelay = Math.min(retryDelay * 2, 30000);
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retryTimer);
+      activeSocket?.close();
+    };
+  }, [user]);
+
   useEffect(() => {
     // Add initial welcome message only once when component mounts
     setMessages([{
@@ -209,9 +273,6 @@ const ChatPage = () => {
       
       // Explicitly set conversation complete to true
       setConversationComplete(true);
-      
-      // Fetch user data to update the sidebar
-      fetchUserData();
     }
   }, [currentStep, messages]);
 
@@ -297,56 +358,71 @@ const ChatPage = () => {
       // For the first message in a completely new conversation, make sure we reset the step
       const isFirstMessage = currentStep === 'start' && messageCount === 0;
       
-      // Use fetchWithAuth instead of fetch
-      const response = await fetchWithAuth('https://medbot-bknd.onrender.com/chat', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          user_id: userId,
-          response: currentInput,
-          new_conversation: isFirstMessage, // Tell backend this is a fresh conversation
-          reset_context: isFirstMessage, // Additional flag to force context reset
-          ignore_previous: true // Ignore any previous conversation context for safer handling
-        }),
-      });
+      // One socket message carries the turn and saves it to chat history; fall back to HTTP
+      const historyEntry = { id: Date.now(), title: chatHistoryTitle(currentInput) };
+      const socketReply = await sendSocketTurn(currentInput, historyEntry);
+      
+      let data;
+      if (socketReply) {
+        // Remove loading message
+        setMessages(prev => prev.filter(msg => !msg.isLoading));
+        
+        if (socketReply.type === 'error') {
+          throw new Error(socketReply.detail || `Server error: ${socketReply.status}`);
+        }
+        data = socketReply;
+      } else {
+        // Use fetchWithAuth instead of fetch
+        const response = await fetchWithAuth('https://medbot-bknd.onrender.com/chat', {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({
+            user_id: userId,
+            response: currentInput,
+            new_conversation: isFirstMessage, // Tell backend this is a fresh conversation
+            reset_context: isFirstMessage, // Additional flag to force context reset
+            ignore_previous: true // Ignore any previous conversation context for safer handling
+          }),
+        });
 
-      // Remove loading message
-      setMessages(prev => prev.filter(msg => !msg.isLoading));
+        // Remove loading message
+        setMessages(prev => prev.filter(msg => !msg.isLoading));
 
-      if (!response.ok) {
-        const errorData = await response.json().catch(() => ({}));
-        console.error('Server error:', errorData);
+        if (!response.ok) {
+          const errorData = await response.json().catch(() => ({}));
+          console.error('Server error:', errorData);
         
-        // If unauthorized, redirect to login
-        if (response.status === 401) {
-          localStorage.removeItem('medbot_token');
-          localStorage.removeItem('medbot_user');
-          navigate('/login');
-          throw new Error('Session expired. Please login again.');
-        }
+          // If unauthorized, redirect to login
+          if (response.status === 401) {
+            localStorage.removeItem('medbot_token');
+            localStorage.removeItem('medbot_user');
+            navigate('/login');
+            throw new Error('Session expired. Please login again.');
+          }
 
-        // Check if it's the known AIMessage error
-        if (errorData.detail && errorData.detail.includes("AIMessage' object has no attribute 'strip")) {
-          // Fall back to getting a diagnosis directly
-          setMessages(prev => [...prev, {
-            role: 'assistant',
-            content: "I'm having trouble processing your input. Let me try to provide a diagnosis based on what I know so far."
-          }]);
+          // Check if it's the known AIMessage error
+          if (errorData.detail && errorData.detail.includes("AIMessage' object has no attribute 'strip")) {
+            // Fall back to getting a diagnosis directly
+            setMessages(prev => [...prev, {
+              role: 'assistant',
+              content: "I'm having trouble processing your input. Let me try to provide a diagnosis based on what I know so far."
+            }]);
           
-          // Try to force a diagnosis after a short delay
-          setTimeout(() => {
-            requestDiagnosis();
-          }, 1500);
+            // Try to force a diagnosis after a short delay
+            setTimeout(() => {
+              requestDiagnosis();
+            }, 1500);
           
-          return;
+            return;
+          }
+        
+          throw new Error(errorData.detail || `Server error: ${response.status}`);
         }
         
-        throw new Error(errorData.detail || `Server error: ${response.status}`);
+        data = await response.json();
       }
-
-      const data = await response.json();
       console.log('Received response:', data);
 
       if (!data.next_question) {
@@ -360,6 +436,9 @@ const ChatPage = () => {
       // Increment message exchange counter
       setMessageCount(prev => prev + 1);
       
+      // Update the sidebar from the session state returned with the reply
+      applySessionState(data.state);
+      
       // Update current step
       if (data.current_step) {
         setCurrentStep(data.current_step);
@@ -367,13 +446,13 @@ const ChatPage = () => {
         if (data.current_step === "criticality" || data.current_step === "criticality_node") {
           setConversationComplete(true);
           setShowSummaryButton(true);
-          // Fetch user data to update the sidebar
-          fetchUserData();
         }
       }
       
-      // Update chat history
-      updateChatHistory(currentInput, data.next_question);
+      // Update chat history (already saved by the server for socket turns)
+      if (!socketReply) {
+        updateChatHistory(currentInput, data.next_question);
+      }
       
     } catch (error) {
       console.error('Error details:', error);
@@ -393,18 +472,44 @@ const ChatPage = () => {
     }
   };
   
-  const updateChatHistory = (userMessage, botResponse) => {
-    // Instead of updating the UI state for every message, 
-    // we'll only save this to the backend but not show it in the sidebar
+  // Send a chat turn over the socket; resolves with the reply, or null when the socket isn't connected
+  const sendSocketTurn = (text, history) => {
+    const socket = socketRef.current;
+    if (!socket || socket.readyState !== WebSocket.OPEN) {
+      return Promise.resolve(null);
+    }
     
-    // Create a new history entry with title based on first few words of user message
-    const title = userMessage.length > 20 
+    const id = `turn-${Date.now()}-${Math.random().toString(36).substr(2, 6)}`;
+    const message = { type: 'turn', id, response: text, history };
+    return new Promise((resolve, reject) => {
+      const timer = setTimeout(() => {
+        pendingTurnsRef.current.delete(id);
+        reject(new Error('The server took too long to reply'));
+      }, 120000);
+      pendingTurnsRef.current.set(id, {
+        message,
+        resolve: (reply) => {
+          clearTimeout(timer);
+          resolve(reply);
+        }
+      });
+      socket.send(JSON.stringify(message));
+    });
+  };
+  
+  // Title for a chat history entry, based on the first few words of the user message
+  const chatHistoryTitle = (userMessage) => {
+    return userMessage.length > 20 
       ? userMessage.substring(0, 20) + '...' 
       : userMessage;
-      
+  };
+  
+  const updateChatHistory = (userMessage, botResponse) => {
+    // Instead of updating the UI state for every message, 
+    // we'll only save this to the backend but not show it in the sidebar
     const newEntry = {
       id: Date.now(),
-      title: title,
+      title: chatHistoryTitle(userMessage),
       messages: [
         { role: 'user', content: userMessage },
         { role: 'assistant', content: botResponse }
@@ -416,9 +521,27 @@ const ChatPage = () => {
     saveChatHistoryToBackend(newEntry);
   };
   
+  // Update patient data from the compact session state returned by /chat and /force_diagnosis
+  const applySessionState = (state) => {
+    if (!state) {
+      fetchUserData();
+      return;
+    }
+    
+    setPatientData({
+      symptoms: state.symptoms || [],
+      previous_history: state.has_previous_history,
+      medication_history: state.has_medication_history,
+      additional_symptoms: state.has_additional_symptoms,
+      diagnosis: state.has_diagnosis,
+      critical: state.critical || false
+    });
+  };
+  
   const fetchUserData = async () => {
     try {
-      const response = await fetchWithAuth(`https://medbot-bknd.onrender.com/user/${userId}`);
+      const fields = 'symptoms,previous_history,medication_history,additional_symptoms,diagnosis,critical';
+      const response = await fetchWithAuth(`https://medbot-bknd.onrender.com/user/${userId}?fields=${fields}`);
       if (response.ok) {
         const data = await response.json();
         console.log('User data:', data);
@@ -591,11 +714,22 @@ const ChatPage = () => {
   
   // Function to save chat history to backend
   const saveChatHistoryToBackend = async (historyEntry) => {
+    const socket = socketRef.current;
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      socket.send(JSON.stringify({
+        type: 'save_history',
+        entry: historyEntry,
+        idempotency_key: `${historyEntry.type || 'chat'}:${historyEntry.id}`
+      }));
+      return;
+    }
+    
     try {
       const response = await fetchWithAuth('https://medbot-bknd.onrender.com/save_chat_history', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Idempotency-Key': `${historyEntry.type || 'chat'}:${historyEntry.id}`,
         },
         body: JSON.stringify({
           user_id: userId,
@@ -797,13 +931,15 @@ const ChatPage = () => {
       const botMessage = { role: 'assistant', content: data.next_question };
       setMessages(prev => [...prev, botMessage]);
       
+      // Update the sidebar from the session state returned with the reply
+      applySessionState(data.state);
+      
       // Update current step
       if (data.current_step) {
         setCurrentStep(data.current_step);
         
         if (data.current_step === "end") {
           setConversationComplete(true);
-          fetchUserData();
         }
       }
       
@@ -935,7 +1071,7 @@ const ChatPage = () => {
       // Mark conversation as complete even if we don't get criticality step
       setConversationComplete(true);
       setShowSummaryButton(true);
-      fetchUserData();
+      applySessionState(data.state);
       
       // If we're now at criticality, fetch user data and save recommendation to history
       if (data.current_step === "criticality" || data.current_step === "criticality_node") {